@@ -0,0 +1,451 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Iterable, Optional
+
+import numpy as np
+import pygame
+import sounddevice as sd
+import speech_recognition as sr
+
+from audio_format import PLAYBACK_DTYPES, PlaybackFormat
+from deadline import LatencyTracker
+
+logger = logging.getLogger('voice_chat_ai.audio')
+
+class AudioInput:
+    """開いたままにするマイクと、ターンをまたいで使う音声認識器
+
+    雑音レベルの測定は最初に開いたときの1回だけで、その後は発話していない区間のエネルギーで追跡する。
+    読み取りに失敗したら閉じ、次の聞き取りで開き直す。
+    """
+
+    def __init__(self, device_name: str = "", calibration_seconds: float = 1.0, recheck_seconds: float = 30.0):
+        self.device_name = device_name
+        self.calibration_seconds = calibration_seconds
+        self.recheck_seconds = recheck_seconds
+        self.recognizer = sr.Recognizer()
+        self.source: Optional[sr.Microphone] = None
+        self.device_index: Optional[int] = None
+        self.checked_at = 0.0
+        self.calibrated = False
+        self.lock = threading.Lock()
+        self.setup_latency = LatencyTracker()
+        self.counters = {"opened": 0, "errors": 0, "drained_frames": 0}
+
+    def _find_device(self) -> Optional[int]:
+        """名前にdevice_nameを含む入力デバイスの番号（見つからなければ既定のデバイス）"""
+        self.checked_at = time.monotonic()
+        if not self.device_name:
+            return None
+        for index, name in enumerate(sr.Microphone.list_microphone_names()):
+            if self.device_name.lower() in (name or "").lower():
+                return index
+        logger.warning(f"入力デバイスが見つからないため既定のデバイスを使います: {self.device_name}")
+        return None
+
+    def _open(self):
+        self.device_index = self._find_device()
+        source = sr.Microphone(device_index=self.device_index)
+        source.__enter__()
+        if source.stream is None:
+            raise OSError("マイクを開けませんでした")
+        self.source = source
+        self.counters["opened"] += 1
+        if not self.calibrated:
+            self.recognizer.adjust_for_ambient_noise(source, duration=self.calibration_seconds)
+            self.calibrated = True
+            logger.info(f"雑音レベルを測定しました（しきい値: {self.recognizer.energy_threshold:.0f}）")
+
+    def _close(self):
+        source, self.source = self.source, None
+        if source is not None:
+            try:
+                source.__exit__(None, None, None)
+            except Exception as e:
+                logger.debug(f"マイクを閉じる際のエラー: {str(e)}")
+
+    def _preferred_device_returned(self) -> bool:
+        # 指定のデバイスがなく既定のデバイスで開いている場合だけ、一定間隔で接続を確認する
+        if not self.device_name or self.device_index is not None:
+            return False
+        if time.monotonic() - self.checked_at < self.recheck_seconds:
+            return False
+        return self._find_device() is not None
+
+    def _drain(self):
+        # 前のターン（応答の再生中など）に溜まった音声を捨てる
+        stream = self.source.stream.pyaudio_stream
+        for _ in range(8):
+            available = stream.get_read_available()
+            if available <= 0:
+                break
+            stream.read(available, exception_on_overflow=False)
+            self.counters["drained_frames"] += available
+
+    def acquire(self) -> sr.Microphone:
+        """聞き取りの開始時に呼ぶ（開いたままのマイクを返す）"""
+        started_at = time.monotonic()
+        with self.lock:
+            if self.source is not None and self._preferred_device_returned():
+                logger.info(f"入力デバイスを切り替えます: {self.device_name}")
+                self._close()
+            if self.source is None:
+                self._open()
+            try:
+                self._drain()
+            except OSError as e:
+                # 開いたままのストリームが使えなくなっていれば開き直す
+                self._recover(e)
+                self._open()
+        self.setup_latency.record(time.monotonic() - started_at)
+        return self.source
+
+    def _recover(self, error: BaseException):
+        self.counters["errors"] += 1
+        logger.warning(f"入力デバイスのエラーのため開き直します: {str(error)}")
+        self._close()
+
+    def recover(self, error: BaseException):
+        """読み取りに失敗した場合に呼ぶ（次のacquireで開き直す）"""
+        with self.lock:
+            self._recover(error)
+
+    def track_noise(self, energy: float, seconds_per_buffer: float):
+        """発話していない区間のエネルギーでしきい値を更新（Recognizer.listenの動的調整と同じ式）"""
+        recognizer = self.recognizer
+        if not recognizer.dynamic_energy_threshold:
+            return
+        damping = recognizer.dynamic_energy_adjustment_damping ** seconds_per_buffer
+        target_energy = energy * recognizer.dynamic_energy_ratio
+        recognizer.energy_threshold = recognizer.energy_threshold * damping + target_energy * (1 - damping)
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            **self.counters,
+            "energy_threshold": round(self.recognizer.energy_threshold, 1),
+            "setup": self.setup_latency.summary()
+        }
+
+def query_playback_format(device: Optional[int]) -> PlaybackFormat:
+    """出力デバイスの既定のサンプルレートとチャンネル数（最大2）、受け付けるdtypeを問い合わせる"""
+    info = sd.query_devices(device, 'output')
+    samplerate = int(info["default_samplerate"])
+    channels = max(1, min(2, int(info["max_output_channels"])))
+    for dtype in PLAYBACK_DTYPES:
+        try:
+            sd.check_output_settings(device=device, channels=channels, dtype=dtype, samplerate=samplerate)
+        except (sd.PortAudioError, ValueError):
+            continue
+        return PlaybackFormat(samplerate, channels, dtype)
+    raise sd.PortAudioError(f"出力デバイスが対応する形式がありません: {info['name']}")
+
+class OutputStream:
+    """開いたままにする出力ストリーム（再生するものがなければ無音を出し続ける）
+
+    再生はbegin → write（デバイスの形式に変換済みのブロック）→ finishの順に行う。
+    再生中に書き込みが追いつかず無音で埋めた回数をunderrunsに数える。
+    """
+
+    def __init__(self, device: Optional[int], playback_format: PlaybackFormat, block_seconds: float):
+        self.format = playback_format
+        self.blocks: deque = deque()
+        self.offset = 0
+        self.playing = False
+        self.ending = False
+        self.started = False
+        self.failed = False
+        self.drained = threading.Event()
+        self.drained.set()
+        self.underruns = 0
+        self.blocksize = int(playback_format.samplerate * block_seconds)
+        self.written = 0
+        self.stream = sd.OutputStream(
+            device=device,
+            channels=playback_format.channels,
+            dtype=playback_format.dtype,
+            samplerate=playback_format.samplerate,
+            blocksize=self.blocksize,
+            callback=self._callback,
+            finished_callback=self._finished
+        )
+        self.stream.start()
+
+    def _callback(self, outdata, frames, time_info, status):
+        if status.output_underflow and self.playing:
+            self.underruns += 1
+        if not self.started and self.written < self.blocksize and not self.ending:
+            # 1ブロック分たまるまでは再生を始めない（リサンプラーの遅延で最初のブロックは短くなる）
+            outdata.fill(0)
+            return
+        filled = 0
+        blocks = self.blocks
+        while filled < frames:
+            try:
+                block = blocks[0]
+            except IndexError:
+                # 再生待ちがない（stopで消された場合を含む）
+                break
+            count = min(frames - filled, len(block) - self.offset)
+            outdata[filled:filled + count] = block[self.offset:self.offset + count]
+            filled += count
+            self.offset += count
+            if self.offset >= len(block):
+                if blocks and blocks[0] is block:
+                    blocks.popleft()
+                self.offset = 0
+        if filled:
+            self.started = True
+        if filled < frames:
+            outdata[filled:] = 0
+            if self.playing and self.ending:
+                self.playing = False
+                self.drained.set()
+            elif self.playing and self.started:
+                # 変換が再生に追いつかなかった
+                self.underruns += 1
+
+    def _finished(self):
+        # デバイスが外れるなどしてストリームが止まった
+        self.failed = True
+        self.drained.set()
+
+    @property
+    def usable(self) -> bool:
+        return not self.failed and self.stream.active
+
+    def begin(self):
+        self.blocks.clear()
+        self.offset = 0
+        self.ending = False
+        self.started = False
+        self.written = 0
+        self.drained.clear()
+        self.playing = True
+
+    def write(self, block: np.ndarray):
+        if len(block):
+            self.blocks.append(block)
+            self.written += len(block)
+
+    def finish(self, should_continue: Callable[[], bool]) -> bool:
+        """書き込んだ分を再生し終わるまで待つ（中断したらFalse）"""
+        self.ending = True
+        while not self.drained.wait(0.1):
+            if not should_continue():
+                self.stop()
+                return False
+        if self.failed:
+            raise sd.PortAudioError("出力ストリームが停止しました")
+        return True
+
+    def stop(self):
+        self.playing = False
+        self.blocks.clear()
+        self.drained.set()
+
+    def close(self):
+        self.stop()
+        try:
+            self.stream.close()
+        except Exception as e:
+            logger.debug(f"出力ストリームを閉じる際のエラー: {str(e)}")
+
+class AudioOutput:
+    """開いたままにする再生デバイス（ファイル再生用のpygameのミキサーと、PCM再生用の出力ストリーム）
+
+    デバイスの形式（サンプルレート・チャンネル数・dtype）は開くときに1回だけ問い合わせ、ミキサーとストリームをその形式で開く。
+    再生に失敗したら閉じて開き直す。デバイスの一覧はsounddeviceの公開APIで問い合わせるだけで、
+    PortAudioの初期化し直しはしない（開いたままのストリームを壊さないため）。
+    """
+
+    def __init__(self, device_name: str = "", block_seconds: float = 0.05, recheck_seconds: float = 30.0):
+        self.device_name = device_name
+        self.block_seconds = block_seconds
+        self.recheck_seconds = recheck_seconds
+        self.stream: Optional[OutputStream] = None
+        self.device: Optional[int] = None
+        self.format: Optional[PlaybackFormat] = None
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+        self.setup_latency = LatencyTracker()
+        self.counters = {"mixer_opened": 0, "stream_opened": 0, "errors": 0, "underruns": 0}
+
+    def _native_format(self) -> PlaybackFormat:
+        if self.format is None:
+            self.device = self._find_device()
+            self.format = query_playback_format(self.device)
+            logger.info(f"出力デバイスの形式: {self.format}")
+        return self.format
+
+    def _ensure_mixer(self):
+        if not pygame.mixer.get_init():
+            # デコードした音声をデバイスの形式で出力させ、ホスト側での変換を減らす
+            try:
+                playback_format = self._native_format()
+                pygame.mixer.init(frequency=playback_format.samplerate, channels=playback_format.channels)
+            except (sd.PortAudioError, ValueError) as e:
+                logger.warning(f"出力デバイスの形式を取得できないため既定の設定でミキサーを開きます: {str(e)}")
+                pygame.mixer.init()
+            self.counters["mixer_opened"] += 1
+
+    def _close_mixer(self):
+        try:
+            pygame.mixer.quit()
+        except Exception as e:
+            logger.debug(f"ミキサーを閉じる際のエラー: {str(e)}")
+
+    def play_file(self, path: str):
+        """音声ファイルを再生し、終わるまで待つ"""
+        with self.lock:
+            for attempt in range(2):
+                started_at = time.monotonic()
+                try:
+                    self._ensure_mixer()
+                    pygame.mixer.music.load(path)
+                    self.setup_latency.record(time.monotonic() - started_at)
+                    pygame.mixer.music.play()
+                    break
+                except pygame.error as e:
+                    self.counters["errors"] += 1
+                    logger.warning(f"ミキサーのエラーのため開き直します: {str(e)}")
+                    self._close_mixer()
+                    if attempt:
+                        raise
+
+        # 再生が終わるまで待機
+        while pygame.mixer.music.get_busy():
+            time.sleep(0.1)
+
+    def _find_device(self) -> Optional[int]:
+        """名前にdevice_nameを含む出力デバイスの番号（見つからなければ既定のデバイス）"""
+        self.checked_at = time.monotonic()
+        if not self.device_name:
+            return None
+        for index, info in enumerate(sd.query_devices()):
+            if info["max_output_channels"] > 0 and self.device_name.lower() in info["name"].lower():
+                return index
+        logger.warning(f"出力デバイスが見つからないため既定のデバイスを使います: {self.device_name}")
+        return None
+
+    def _preferred_device_returned(self) -> bool:
+        # 指定のデバイスがなく既定のデバイスで開いている場合だけ、一定間隔で接続を確認する
+        # （一覧を問い合わせるだけなので、開いているストリームはそのまま）
+        if not self.device_name or self.device is not None:
+            return False
+        if time.monotonic() - self.checked_at < self.recheck_seconds:
+            return False
+        return self._find_device() is not None
+
+    def _close_stream(self):
+        stream, self.stream = self.stream, None
+        if stream is not None:
+            self.counters["underruns"] += stream.underruns
+            stream.close()
+
+    def _reset_device(self):
+        # 別のデバイスに切り替わる可能性があるので、形式も問い合わせ直す
+        self._close_stream()
+        self.format = None
+
+    def _acquire_stream(self) -> OutputStream:
+        stream = self.stream
+        if stream is not None and not stream.usable:
+            self._reset_device()
+        elif stream is not None and self._preferred_device_returned():
+            logger.info(f"出力デバイスを切り替えます: {self.device_name}")
+            self._reset_device()
+        if self.stream is None:
+            playback_format = self._native_format()
+            self.stream = OutputStream(self.device, playback_format, self.block_seconds)
+            self.counters["stream_opened"] += 1
+        return self.stream
+
+    def play_blocks(
+        self,
+        convert: Callable[[PlaybackFormat], Iterable[np.ndarray]],
+        should_continue: Callable[[], bool] = lambda: True
+    ) -> bool:
+        """デバイスの形式に変換したブロックを順に再生し、終わるまで待つ（中断したらFalse）
+
+        convertにはデバイスの形式が渡され、変換済みのブロックを1つずつ返す。
+        変換しながら再生するので、最初のブロックができた時点で音が出始める。
+        """
+        with self.lock:
+            for attempt in range(2):
+                started_at = time.monotonic()
+                try:
+                    stream = self._acquire_stream()
+                    self.setup_latency.record(time.monotonic() - started_at)
+                    break
+                except sd.PortAudioError as e:
+                    self.counters["errors"] += 1
+                    logger.warning(f"出力デバイスを開けないため開き直します: {str(e)}")
+                    self._reset_device()
+                    if attempt:
+                        raise
+
+            try:
+                stream.begin()
+                for block in convert(stream.format):
+                    if not should_continue() or stream.failed:
+                        break
+                    stream.write(block)
+                else:
+                    return stream.finish(should_continue)
+                if stream.failed:
+                    raise sd.PortAudioError("出力ストリームが停止しました")
+                stream.stop()
+                return False
+            except sd.PortAudioError as e:
+                # 次の再生で開き直す
+                self.counters["errors"] += 1
+                logger.warning(f"出力デバイスのエラーのため開き直します: {str(e)}")
+                self._reset_device()
+                raise
+
+    def stop(self):
+        """再生中のPCMを止める"""
+        stream = self.stream
+        if stream is not None:
+            stream.stop()
+
+    def close(self):
+        with self.lock:
+            self._close_stream()
+            self._close_mixer()
+
+    def stats(self) -> Dict[str, Any]:
+        underruns = self.counters["underruns"] + (self.stream.underruns if self.stream is not None else 0)
+        return {
+            **self.counters,
+            "underruns": underruns,
+            "format": self.format._asdict() if self.format is not None else None,
+            "setup": self.setup_latency.summary()
+        }
+
+class AudioDevices:
+    """ターンをまたいで開いたままにする入出力デバイス"""
+
+    def __init__(
+        self,
+        input_device: str = "",
+        output_device: str = "",
+        calibration_seconds: float = 1.0,
+        recheck_seconds: float = 30.0,
+        block_seconds: float = 0.05
+    ):
+        self.input = AudioInput(input_device, calibration_seconds, recheck_seconds)
+        self.output = AudioOutput(output_device, block_seconds, recheck_seconds)
+
+    def close(self):
+        self.input.close()
+        self.output.close()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {"input": self.input.stats(), "output": self.output.stats()}
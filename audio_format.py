@@ -0,0 +1,154 @@
+import math
+from typing import NamedTuple, Optional
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# デバイスに渡す形式として使えるdtype（優先順）
+PLAYBACK_DTYPES = ("float32", "int32", "int16")
+
+class PlaybackFormat(NamedTuple):
+    """出力デバイスの形式（起動後に1回だけ問い合わせる）"""
+    samplerate: int
+    channels: int
+    dtype: str
+
+def pcm_to_float(frames: bytes, sample_width: int, channels: int = 1) -> np.ndarray:
+    """PCMデータを-1.0〜1.0のfloat32配列（フレーム数×チャンネル数）に変換"""
+    if sample_width == 1:
+        # 8bitのWAVは符号なし
+        samples = (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128.0) / 128.0
+    elif sample_width == 2:
+        samples = np.frombuffer(frames, dtype="<i2").astype(np.float32) / 32768.0
+    elif sample_width == 3:
+        # 24bitは3バイトずつ詰めて並んでいるので、上位にずらして32bitとして読む
+        packed = np.frombuffer(frames, dtype=np.uint8)
+        packed = packed[:len(packed) - len(packed) % 3].reshape(-1, 3)
+        widened = np.zeros((len(packed), 4), dtype=np.uint8)
+        widened[:, 1:] = packed
+        samples = widened.view("<i4")[:, 0].astype(np.float32) / 2147483648.0
+    elif sample_width == 4:
+        samples = np.frombuffer(frames, dtype="<i4").astype(np.float32) / 2147483648.0
+    else:
+        raise ValueError(f"未対応のサンプル幅です: {sample_width}")
+    return samples[:len(samples) - len(samples) % channels].reshape(-1, channels)
+
+def map_channels(samples: np.ndarray, channels: int) -> np.ndarray:
+    """チャンネル数を合わせる（モノラルからは複製、モノラルへは平均、それ以外は先頭から対応させて足りない分は平均）"""
+    source = samples.shape[1]
+    if source == channels:
+        return samples
+    if source == 1:
+        return np.repeat(samples, channels, axis=1)
+    if channels == 1:
+        return samples.mean(axis=1, keepdims=True)
+    if source > channels:
+        return samples[:, :channels]
+    return np.concatenate([samples, np.repeat(samples.mean(axis=1, keepdims=True), channels - source, axis=1)], axis=1)
+
+def float_to_dtype(samples: np.ndarray, dtype: str) -> np.ndarray:
+    """-1.0〜1.0のfloat32をデバイスのdtypeに変換"""
+    if dtype == "float32":
+        return np.ascontiguousarray(samples, dtype=np.float32)
+    scale = {"int16": 32767.0, "int32": 2147483647.0}[dtype]
+    return (np.clip(samples, -1.0, 1.0) * scale).astype(dtype)
+
+class PolyphaseResampler:
+    """有理数比のポリフェーズ・リサンプラー（ブロックごとに処理し、ブロック間のフィルタ状態を保持する）
+
+    入力をup倍に補間してdown分の1に間引く処理を、出力サンプルごとに必要な位相の係数だけで計算する。
+    1ブロック分の出力はスライディング窓と係数の積和（einsum）でまとめて求める。
+    """
+
+    def __init__(self, input_rate: int, output_rate: int, channels: int, taps_per_phase: int = 24, rolloff: float = 0.9, beta: float = 8.0):
+        divisor = math.gcd(input_rate, output_rate)
+        self.up = output_rate // divisor
+        self.down = input_rate // divisor
+        self.channels = channels
+        # 間引く場合は通過帯域が狭くなる分だけフィルタを長くする
+        self.taps = taps_per_phase * max(1, -(-self.down // self.up))
+
+        # フィルタの遅延（出力サンプル数）。遅延分だけ出力の位置をずらし、入力と出力の先頭を揃える
+        length = self.taps * self.up
+        self.delay = int(round((length - 1) / 2 / self.down))
+
+        # カイザー窓をかけたsincの低域通過フィルタ（補間後のサンプル列に対して設計）。
+        # 中心を出力サンプルの位置に合わせ、遅延が出力の整数サンプルになるようにする
+        cutoff = rolloff * 0.5 / max(self.up, self.down)
+        n = np.arange(length) - self.delay * self.down
+        prototype = 2 * cutoff * np.sinc(2 * cutoff * n) * np.kaiser(length, beta) * self.up
+        # phases[p, j] = prototype[p + j*up]。窓は時間順に並ぶので係数を逆順にしておく
+        self.phases = np.ascontiguousarray(prototype.reshape(self.taps, self.up).T[:, ::-1], dtype=np.float32)
+
+        self.output_index = self.delay
+        self.history = np.zeros((self.taps - 1, channels), dtype=np.float32)
+        self.history_start = -(self.taps - 1)  # history[0]の入力サンプル位置
+        self.input_frames = 0
+
+    @property
+    def passthrough(self) -> bool:
+        return self.up == self.down
+
+    def process(self, samples: np.ndarray) -> np.ndarray:
+        """1ブロック分（フレーム数×チャンネル数）を変換"""
+        if self.passthrough or not len(samples):
+            return samples
+        self.input_frames += len(samples)
+        buffer = np.concatenate([self.history, samples.astype(np.float32, copy=False)])
+        last_input = self.history_start + len(buffer) - 1
+
+        # 必要な入力がそろっている出力サンプルをまとめて計算する
+        end = ((last_input + 1) * self.up - 1) // self.down + 1
+        indices = np.arange(self.output_index, end)
+        bases = indices * self.down // self.up
+        phases = indices * self.down % self.up
+        windows = sliding_window_view(buffer, self.taps, axis=0)  # (窓の数, チャンネル数, タップ数)
+        output = np.einsum("kct,kt->kc", windows[bases - (self.taps - 1) - self.history_start], self.phases[phases])
+        self.output_index = end
+
+        # 次の出力に必要な分だけ入力を残す
+        keep_from = end * self.down // self.up - (self.taps - 1)
+        self.history = buffer[keep_from - self.history_start:]
+        self.history_start = keep_from
+        return output.astype(np.float32, copy=False)
+
+    def flush(self) -> np.ndarray:
+        """入力の終わりにフィルタに残っている分を出力"""
+        if self.passthrough:
+            return np.zeros((0, self.channels), dtype=np.float32)
+        expected = self.input_frames * self.up // self.down
+        produced = self.output_index - self.delay
+        tail = self.process(np.zeros((self.taps, self.channels), dtype=np.float32))
+        return tail[:max(0, expected - produced)]
+
+class PlaybackConverter:
+    """受け取ったPCMをデバイスの形式（サンプルレート・チャンネル数・dtype）に変換"""
+
+    def __init__(self, samplerate: int, sample_width: int, channels: int, target: PlaybackFormat, taps_per_phase: int = 24):
+        self.sample_width = sample_width
+        self.channels = channels
+        self.target = target
+        self.resampler: Optional[PolyphaseResampler] = None
+        if samplerate != target.samplerate:
+            # チャンネル数が少ない側でリサンプルする（モノラル→ステレオなら計算は1チャンネル分）
+            self.resampler = PolyphaseResampler(samplerate, target.samplerate, min(channels, target.channels), taps_per_phase)
+        self.remainder = b""
+
+    def convert(self, frames: bytes) -> np.ndarray:
+        """1ブロック分のPCMを変換（フレームの途中で切れた分は次のブロックに回す）"""
+        frame_bytes = self.sample_width * self.channels
+        frames = self.remainder + frames
+        usable = len(frames) - len(frames) % frame_bytes
+        frames, self.remainder = frames[:usable], frames[usable:]
+        samples = pcm_to_float(frames, self.sample_width, self.channels)
+        if self.channels > self.target.channels:
+            samples = map_channels(samples, self.target.channels)
+        if self.resampler is not None:
+            samples = self.resampler.process(samples)
+        return float_to_dtype(map_channels(samples, self.target.channels), self.target.dtype)
+
+    def flush(self) -> np.ndarray:
+        """入力の終わりに残っている分を変換"""
+        if self.resampler is None:
+            return float_to_dtype(np.zeros((0, self.target.channels), dtype=np.float32), self.target.dtype)
+        return float_to_dtype(map_channels(self.resampler.flush(), self.target.channels), self.target.dtype)
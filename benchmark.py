@@ -0,0 +1,645 @@
+"""性能計測用スクリプト
+
+使い方:
+    python benchmark.py stt-server --port 9000   # ローカルの代替STTサーバーを起動
+    python benchmark.py stt                      # 逐次文字起こしと一括文字起こしを比較
+    python benchmark.py mcp-load --path /time    # 起動中のmcp_serverの負荷試験
+    python benchmark.py logging                  # リクエスト処理中のログ出力コストを比較
+    python benchmark.py serialization            # MCP応答のシリアライズ方式を比較
+    python benchmark.py workers --workers 1 2 4  # ワーカー数ごとのスループットを比較
+    python benchmark.py kws                      # キーワードゲートの誤受理・誤棄却と削減できるSTT呼び出し
+    python benchmark.py hedge                    # ヘッジと期限によるターン所要時間の裾の比較
+    python benchmark.py playback                 # 再生形式の変換のCPU時間（音声1秒あたり）と音切れの回数
+"""
+import argparse
+import json
+import os
+import statistics
+import threading
+import time
+import urllib.request
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional, Tuple
+
+from streaming_stt import StreamingTranscriber, pcm_to_wav
+
+# ---------------------------------------------------------------------------
+# 代替STTサーバー
+# ---------------------------------------------------------------------------
+
+# 代替STTが認識する文字（合成音声の1区間に1文字を割り当てる）
+STT_ALPHABET = "きょうのとうきょうとおおさかのてんきとじこくをおしえてください"
+STT_SEGMENT_SECONDS = 0.25
+STT_SAMPLE_RATE = 16000
+
+def synthesize_utterance(text: str) -> bytes:
+    """文字ごとに一定振幅の区間を並べた合成音声（16bit PCM）を生成"""
+    samples_per_segment = int(STT_SAMPLE_RATE * STT_SEGMENT_SECONDS)
+    frames = bytearray()
+    for char in text:
+        amplitude = 1000 + 100 * STT_ALPHABET.index(char)
+        frames.extend(amplitude.to_bytes(2, 'little', signed=True) * samples_per_segment)
+    return bytes(frames)
+
+def decode_utterance(frames: bytes) -> str:
+    """合成音声を文字列に戻す（区間に満たない端数は無視）"""
+    samples_per_segment = int(STT_SAMPLE_RATE * STT_SEGMENT_SECONDS)
+    bytes_per_segment = samples_per_segment * 2
+    chars = []
+    for offset in range(0, len(frames) - bytes_per_segment + 1, bytes_per_segment):
+        amplitude = int.from_bytes(frames[offset:offset + 2], 'little', signed=True)
+        index = (amplitude - 1000) // 100
+        if 0 <= index < len(STT_ALPHABET):
+            chars.append(STT_ALPHABET[index])
+    return "".join(chars)
+
+class StandInSTTHandler(BaseHTTPRequestHandler):
+    """OpenAIの /v1/audio/transcriptions を模倣するハンドラー
+
+    音声長に比例した遅延を入れて、Whisperの処理時間を模擬する。
+    """
+    base_latency = 0.3
+    latency_per_second = 0.15
+
+    def do_POST(self):
+        if not self.path.endswith("/audio/transcriptions"):
+            self.send_error(404)
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        riff = body.find(b"RIFF")
+        if riff < 0:
+            self.send_error(400, "WAVデータが見つかりません")
+            return
+        size = int.from_bytes(body[riff + 4:riff + 8], 'little') + 8
+        frames = body[riff + 44:riff + size]
+
+        audio_seconds = len(frames) / (STT_SAMPLE_RATE * 2)
+        time.sleep(self.base_latency + self.latency_per_second * audio_seconds)
+
+        payload = json.dumps({"text": decode_utterance(frames)}, ensure_ascii=False).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stt_server(port: int) -> ThreadingHTTPServer:
+    """代替STTサーバーをバックグラウンドで起動"""
+    server = ThreadingHTTPServer(("127.0.0.1", port), StandInSTTHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def make_transcribe(base_url: str):
+    """代替STTサーバーに問い合わせる文字起こし関数を作成"""
+    def transcribe(wav_data: bytes, prompt: Optional[str] = None) -> str:
+        boundary = uuid.uuid4().hex
+        body = (
+            f"--{boundary}\r\n"
+            'Content-Disposition: form-data; name="model"\r\n\r\nwhisper-1\r\n'
+            f"--{boundary}\r\n"
+            'Content-Disposition: form-data; name="file"; filename="speech.wav"\r\n'
+            "Content-Type: audio/wav\r\n\r\n"
+        ).encode() + wav_data + f"\r\n--{boundary}--\r\n".encode()
+        request = urllib.request.Request(
+            f"{base_url}/audio/transcriptions",
+            data=body,
+            headers={"Content-Type": f"multipart/form-data; boundary={boundary}"}
+        )
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())["text"]
+    return transcribe
+
+def bench_stt(args):
+    """逐次文字起こしと一括文字起こしの発話終了後の待ち時間を比較"""
+    server = start_stt_server(args.port)
+    transcribe = make_transcribe(f"http://127.0.0.1:{args.port}/v1")
+    text = STT_ALPHABET[:args.chars]
+    frames = synthesize_utterance(text)
+    buffer_bytes = int(STT_SAMPLE_RATE * 0.1) * 2
+    audio_seconds = len(frames) / (STT_SAMPLE_RATE * 2)
+    print(f"発話長: {audio_seconds:.2f}秒 ({len(text)}文字), 再生速度: x{args.speed}")
+
+    batch_latencies: List[float] = []
+    stream_latencies: List[float] = []
+    for _ in range(args.runs):
+        # 一括: 発話終了後に全体を1回で送信
+        started = time.monotonic()
+        result = transcribe(pcm_to_wav(frames, STT_SAMPLE_RATE, 2))
+        batch_latencies.append(time.monotonic() - started)
+        assert result == text, f"一括結果が不一致: {result}"
+
+        # 逐次: マイクと同じ間隔で音声を投入しながら窓を送信
+        partials = []
+        transcriber = StreamingTranscriber(
+            transcribe, STT_SAMPLE_RATE, 2,
+            chunk_seconds=args.chunk, window_seconds=args.window,
+            on_partial=partials.append
+        )
+        for offset in range(0, len(frames), buffer_bytes):
+            transcriber.feed(frames[offset:offset + buffer_bytes])
+            time.sleep(0.1 / args.speed)
+        started = time.monotonic()
+        result = transcriber.finish()
+        stream_latencies.append(time.monotonic() - started)
+        assert result == text, f"逐次結果が不一致: {result}"
+
+    server.shutdown()
+    print(f"部分結果の例: {partials[:3]}")
+    print(f"一括: 発話終了から確定まで 中央値 {statistics.median(batch_latencies):.3f}秒")
+    print(f"逐次: 発話終了から確定まで 中央値 {statistics.median(stream_latencies):.3f}秒 "
+          f"(窓 {args.window}秒 / チャンク {args.chunk}秒)")
+
+def run_stt_server(args):
+    """代替STTサーバーをフォアグラウンドで起動"""
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), StandInSTTHandler)
+    print(f"代替STTサーバー: http://127.0.0.1:{args.port}/v1 (OPENAI_BASE_URLに設定して使用)")
+    server.serve_forever()
+
+# ---------------------------------------------------------------------------
+# MCPサーバー負荷試験
+# ---------------------------------------------------------------------------
+
+def percentile(values: List[float], ratio: float) -> float:
+    """パーセンタイル値（最近傍法）"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * ratio))]
+
+def report_latencies(label: str, latencies: List[float], elapsed: float):
+    """レイテンシ分布とスループットを表示"""
+    print(f"{label}: {len(latencies)}件 / {elapsed:.2f}秒 ({len(latencies) / elapsed:.1f} req/s) "
+          f"p50={percentile(latencies, 0.5) * 1000:.2f}ms "
+          f"p95={percentile(latencies, 0.95) * 1000:.2f}ms "
+          f"p99={percentile(latencies, 0.99) * 1000:.2f}ms")
+
+def run_load(url: str, path: str, api_key: str, concurrency: int, requests: int) -> Tuple[List[float], float]:
+    """並列リクエストを送り、各リクエストのレイテンシと全体の所要時間を返す"""
+    headers = {"Authorization": f"Bearer {api_key}"}
+    latencies: List[float] = []
+    lock = threading.Lock()
+
+    def worker(count: int):
+        for _ in range(count):
+            request = urllib.request.Request(f"{url}{path}", headers=headers)
+            started = time.perf_counter()
+            with urllib.request.urlopen(request) as response:
+                response.read()
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+
+    per_worker = requests // concurrency
+    threads = [threading.Thread(target=worker, args=(per_worker,)) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, time.perf_counter() - started
+
+def bench_mcp_load(args):
+    """起動中のmcp_serverに並列リクエストを送り、レイテンシを計測
+
+    ログ設定の比較は LOG_QUEUE=0 / LOG_QUEUE=1 でサーバーを起動し直して実行する。
+    リクエストごとにアプリのログを書くのは天気情報の取得（キャッシュにない場合）だけで、
+    これは上流の枠で間隔が空けられるため、負荷試験ではログ出力のコストはほとんど見えない。
+    """
+    latencies, elapsed = run_load(args.url, args.path, args.api_key, args.concurrency, args.requests)
+    report_latencies(f"{args.path} (並列数 {args.concurrency})", latencies, elapsed)
+
+def wait_for_server(url: str, timeout: float = 30.0):
+    """サーバーが応答するまで待機"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"{url}/health") as response:
+                response.read()
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError(f"サーバーが起動しませんでした: {url}")
+
+def bench_workers(args):
+    """ワーカー数ごとにmcp_serverを起動し、スループットの伸びを計測"""
+    import subprocess
+    import sys
+    import tempfile
+
+    baseline = None
+    for workers in args.workers:
+        env = dict(
+            os.environ,
+            MCP_SERVER_HOST="127.0.0.1",
+            MCP_SERVER_PORT=str(args.port),
+            MCP_SERVER_WORKERS=str(workers),
+            MCP_CACHE_PATH=os.path.join(tempfile.mkdtemp(), "cache.sqlite3"),
+            MCP_LOG_LEVEL="WARNING"
+        )
+        server = subprocess.Popen([sys.executable, "mcp_server.py"], env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        url = f"http://127.0.0.1:{args.port}"
+        try:
+            wait_for_server(url)
+            run_load(url, args.path, args.api_key, args.concurrency, args.concurrency * 10)
+            latencies, elapsed = run_load(url, args.path, args.api_key, args.concurrency, args.requests)
+        finally:
+            server.terminate()
+            server.wait()
+        throughput = len(latencies) / elapsed
+        baseline = baseline or throughput
+        report_latencies(f"ワーカー数 {workers} (x{throughput / baseline:.2f})", latencies, elapsed)
+
+def bench_logging(args):
+    """リクエスト処理中のログ出力コストを同期書き込みとキュー経由で比較
+
+    サーバーは起動せず、1リクエスト分のログ出力だけをプロセス内で計測する（HTTP処理を含むレイテンシではない）。
+    """
+    import logging
+    import tempfile
+    import log_config
+
+    result = {
+        "status": "success",
+        "data": {"city": "Tokyo", "weather": {"description": "晴れ", "temperature": {"current": 20.5, "max": 23.1, "min": 17.2},
+                 "humidity": 60, "wind_speed": 3.2, "clouds": 10}}
+    }
+
+    def handle_request_print_style(logger):
+        # 変更前: 整形済みメッセージを同期的に書き込む
+        logger.debug("天気情報の取得を開始: 都市名 = Tokyo")
+        logger.debug(f"天気情報の取得成功: {json.dumps(result, ensure_ascii=False)}")
+
+    def handle_request_structured(logger):
+        log_config.log_event(logger, logging.DEBUG, "weather.fetch.start", city="Tokyo")
+        log_config.log_event(logger, logging.DEBUG, "weather.fetch.success", city="Tokyo", result=result)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        log_file = os.path.join(tmp, "bench.log")
+        logger = logging.getLogger("bench")
+        root = logging.getLogger()
+
+        # 同期書き込み（変更前の FileHandler 構成）
+        root.handlers.clear()
+        root.setLevel(logging.DEBUG)
+        handler = logging.FileHandler(log_file)
+        handler.setFormatter(logging.Formatter(log_config.LOG_FORMAT))
+        root.addHandler(handler)
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(args.requests):
+            t = time.perf_counter()
+            handle_request_print_style(logger)
+            latencies.append(time.perf_counter() - t)
+        report_latencies("同期FileHandler", latencies, time.perf_counter() - started)
+        root.removeHandler(handler)
+        handler.close()
+
+        # キュー経由 + ローテーション（同期側と件数を揃えるためサンプリングは無効）
+        os.environ["LOG_QUEUE"] = "1"
+        os.environ["LOG_SAMPLE_RATE"] = "0"
+        log_config.setup_logging(log_file, level=logging.DEBUG, console=False)
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(args.requests):
+            t = time.perf_counter()
+            handle_request_structured(logger)
+            latencies.append(time.perf_counter() - t)
+        report_latencies("キュー経由", latencies, time.perf_counter() - started)
+        log_config.shutdown_logging()
+        root.handlers.clear()
+
+# ---------------------------------------------------------------------------
+# シリアライズ
+# ---------------------------------------------------------------------------
+
+def time_per_call(func, iterations: int) -> float:
+    """1回あたりの実行時間（マイクロ秒）"""
+    started = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - started) / iterations * 1e6
+
+def bench_serialization(args):
+    """MCP応答のシリアライズ・デシリアライズ方式を比較"""
+    import mcp_codec
+
+    weather = {
+        "status": "success",
+        "data": {"city": "Tokyo", "weather": {"description": "晴れ", "temperature": {"current": 20.5, "max": 23.1, "min": 17.2},
+                 "humidity": 60, "wind_speed": 3.2, "clouds": 10}}
+    }
+    files = {"status": "success", "data": {"type": "files", "info": "\n".join(f"ファイル_{i}.txt" for i in range(2000))}}
+    payloads = {"weather": weather, "files(2000件)": files}
+
+    for name, payload in payloads.items():
+        print(f"[{name}]")
+        std_body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        print(f"  json (標準)   encode {time_per_call(lambda: json.dumps(payload, ensure_ascii=False).encode('utf-8'), args.iterations):8.2f}us"
+              f"  decode {time_per_call(lambda: json.loads(std_body), args.iterations):8.2f}us  {len(std_body)}B")
+        if mcp_codec.orjson is not None:
+            body = mcp_codec.orjson.dumps(payload)
+            print(f"  orjson        encode {time_per_call(lambda: mcp_codec.orjson.dumps(payload), args.iterations):8.2f}us"
+                  f"  decode {time_per_call(lambda: mcp_codec.orjson.loads(body), args.iterations):8.2f}us  {len(body)}B")
+        if mcp_codec.msgpack is not None:
+            body = mcp_codec.msgpack.packb(payload, use_bin_type=True)
+            print(f"  msgpack       encode {time_per_call(lambda: mcp_codec.msgpack.packb(payload, use_bin_type=True), args.iterations):8.2f}us"
+                  f"  decode {time_per_call(lambda: mcp_codec.msgpack.unpackb(body, raw=False), args.iterations):8.2f}us  {len(body)}B")
+
+    # /commands は起動時にシリアライズ済みの本文を返すだけになる
+    commands = {"status": "success", "data": {"commands": {"weather": {"description": "天気情報を取得"}}}}
+    bodies = {media_type: mcp_codec.encode(commands, media_type) for media_type in mcp_codec.available_media_types()}
+    print(f"[/commands] 毎回構築+json: {time_per_call(lambda: json.dumps(dict(commands), ensure_ascii=False).encode('utf-8'), args.iterations):.2f}us"
+          f" / 事前構築: {time_per_call(lambda: bodies[mcp_codec.negotiate_media_type('application/json')], args.iterations):.2f}us")
+
+# ---------------------------------------------------------------------------
+# キーワードゲート
+# ---------------------------------------------------------------------------
+
+# 合成母音のフォルマント（F1, F2）
+KWS_FORMANTS = {"a": (800, 1200), "i": (300, 2300), "u": (350, 1300), "e": (500, 1900), "o": (500, 900)}
+KWS_SAMPLE_RATE = 16000
+
+def synthesize_vowels(sequence: str, rng, stretch: float = 1.0):
+    """母音列の合成音声（話者ごとの基本周波数・長さ・音量をランダムに変える）"""
+    import numpy as np
+
+    f0 = rng.uniform(100, 180)
+    parts = []
+    for vowel in sequence:
+        t = np.arange(int(KWS_SAMPLE_RATE * rng.uniform(0.12, 0.2) * stretch)) / KWS_SAMPLE_RATE
+        f1, f2 = KWS_FORMANTS[vowel]
+        wave_ = np.zeros_like(t)
+        for k in range(1, int(4000 / f0)):
+            amplitude = np.exp(-((k * f0 - f1) / 150) ** 2) + 0.7 * np.exp(-((k * f0 - f2) / 200) ** 2) + 0.02
+            wave_ += amplitude * np.sin(2 * np.pi * k * f0 * t + rng.uniform(0, 2 * np.pi))
+        parts.append(wave_ * np.minimum(1.0, np.minimum(t, t[-1] - t) / 0.02))
+    samples = np.concatenate(parts)
+    return samples / np.abs(samples).max() * rng.uniform(0.2, 0.8)
+
+def bench_kws(args):
+    """合成音声でキーワードゲートの誤受理・誤棄却と削減できるSTT呼び出しを計測"""
+    import numpy as np
+    from keyword_spotter import KeywordSpotter, evaluate
+
+    rng = np.random.default_rng(args.seed)
+
+    def random_sequence(length: int) -> str:
+        while True:
+            sequence = "".join(rng.choice(list(KWS_FORMANTS), length))
+            if args.keyword not in sequence:
+                return sequence
+
+    def segment(sequence: str, command: bool = True):
+        # 無音 → 発話 → （コマンド部分） に雑音を重ねた区間
+        parts = [np.zeros(int(KWS_SAMPLE_RATE * rng.uniform(0.05, 0.3))), synthesize_vowels(sequence, rng, rng.uniform(0.8, 1.25))]
+        if command:
+            parts.append(synthesize_vowels(random_sequence(5), rng))
+        samples = np.concatenate(parts)
+        return (samples + rng.normal(0, args.noise, len(samples))).astype(np.float32)
+
+    def cough():
+        t = np.arange(int(KWS_SAMPLE_RATE * rng.uniform(0.2, 0.5))) / KWS_SAMPLE_RATE
+        return (rng.normal(0, 0.5, len(t)) * np.exp(-t * 12)).astype(np.float32)
+
+    spotter = KeywordSpotter.enroll([segment(args.keyword, command=False) for _ in range(args.enroll)], KWS_SAMPLE_RATE)
+    positives = [segment(args.keyword) for _ in range(args.segments)]
+    negatives = [segment(random_sequence(len(args.keyword))) for _ in range(args.segments)]
+    negatives += [cough() for _ in range(args.segments // 5)]
+
+    result = evaluate(spotter, positives, negatives, KWS_SAMPLE_RATE)
+    print(f"正例 {result['positives']}件 / 負例 {result['negatives']}件  1区間あたり {result['gate_ms_avg']}ms")
+    print(f"{'しきい値':>10} {'誤棄却':>6} {'誤受理':>6} {'STT削減':>7}")
+    base = spotter.threshold
+    for ratio in (0.6, 0.8, 1.0, 1.2, 1.5):
+        threshold = base * ratio
+        false_rejects = sum(1 for score in result["positive_scores"] if score > threshold)
+        false_accepts = sum(1 for score in result["negative_scores"] if score <= threshold)
+        avoided = len(negatives) - false_accepts + false_rejects
+        marker = " ← 登録時のしきい値" if ratio == 1.0 else ""
+        print(f"{threshold:10.4f} {false_rejects:6d} {false_accepts:6d} {avoided:7d}{marker}")
+
+# ---------------------------------------------------------------------------
+# 期限とヘッジ
+# ---------------------------------------------------------------------------
+
+def bench_hedge(args):
+    """裾の重い上流（まれに停滞）を模した段階を直列に呼び、ターン所要時間の分布を比較"""
+    import random
+    from deadline import Deadline, DeadlineExceeded, Hedger, set_deadline
+
+    stages = [("stt", 0.30), ("llm", 0.60), ("mcp", 0.05), ("llm", 0.60), ("tts", 0.30)]
+
+    def upstream(typical: float, rng: random.Random):
+        def call(timeout: float):
+            # 通常はtypical前後、stall_rateの確率で停滞する
+            latency = typical * rng.uniform(0.8, 1.2) * args.scale
+            if rng.random() < args.stall_rate:
+                latency = args.stall * args.scale
+            time.sleep(min(latency, timeout))
+            if latency > timeout:
+                raise TimeoutError("上流がタイムアウトしました")
+        return call
+
+    for label, hedge_keys, budget in (
+        ("期限・ヘッジなし", (), None),
+        ("期限のみ", (), args.budget),
+        ("期限+ヘッジ", None, args.budget)
+    ):
+        rng = random.Random(args.seed)
+        hedger = Hedger(hedge_keys, min_samples=20)
+        latencies = []
+        fallbacks = 0
+        for _ in range(args.turns):
+            set_deadline(Deadline(budget * args.scale) if budget else None)
+            started = time.perf_counter()
+            try:
+                for name, typical in stages:
+                    hedger.call(name, upstream(typical, rng), cap=60.0)
+            except DeadlineExceeded:
+                fallbacks += 1
+            latencies.append(time.perf_counter() - started)
+        set_deadline(None)
+        calls = sum(stats["calls"] for stats in hedger.stats().values())
+        hedged = sum(stats["hedged"] for stats in hedger.stats().values())
+        print(f"{label:12s} p50 {percentile(latencies, 0.5) / args.scale:6.2f}s  p95 {percentile(latencies, 0.95) / args.scale:6.2f}s"
+              f"  p99 {percentile(latencies, 0.99) / args.scale:6.2f}s  定型応答 {fallbacks}件  追加呼び出し {hedged / calls:.1%}")
+
+# ---------------------------------------------------------------------------
+# 再生形式の変換
+# ---------------------------------------------------------------------------
+
+# 変換元の形式（サンプルレート, サンプル幅, チャンネル数）
+PLAYBACK_SOURCES = (("TTS PCM 24kHz/16bit/mono", 24000, 2, 1), ("22.05kHz/8bit/mono", 22050, 1, 1), ("44.1kHz/24bit/stereo", 44100, 3, 2))
+
+def synthesize_pcm(rate: int, sample_width: int, channels: int, seconds: float) -> bytes:
+    """和音のPCMデータ（指定のサンプル幅・チャンネル数）を生成"""
+    import numpy as np
+
+    t = np.arange(int(rate * seconds)) / rate
+    samples = 0.3 * np.sin(2 * np.pi * 220 * t) + 0.2 * np.sin(2 * np.pi * 1760 * t)
+    samples = np.repeat(samples[:, None], channels, axis=1)
+    if sample_width == 1:
+        return (samples * 127 + 128).astype(np.uint8).tobytes()
+    values = (samples * (2 ** (8 * sample_width - 1) - 1)).astype("<i4")
+    if sample_width == 3:
+        return values.view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+    return values.astype(f"<i{sample_width}").tobytes()
+
+def scalar_resample(resampler, samples):
+    """比較用：PolyphaseResampler.processと同じ計算を出力サンプルごとに行う"""
+    import numpy as np
+
+    resampler.input_frames += len(samples)
+    buffer = np.concatenate([resampler.history, samples.astype(np.float32)])
+    last_input = resampler.history_start + len(buffer) - 1
+    end = ((last_input + 1) * resampler.up - 1) // resampler.down + 1
+    output = np.empty((end - resampler.output_index, buffer.shape[1]), dtype=np.float32)
+    for k, index in enumerate(range(resampler.output_index, end)):
+        start = index * resampler.down // resampler.up - (resampler.taps - 1) - resampler.history_start
+        output[k] = np.dot(resampler.phases[index * resampler.down % resampler.up], buffer[start:start + resampler.taps])
+    resampler.output_index = end
+    keep_from = end * resampler.down // resampler.up - (resampler.taps - 1)
+    resampler.history = buffer[keep_from - resampler.history_start:]
+    resampler.history_start = keep_from
+    return output
+
+def simulate_playback(convert, target, block_seconds: float):
+    """変換しながら実時間で再生するデバイスを模して、変換のCPU時間と音切れの回数を数える"""
+    from collections import deque
+
+    blocks = deque()
+    done = threading.Event()
+    cpu = [0.0]
+
+    def produce():
+        started = time.thread_time()
+        for block in convert(target):
+            blocks.append(block)
+        cpu[0] = time.thread_time() - started
+        done.set()
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+    # デバイスは1ブロック分が届いてから一定間隔でblock_seconds分ずつ取り出す（OutputStreamと同じ）
+    frames_per_block = int(target.samplerate * block_seconds)
+    available = 0
+    while available < frames_per_block and not done.is_set():
+        while blocks:
+            available += len(blocks.popleft())
+        time.sleep(0.001)
+    underruns = 0
+    next_tick = time.perf_counter()
+    while True:
+        while blocks:
+            available += len(blocks.popleft())
+        if available >= frames_per_block:
+            available -= frames_per_block
+        elif done.is_set() and not blocks:
+            break
+        else:
+            underruns += 1
+            available = 0
+        next_tick += block_seconds
+        time.sleep(max(0.0, next_tick - time.perf_counter()))
+    producer.join()
+    return cpu[0], underruns
+
+def bench_playback(args):
+    """TTS音声をデバイスの形式に変換するCPU時間（音声1秒あたり）と、実時間再生での音切れの回数を計測"""
+    from audio_format import PlaybackConverter, PlaybackFormat, PolyphaseResampler
+
+    target = PlaybackFormat(args.rate, args.channels, args.dtype)
+    print(f"出力形式: {args.rate}Hz / {args.channels}ch / {args.dtype}  ブロック {args.block * 1000:.0f}ms  音声 {args.seconds}秒")
+    print(f"{'変換元':28s} {'方式':10s} {'CPU ms/音声1秒':>14s} {'音切れ':>6s}")
+    for label, rate, sample_width, channels in PLAYBACK_SOURCES:
+        pcm = synthesize_pcm(rate, sample_width, channels, args.seconds)
+        block_bytes = int(rate * args.block) * sample_width * channels
+        for method in ("ベクトル化", "サンプルごと"):
+            def convert(playback_format):
+                converter = PlaybackConverter(rate, sample_width, channels, playback_format, args.taps)
+                if method == "サンプルごと" and converter.resampler is not None:
+                    resampler: PolyphaseResampler = converter.resampler
+                    resampler.process = lambda samples, resampler=resampler: scalar_resample(resampler, samples)
+                for offset in range(0, len(pcm), block_bytes):
+                    yield converter.convert(pcm[offset:offset + block_bytes])
+                yield converter.flush()
+
+            cpu, underruns = simulate_playback(convert, target, args.block)
+            print(f"{label:28s} {method:10s} {cpu / args.seconds * 1000:14.1f} {underruns:6d}")
+
+def main():
+    parser = argparse.ArgumentParser(description="音声対話AIの性能計測")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    stt = subparsers.add_parser("stt", help="逐次文字起こしの計測")
+    stt.add_argument("--port", type=int, default=9000)
+    stt.add_argument("--chars", type=int, default=24)
+    stt.add_argument("--chunk", type=float, default=1.0)
+    stt.add_argument("--window", type=float, default=3.0)
+    stt.add_argument("--speed", type=float, default=1.0)
+    stt.add_argument("--runs", type=int, default=3)
+    stt.set_defaults(func=bench_stt)
+
+    stt_server = subparsers.add_parser("stt-server", help="代替STTサーバーを起動")
+    stt_server.add_argument("--port", type=int, default=9000)
+    stt_server.set_defaults(func=run_stt_server)
+
+    mcp_load = subparsers.add_parser("mcp-load", help="mcp_serverの負荷試験")
+    mcp_load.add_argument("--url", default="http://localhost:8000")
+    mcp_load.add_argument("--path", default="/time")
+    mcp_load.add_argument("--api-key", default="your-local-api-key")
+    mcp_load.add_argument("--concurrency", type=int, default=16)
+    mcp_load.add_argument("--requests", type=int, default=2000)
+    mcp_load.set_defaults(func=bench_mcp_load)
+
+    workers = subparsers.add_parser("workers", help="ワーカー数ごとのスループットの計測（mcp_serverを起動して計測）")
+    workers.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    workers.add_argument("--port", type=int, default=8765)
+    workers.add_argument("--path", default="/weather/Tokyo")
+    workers.add_argument("--api-key", default=os.getenv("MCP_API_KEY", "your-local-api-key"))
+    workers.add_argument("--concurrency", type=int, default=32)
+    workers.add_argument("--requests", type=int, default=4000)
+    workers.set_defaults(func=bench_workers)
+
+    logging_bench = subparsers.add_parser("logging", help="リクエスト処理中のログ出力コストの計測")
+    logging_bench.add_argument("--requests", type=int, default=20000)
+    logging_bench.set_defaults(func=bench_logging)
+
+    serialization = subparsers.add_parser("serialization", help="MCP応答のシリアライズ方式の比較")
+    serialization.add_argument("--iterations", type=int, default=20000)
+    serialization.set_defaults(func=bench_serialization)
+
+    kws = subparsers.add_parser("kws", help="キーワードゲートの誤受理・誤棄却の計測（合成音声）")
+    kws.add_argument("--keyword", default="aiu", help="キーワードとする母音列")
+    kws.add_argument("--enroll", type=int, default=4)
+    kws.add_argument("--segments", type=int, default=100)
+    kws.add_argument("--noise", type=float, default=0.02)
+    kws.add_argument("--seed", type=int, default=0)
+    kws.set_defaults(func=bench_kws)
+
+    hedge = subparsers.add_parser("hedge", help="期限とヘッジによるターン所要時間の裾の比較（模擬上流）")
+    hedge.add_argument("--turns", type=int, default=200)
+    hedge.add_argument("--stall-rate", type=float, default=0.02, help="各呼び出しが停滞する確率")
+    hedge.add_argument("--stall", type=float, default=8.0, help="停滞時の所要時間（秒）")
+    hedge.add_argument("--budget", type=float, default=6.0, help="ターンの期限（秒）")
+    hedge.add_argument("--scale", type=float, default=0.02, help="実時間への縮尺（0.02なら1/50の時間で実行）")
+    hedge.add_argument("--seed", type=int, default=0)
+    hedge.set_defaults(func=bench_hedge)
+
+    playback = subparsers.add_parser("playback", help="再生形式の変換のCPU時間と音切れの計測")
+    playback.add_argument("--rate", type=int, default=48000, help="出力デバイスのサンプルレート")
+    playback.add_argument("--channels", type=int, default=2)
+    playback.add_argument("--dtype", default="float32", choices=("float32", "int32", "int16"))
+    playback.add_argument("--block", type=float, default=0.05, help="ブロック長（秒）")
+    playback.add_argument("--taps", type=int, default=24, help="リサンプラーの位相あたりのタップ数")
+    playback.add_argument("--seconds", type=float, default=3.0, help="再生する音声の長さ（秒）")
+    playback.set_defaults(func=bench_playback)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,451 @@
+"""日本の市区町村の索引（漢字・かな・ローマ字からOpenWeatherMapの都市IDを引く）
+
+索引はキーをバイト順に並べた配列として1ファイルに詰めて保存し、mmapで読み込む。
+全市区町村の索引は次のコマンドで作成する:
+
+    python city_index.py build --owm city.list.json.gz --municipalities municipalities.csv -o data/jp_cities.idx
+
+--owm はOpenWeatherMapの都市一覧（http://bulk.openweathermap.org/sample/city.list.json.gz）、
+--municipalities は総務省の全国地方公共団体コードをCSVにしたもの
+（団体コード, 都道府県名（漢字）, 市区町村名（漢字）, 都道府県名（カナ）, 市区町村名（カナ））。
+同名の市区町村（府中市・伊達市など）は、OWMの都市の座標がどの都道府県庁に近いかで都市IDを選び、
+名前だけでは1つに決めずに都道府県名付きで指定してもらう。
+索引ファイルはリポジトリに含めていない（元データの再配布を避けるため）。作成していない場合は
+SEED_CITIESの主要都市だけの索引を使い、それ以外の都市名はOWMの都市名検索に任せる。
+"""
+import argparse
+import csv
+import gzip
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import unicodedata
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+MAGIC = b"JPCI"
+VERSION = 1
+HEADER = struct.Struct("<4sIIIII")
+RECORD = struct.Struct("<9I")
+
+# 市区町村名の末尾（索引には末尾を除いた形も登録する）
+KANJI_SUFFIXES = ("市", "区", "町", "村")
+KANA_SUFFIXES = ("し", "く", "まち", "ちょう", "むら", "そん")
+ROMAJI_SUFFIXES = ("shi", "ku", "machi", "cho", "mura", "son")
+
+DEFAULT_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "jp_cities.idx")
+
+# 索引ファイルがない場合に使う主要都市（漢字, かな, ローマ字, OWMの都市ID, 都道府県）
+SEED_CITIES = [
+    ("東京", "とうきょう", "Tokyo", 1850147, "東京都"),
+    ("大阪", "おおさか", "Osaka", 1853909, "大阪府"),
+    ("京都", "きょうと", "Kyoto", 1857910, "京都府"),
+    ("名古屋", "なごや", "Nagoya", 1856057, "愛知県"),
+    ("横浜", "よこはま", "Yokohama", 1848354, "神奈川県"),
+    ("神戸", "こうべ", "Kobe", 1859171, "兵庫県"),
+    ("福岡", "ふくおか", "Fukuoka", 1863967, "福岡県"),
+    ("札幌", "さっぽろ", "Sapporo", 2128295, "北海道"),
+    ("仙台", "せんだい", "Sendai", 2111149, "宮城県"),
+    ("広島", "ひろしま", "Hiroshima", 1862415, "広島県"),
+    ("那覇", "なは", "Naha", 1856035, "沖縄県")
+]
+
+# 都道府県庁のおおよその位置（緯度, 経度）。OWMの同名の都市から、市区町村の都道府県にあるものを選ぶのに使う
+PREFECTURE_COORDS = {
+    "北海道": (43.064, 141.347), "青森県": (40.824, 140.740), "岩手県": (39.704, 141.153),
+    "宮城県": (38.269, 140.872), "秋田県": (39.719, 140.102), "山形県": (38.240, 140.364),
+    "福島県": (37.750, 140.468), "茨城県": (36.342, 140.447), "栃木県": (36.566, 139.884),
+    "群馬県": (36.391, 139.061), "埼玉県": (35.857, 139.649), "千葉県": (35.605, 140.123),
+    "東京都": (35.690, 139.692), "神奈川県": (35.448, 139.643), "新潟県": (37.902, 139.023),
+    "富山県": (36.695, 137.211), "石川県": (36.594, 136.626), "福井県": (36.065, 136.222),
+    "山梨県": (35.664, 138.568), "長野県": (36.651, 138.181), "岐阜県": (35.391, 136.722),
+    "静岡県": (34.977, 138.383), "愛知県": (35.180, 136.907), "三重県": (34.730, 136.509),
+    "滋賀県": (35.004, 135.869), "京都府": (35.021, 135.756), "大阪府": (34.686, 135.520),
+    "兵庫県": (34.691, 135.183), "奈良県": (34.685, 135.833), "和歌山県": (34.226, 135.168),
+    "鳥取県": (35.504, 134.238), "島根県": (35.472, 133.051), "岡山県": (34.662, 133.935),
+    "広島県": (34.397, 132.460), "山口県": (34.186, 131.471), "徳島県": (34.066, 134.559),
+    "香川県": (34.340, 134.043), "愛媛県": (33.842, 132.766), "高知県": (33.560, 133.531),
+    "福岡県": (33.607, 130.418), "佐賀県": (33.249, 130.299), "長崎県": (32.745, 129.874),
+    "熊本県": (32.790, 130.742), "大分県": (33.238, 131.613), "宮崎県": (31.911, 131.424),
+    "鹿児島県": (31.560, 130.558), "沖縄県": (26.212, 127.681)
+}
+# 都道府県庁からこの距離（km）以内なら、他の都道府県庁の方が近くても同じ都道府県の都市とみなす
+PREFECTURE_MATCH_KM = 150.0
+
+# 都市名以外で都市を指す呼び方（別名, 対象の漢字名）
+SEED_ALIASES = [
+    ("沖縄", "那覇"),
+    ("おきなわ", "那覇"),
+    ("okinawa", "那覇")
+]
+
+class CityRecord(NamedTuple):
+    """索引の1都市分"""
+    owm_id: int
+    name: str
+    kana: str
+    romaji: str
+    prefecture: str
+
+def normalize_key(text: str) -> str:
+    """検索キーの正規化（全角半角・大小文字・カタカナを統一し、記号とアクセント記号を除く。濁点・半濁点は残す）"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    chars = []
+    for char in unicodedata.normalize("NFKD", text):
+        if unicodedata.combining(char):
+            # アクセント記号は除き、かなの濁点・半濁点は残す（NFCで元の文字に戻る）
+            if char in "\u3099\u309a":
+                chars.append(char)
+            continue
+        code = ord(char)
+        if 0x30A1 <= code <= 0x30F6:
+            # カタカナをひらがなに
+            char = chr(code - 0x60)
+        if char.isalnum() or char in "ー々〆ヶ":
+            chars.append(char)
+    return unicodedata.normalize("NFC", "".join(chars))
+
+def strip_suffix(key: str) -> str:
+    """市区町村の末尾を除いた形"""
+    for suffix in KANJI_SUFFIXES + KANA_SUFFIXES + ROMAJI_SUFFIXES:
+        if key.endswith(suffix) and len(key) > len(suffix) + 1:
+            return key[:-len(suffix)]
+    return key
+
+def fold_romaji(key: str) -> str:
+    """ローマ字の表記ゆれをそろえる（toukyou・ooitaのような長音を1文字に、b・p・mの前のmをnに）"""
+    key = re.sub(r"([aiueo])\1+", r"\1", key).replace("ou", "o")
+    return re.sub(r"m(?=[bpm])", "n", key)
+
+def record_keys(record: CityRecord) -> Iterable[str]:
+    """1都市分の検索キー（漢字・かな・ローマ字と、それぞれの末尾を除いた形。ローマ字は長音をそろえた形も）"""
+    romaji = normalize_key(record.romaji)
+    for key in (normalize_key(record.name), normalize_key(record.kana), romaji, fold_romaji(romaji), normalize_key(record.prefecture + record.name)):
+        if key:
+            yield key
+            yield strip_suffix(key)
+
+def bounded_levenshtein(a: str, b: str, max_distance: int) -> int:
+    """編集距離（max_distanceを超えたら打ち切ってmax_distance+1を返す）"""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+def pack_index(records: List[CityRecord], aliases: Iterable[Tuple[str, int]] = ()) -> bytes:
+    """都市の一覧を索引ファイルの形式に詰める"""
+    strings = bytearray()
+
+    def add_string(value: str) -> Tuple[int, int]:
+        data = value.encode("utf-8")
+        offset = len(strings)
+        strings.extend(data)
+        return offset, len(data)
+
+    packed_records = bytearray()
+    for record in records:
+        fields = [record.owm_id]
+        for value in (record.name, record.kana, record.romaji, record.prefecture):
+            fields.extend(add_string(value))
+        packed_records.extend(RECORD.pack(*fields))
+
+    # 同名の市区町村はどれか1つを選ばず、同じキーをそれぞれの都市について登録する
+    keys: Dict[bytes, List[int]] = {}
+    for index, record in enumerate(records):
+        for key in record_keys(record):
+            indices = keys.setdefault(key.encode("utf-8"), [])
+            if index not in indices:
+                indices.append(index)
+    # 別名は都市名と重ならない場合だけ登録する
+    for alias, index in aliases:
+        keys.setdefault(normalize_key(alias).encode("utf-8"), [index])
+
+    entries = sorted((key, index) for key, indices in keys.items() for index in indices)
+    key_blob = bytearray()
+    offsets = [0]
+    for key, _ in entries:
+        key_blob.extend(key)
+        offsets.append(len(key_blob))
+
+    return b"".join([
+        HEADER.pack(MAGIC, VERSION, len(entries), len(records), len(key_blob), len(strings)),
+        struct.pack(f"<{len(offsets)}I", *offsets),
+        struct.pack(f"<{len(entries)}I", *(index for _, index in entries)),
+        bytes(packed_records),
+        bytes(key_blob),
+        bytes(strings)
+    ])
+
+class CityIndex:
+    """索引ファイルを読み込み、完全一致・前方一致・あいまい検索を行う"""
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        view = memoryview(buffer)
+        magic, version, key_count, record_count, key_blob_size, string_size = HEADER.unpack_from(view, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("都市索引の形式が不正です")
+        position = HEADER.size
+        self.key_offsets = view[position:position + (key_count + 1) * 4].cast("I")
+        position += (key_count + 1) * 4
+        self.key_records = view[position:position + key_count * 4].cast("I")
+        position += key_count * 4
+        self.records = view[position:position + record_count * RECORD.size]
+        position += record_count * RECORD.size
+        self.key_blob = view[position:position + key_blob_size]
+        position += key_blob_size
+        self.strings = view[position:position + string_size]
+        self.key_count = key_count
+        self.record_count = record_count
+        self.max_key_chars = 0
+        if key_count:
+            self.max_key_chars = max(len(self._key(i).decode("utf-8")) for i in range(key_count))
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_INDEX_PATH) -> "CityIndex":
+        """索引ファイルをmmapで読み込む"""
+        with open(path, "rb") as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @classmethod
+    def seed(cls) -> "CityIndex":
+        """主要都市だけの索引"""
+        records = [CityRecord(owm_id, name, kana, romaji, prefecture) for name, kana, romaji, owm_id, prefecture in SEED_CITIES]
+        positions = {record.name: index for index, record in enumerate(records)}
+        return cls(pack_index(records, [(alias, positions[name]) for alias, name in SEED_ALIASES]))
+
+    @classmethod
+    def load_default(cls) -> "CityIndex":
+        """CITY_INDEX_PATHの索引を読み込む（作成していなければ主要都市だけの索引）"""
+        path = os.getenv("CITY_INDEX_PATH", DEFAULT_INDEX_PATH)
+        if os.path.exists(path):
+            return cls.load(path)
+        return cls.seed()
+
+    def __len__(self) -> int:
+        return self.record_count
+
+    def _key(self, i: int) -> bytes:
+        return bytes(self.key_blob[self.key_offsets[i]:self.key_offsets[i + 1]])
+
+    def _record(self, index: int) -> CityRecord:
+        fields = RECORD.unpack_from(self.records, index * RECORD.size)
+        strings = [
+            bytes(self.strings[offset:offset + length]).decode("utf-8")
+            for offset, length in zip(fields[1::2], fields[2::2])
+        ]
+        return CityRecord(fields[0], *strings)
+
+    def _search(self, key: bytes) -> int:
+        # キー配列上の二分探索（key以上となる最初の位置）
+        low, high = 0, self.key_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _matches(self, encoded: bytes) -> List[int]:
+        # キーが完全一致する都市（同名の市区町村があれば複数）
+        indices = []
+        i = self._search(encoded)
+        while i < self.key_count and self._key(i) == encoded:
+            indices.append(self.key_records[i])
+            i += 1
+        return indices
+
+    def lookup_all(self, query: str) -> List[CityRecord]:
+        """完全一致で検索し、同名の市区町村をすべて返す（末尾の市区町村を除いた形も試す）"""
+        key = normalize_key(query)
+        forms = [key, strip_suffix(key)]
+        if key.isascii():
+            forms += [fold_romaji(key), strip_suffix(fold_romaji(key))]
+        for candidate in dict.fromkeys(forms):
+            indices = self._matches(candidate.encode("utf-8"))
+            if indices:
+                return [self._record(index) for index in indices]
+        return []
+
+    def lookup(self, query: str) -> Optional[CityRecord]:
+        """完全一致で検索（同名の市区町村が複数あればNone）"""
+        records = self.lookup_all(query)
+        return records[0] if len(records) == 1 else None
+
+    def prefix(self, query: str, limit: int = 10) -> List[CityRecord]:
+        """前方一致で検索"""
+        encoded = normalize_key(query).encode("utf-8")
+        if not encoded:
+            return []
+        results: Dict[int, CityRecord] = {}
+        i = self._search(encoded)
+        while i < self.key_count and len(results) < limit and self._key(i).startswith(encoded):
+            index = self.key_records[i]
+            results.setdefault(index, self._record(index))
+            i += 1
+        return list(results.values())
+
+    def fuzzy(self, query: str, max_distance: int = 1, limit: int = 5) -> List[Tuple[CityRecord, int]]:
+        """編集距離による近い候補の検索（先頭1文字が一致するキーの範囲だけを調べる）"""
+        key = normalize_key(query)
+        if not key:
+            return []
+        head = key[0].encode("utf-8")
+        next_head = chr(ord(key[0]) + 1).encode("utf-8")
+        start = self._search(head)
+        end = self._search(next_head)
+        best: Dict[int, int] = {}
+        for i in range(start, end):
+            distance = bounded_levenshtein(key, self._key(i).decode("utf-8"), max_distance)
+            if distance <= max_distance:
+                index = self.key_records[i]
+                best[index] = min(distance, best.get(index, distance))
+        ranked = sorted(best.items(), key=lambda item: item[1])[:limit]
+        return [(self._record(index), distance) for index, distance in ranked]
+
+    def resolve(self, query: str) -> Optional[CityRecord]:
+        """完全一致（末尾の市区町村を除いた形・長音をそろえたローマ字を含む）で1都市に決まる場合だけ都市を返す
+
+        前方一致やあいまい一致は別の都市（福島→福岡など）になり得るので、suggestの候補にだけ使う。
+        同名の市区町村が複数ある場合は、都道府県名付きで指定されるまで決めない。
+        """
+        records = self.lookup_all(query)
+        return records[0] if len(records) == 1 else None
+
+    def suggest(self, query: str, limit: int = 3) -> List[CityRecord]:
+        """解決できなかった場合の「もしかして」の候補（同名の市区町村、前方一致、あいまい一致の順）"""
+        results = dict.fromkeys(self.lookup_all(query))
+        for record in self.prefix(query, limit):
+            results.setdefault(record)
+        for record, _ in self.fuzzy(query, max_distance=2, limit=limit):
+            results.setdefault(record)
+        return list(results)[:limit]
+
+    def find_in_text(self, text: str, min_chars: int = 2) -> List[CityRecord]:
+        """文中に含まれる都市名を最長一致で抜き出す"""
+        normalized = normalize_key(text)
+        found: Dict[int, CityRecord] = {}
+        i = 0
+        while i < len(normalized):
+            for length in range(min(self.max_key_chars, len(normalized) - i), min_chars - 1, -1):
+                indices = self._matches(normalized[i:i + length].encode("utf-8"))
+                if indices:
+                    # 同名の市区町村はどれを指すか分からないので、その部分は読み飛ばす
+                    if len(indices) == 1:
+                        found.setdefault(indices[0], self._record(indices[0]))
+                    i += length
+                    break
+            else:
+                i += 1
+        return list(found.values())
+
+def romaji_key(value: str) -> str:
+    """OWMの都市名と市区町村名のローマ字を突き合わせるためのキー
+
+    OWMはTokyo・Oita・Kōchiのように長音を書かず、pykakasiのヘボン式はtoukyou・ooita・kouchiと書くので、
+    両方の長音をそろえてから比べる。
+    """
+    return strip_suffix(fold_romaji(normalize_key(value.replace("-", ""))))
+
+def distance_km(a: Tuple[float, float], b: Tuple[float, float]) -> float:
+    """2地点（緯度, 経度）間の距離"""
+    lat_a, lon_a, lat_b, lon_b = map(math.radians, (*a, *b))
+    h = math.sin((lat_b - lat_a) / 2) ** 2 + math.cos(lat_a) * math.cos(lat_b) * math.sin((lon_b - lon_a) / 2) ** 2
+    return 2 * 6371.0 * math.asin(math.sqrt(h))
+
+def nearest_prefecture(position: Tuple[float, float]) -> str:
+    """最も近い都道府県庁の都道府県"""
+    return min(PREFECTURE_COORDS, key=lambda prefecture: distance_km(position, PREFECTURE_COORDS[prefecture]))
+
+def match_owm_ids(candidates: List[Tuple[int, Tuple[float, float]]], prefectures: Iterable[str]) -> Dict[str, int]:
+    """同じローマ字のOWMの都市（都市ID, 位置）を、同じ読みの市区町村がある都道府県に割り当てる
+
+    OWMの都市はそれらの都道府県のうち県庁が最も近いものに割り当て、1つの都道府県に複数あれば最も近いものを使う。
+    どの都道府県とも離れている都市（別の地方の同名の都市）は割り当てない。
+    """
+    offices = {prefecture: PREFECTURE_COORDS[prefecture] for prefecture in prefectures if prefecture in PREFECTURE_COORDS}
+    best: Dict[str, Tuple[float, int]] = {}
+    for owm_id, position in candidates:
+        if not offices:
+            break
+        owner = min(offices, key=lambda prefecture: distance_km(position, offices[prefecture]))
+        distance = distance_km(position, offices[owner])
+        if distance > PREFECTURE_MATCH_KM and nearest_prefecture(position) != owner:
+            continue
+        if owner not in best or distance < best[owner][0]:
+            best[owner] = (distance, owm_id)
+    return {prefecture: owm_id for prefecture, (_, owm_id) in best.items()}
+
+def build_records(owm_path: str, municipalities_path: str) -> List[CityRecord]:
+    """OWMの都市一覧と市区町村一覧から索引の元データを作成"""
+    import pykakasi
+
+    opener = gzip.open if owm_path.endswith(".gz") else open
+    with opener(owm_path, "rt", encoding="utf-8") as f:
+        owm_cities = [city for city in json.load(f) if city.get("country") == "JP"]
+    # 同じローマ字の都市はすべて残し、同じ読みの市区町村の都道府県で振り分ける
+    owm_candidates: Dict[str, List[Tuple[int, Tuple[float, float]]]] = {}
+    for city in owm_cities:
+        owm_candidates.setdefault(romaji_key(city["name"]), []).append((city["id"], (city["coord"]["lat"], city["coord"]["lon"])))
+
+    kks = pykakasi.Kakasi()
+    rows = []
+    with open(municipalities_path, encoding="utf-8-sig") as f:
+        for row in csv.reader(f):
+            if len(row) < 5 or not row[2].strip():
+                continue
+            prefecture, name, kana = row[1].strip(), row[2].strip(), row[4].strip()
+            hiragana = normalize_key(kana)
+            romaji = "".join(item["hepburn"] for item in kks.convert(hiragana))
+            rows.append((prefecture, name, hiragana, romaji))
+
+    prefectures_by_key: Dict[str, List[str]] = {}
+    for prefecture, _, _, romaji in rows:
+        prefectures_by_key.setdefault(romaji_key(romaji), []).append(prefecture)
+    owm_ids = {
+        key: match_owm_ids(owm_candidates[key], prefectures)
+        for key, prefectures in prefectures_by_key.items() if key in owm_candidates
+    }
+    return [
+        CityRecord(owm_ids.get(romaji_key(romaji), {}).get(prefecture, 0), name, hiragana, romaji.capitalize(), prefecture)
+        for prefecture, name, hiragana, romaji in rows
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description="日本の市区町村索引の作成と確認")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build = subparsers.add_parser("build", help="索引ファイルを作成")
+    build.add_argument("--owm", required=True, help="OpenWeatherMapの都市一覧（city.list.json[.gz]）")
+    build.add_argument("--municipalities", required=True, help="市区町村一覧のCSV")
+    build.add_argument("-o", "--output", default=DEFAULT_INDEX_PATH)
+
+    lookup = subparsers.add_parser("lookup", help="索引で都市を検索")
+    lookup.add_argument("query")
+
+    args = parser.parse_args()
+    if args.command == "build":
+        records = build_records(args.owm, args.municipalities)
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "wb") as f:
+            f.write(pack_index(records))
+        matched = sum(1 for record in records if record.owm_id)
+        print(f"{len(records)}件の市区町村を登録しました（OWMの都市ID付き: {matched}件）: {args.output}")
+    else:
+        index = CityIndex.load_default()
+        record = index.resolve(args.query)
+        print(record if record else f"見つかりません。候補: {index.suggest(args.query)}")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,183 @@
+import inspect
+import json
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+class Parameter(NamedTuple):
+    """コマンドの引数"""
+    name: str  # ツールの引数名（MCPControllerのメソッドの引数名）
+    description: str  # /commandsに載せる説明
+    schema_description: str  # ツールスキーマに載せる説明
+    enum: Optional[Tuple[str, ...]] = None
+    default: Optional[str] = None
+    command_name: Optional[str] = None  # /commandsでの引数名（ツールの引数名と異なる場合）
+
+    @property
+    def catalog_name(self) -> str:
+        return self.command_name or self.name
+
+class Command(NamedTuple):
+    """1コマンド分の定義（/commands・ツールスキーマ・ディスパッチはすべてここから生成する）"""
+    name: str  # /commandsでのコマンド名
+    tool_name: str  # LLMに渡すツール名
+    description: str  # /commandsに載せる説明
+    tool_description: str  # ツールスキーマに載せる説明
+    method: str  # 実行するMCPControllerのメソッド名
+    examples: Tuple[str, ...] = ()
+    parameters: Tuple[Parameter, ...] = ()
+
+class CommandRegistry:
+    """コマンドの登録と、登録内容から生成する各種の表現
+
+    生成結果は初回にまとめて構築し、登録が変わるまで同じオブジェクトを返す
+    （プロンプトはバイト単位で同一になるため、プロバイダ側のプロンプトキャッシュが効く）。
+    """
+
+    def __init__(self):
+        self.commands: Dict[str, Command] = {}
+        self.by_tool_name: Dict[str, Command] = {}
+        self.compiled: Dict[str, Any] = {}
+
+    def register(self, command: Command) -> Command:
+        if command.name in self.commands or command.tool_name in self.by_tool_name:
+            raise ValueError(f"コマンドが重複しています: {command.name}")
+        self.commands[command.name] = command
+        self.by_tool_name[command.tool_name] = command
+        self.compiled.clear()
+        return command
+
+    def __iter__(self) -> Iterator[Command]:
+        return iter(self.commands.values())
+
+    def _compile(self, key: str, build: Callable[[], Any]) -> Any:
+        if key not in self.compiled:
+            self.compiled[key] = build()
+        return self.compiled[key]
+
+    def commands_payload(self) -> Dict[str, Any]:
+        """/commandsの応答"""
+        return self._compile("payload", lambda: {
+            "status": "success",
+            "data": {
+                "commands": {
+                    command.name: {
+                        "description": command.description,
+                        "examples": list(command.examples),
+                        "parameters": {parameter.catalog_name: parameter.description for parameter in command.parameters}
+                    }
+                    for command in self
+                }
+            }
+        })
+
+    def tool_schemas(self) -> List[Dict[str, Any]]:
+        """Tool callingに渡すツール定義"""
+        def schema(command: Command) -> Dict[str, Any]:
+            properties = {}
+            for parameter in command.parameters:
+                prop = {"type": "string", "description": parameter.schema_description}
+                if parameter.enum:
+                    prop["enum"] = list(parameter.enum)
+                properties[parameter.name] = prop
+            parameters = {"type": "object", "properties": properties}
+            if command.parameters:
+                parameters["required"] = [parameter.name for parameter in command.parameters]
+            return {
+                "type": "function",
+                "function": {
+                    "name": command.tool_name,
+                    "description": command.tool_description,
+                    "parameters": parameters
+                }
+            }
+
+        return self._compile("tools", lambda: [schema(command) for command in self])
+
+    def catalog_json(self) -> str:
+        """自然文の解析プロンプトに埋め込むコマンド一覧"""
+        return self._compile("catalog", lambda: json.dumps([
+            {
+                "name": command.name,
+                "description": command.description,
+                "examples": list(command.examples),
+                "parameters": {parameter.catalog_name: parameter.description for parameter in command.parameters}
+            }
+            for command in self
+        ], ensure_ascii=False, indent=2))
+
+    def dispatch_table(self, controller: Any) -> Dict[str, Callable[..., Dict[str, Any]]]:
+        """ツール名から実行関数を引く表（引数は定義された名前だけを渡し、省略時は既定値）
+
+        実行関数にはLLMが決めない呼び出し側の指定（priorityなど）もキーワード引数で渡せる。
+        メソッドが受け付けない指定は渡さない。
+        """
+        def handler(command: Command) -> Callable[..., Dict[str, Any]]:
+            method = getattr(controller, command.method)
+            parameters = command.parameters
+            accepted = inspect.signature(method).parameters
+
+            def call(args: Dict[str, Any], **options: Any) -> Dict[str, Any]:
+                return method(
+                    **{
+                        parameter.name: args.get(parameter.name, parameter.default)
+                        for parameter in parameters
+                        if parameter.name in args or parameter.default is not None
+                    },
+                    **{name: value for name, value in options.items() if name in accepted}
+                )
+            return call
+
+        return {command.tool_name: handler(command) for command in self}
+
+    def command_call(self, name: str, parameters: Dict[str, Any]) -> Optional[Tuple[str, Dict[str, Any]]]:
+        """/commandsの形式のコマンドをツール呼び出しに変換（未登録ならNone）"""
+        command = self.commands.get(name)
+        if command is None:
+            return None
+        return command.tool_name, {
+            parameter.name: parameters[parameter.catalog_name]
+            for parameter in command.parameters
+            if parameter.catalog_name in parameters
+        }
+
+# 利用可能なコマンド（コマンドの追加はここに1件登録するだけでよい）
+COMMANDS = CommandRegistry()
+
+COMMANDS.register(Command(
+    name="weather",
+    tool_name="get_weather",
+    description="天気情報を取得",
+    tool_description="指定された都市の天気情報を取得します",
+    method="get_weather",
+    examples=("東京の天気を教えて", "大阪の天気は？", "天気を教えて"),
+    parameters=(
+        Parameter("city", "都市名（デフォルト: 東京）", "天気を知りたい都市名（例：東京、大阪）", default="東京"),
+    )
+))
+
+COMMANDS.register(Command(
+    name="system",
+    tool_name="get_system_info",
+    description="システム情報を取得",
+    tool_description="システム情報を取得します",
+    method="get_system_info",
+    examples=("CPUの使用率を確認して", "メモリの使用状況を教えて", "ファイルを見せて"),
+    parameters=(
+        Parameter(
+            "info_type",
+            "情報タイプ（cpu, memory, files）",
+            "取得したい情報のタイプ（cpu, memory, files）",
+            enum=("cpu", "memory", "files"),
+            default="cpu",
+            command_name="type"
+        ),
+    )
+))
+
+COMMANDS.register(Command(
+    name="time",
+    tool_name="get_time",
+    description="現在時刻を取得",
+    tool_description="現在の時刻情報を取得します",
+    method="get_time",
+    examples=("時刻を教えて", "今何時？")
+))
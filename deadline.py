@@ -0,0 +1,188 @@
+import contextvars
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple, TypeVar
+
+logger = logging.getLogger('voice_chat_ai.deadline')
+
+T = TypeVar("T")
+
+class DeadlineExceeded(Exception):
+    """ターンの期限までに処理が終わらなかった場合のエラー"""
+
+class Deadline:
+    """1ターン分の期限（発話終了から応答開始までの予算）"""
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.started_at = time.monotonic()
+        self.expires_at = self.started_at + budget
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+# 現在のターンの期限（スレッドプールに渡す場合はcontextvars.copy_contextで引き継ぐ）
+current = contextvars.ContextVar("deadline", default=None)
+
+def current_deadline() -> Optional[Deadline]:
+    return current.get()
+
+def set_deadline(deadline: Optional[Deadline]):
+    current.set(deadline)
+
+def stage_timeout(cap: float, reserve: float = 0.0) -> float:
+    """各段階に使える秒数（期限の残りからreserveを除いた値とcapの小さい方）"""
+    deadline = current.get()
+    if deadline is None:
+        return cap
+    remaining = deadline.remaining() - reserve
+    if remaining <= 0:
+        raise DeadlineExceeded(f"ターンの期限（{deadline.budget}秒）を超えました")
+    return min(cap, remaining)
+
+def turn_expired(reserve: float = 0.0) -> bool:
+    """現在のターンの期限を過ぎたか（期限がなければFalse）"""
+    deadline = current.get()
+    return deadline is not None and deadline.remaining() - reserve <= 0
+
+def submit_in_context(executor: ThreadPoolExecutor, func: Callable[..., T], *args: Any) -> "Future[T]":
+    """現在の期限を引き継いでスレッドプールで実行"""
+    return executor.submit(contextvars.copy_context().run, func, *args)
+
+class LatencyTracker:
+    """直近の所要時間からパーセンタイルを求める"""
+    def __init__(self, window: int = 200):
+        self.samples = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self.samples)
+
+    def percentile(self, ratio: float) -> Optional[float]:
+        with self.lock:
+            if not self.samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * ratio))]
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "count": len(self.samples),
+            **{
+                name: round(value * 1000, 1) if value is not None else None
+                for name, value in (
+                    ("p50_ms", self.percentile(0.5)),
+                    ("p95_ms", self.percentile(0.95)),
+                    ("p99_ms", self.percentile(0.99))
+                )
+            }
+        }
+
+class Hedger:
+    """期限内での呼び出しと、冪等な呼び出しのヘッジ
+
+    対象のキーでは、呼び出しが直近のp95を超えても終わらなければ同じ呼び出しをもう1つ発行し、
+    先に成功した方の結果を使う。funcには使える秒数が渡される。
+    """
+
+    def __init__(self, hedge_keys: Optional[Iterable[str]] = None, min_samples: int = 20, max_workers: int = 8):
+        # hedge_keysがNoneならすべてのキーをヘッジする
+        self.hedge_keys = None if hedge_keys is None else set(hedge_keys)
+        self.min_samples = min_samples
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+        self.trackers: Dict[str, LatencyTracker] = {}
+        self.counters: Dict[str, Dict[str, int]] = {}
+        self.lock = threading.Lock()
+
+    def _state(self, key: str) -> Tuple[LatencyTracker, Dict[str, int]]:
+        with self.lock:
+            if key not in self.trackers:
+                self.trackers[key] = LatencyTracker()
+                self.counters[key] = {"calls": 0, "hedged": 0, "hedge_wins": 0, "deadline_exceeded": 0}
+            return self.trackers[key], self.counters[key]
+
+    def _count(self, counters: Dict[str, int], name: str):
+        with self.lock:
+            counters[name] += 1
+
+    def hedge_delay(self, key: str) -> Optional[float]:
+        """ヘッジを発行するまでの待ち時間（対象外、または計測が足りなければNone）"""
+        if self.hedge_keys is not None and key not in self.hedge_keys:
+            return None
+        tracker, _ = self._state(key)
+        if len(tracker) < self.min_samples:
+            return None
+        return tracker.percentile(0.95)
+
+    def call(self, key: str, func: Callable[[float], T], cap: float, reserve: float = 0.0) -> T:
+        """期限内でfuncを実行（必要ならヘッジ）"""
+        tracker, counters = self._state(key)
+        self._count(counters, "calls")
+        try:
+            timeout = stage_timeout(cap, reserve)
+        except DeadlineExceeded:
+            self._count(counters, "deadline_exceeded")
+            raise
+        expires_at = time.monotonic() + timeout
+        delay = self.hedge_delay(key)
+
+        if delay is None or delay >= timeout:
+            started_at = time.monotonic()
+            try:
+                result = func(timeout)
+            except Exception as e:
+                if turn_expired(reserve):
+                    self._count(counters, "deadline_exceeded")
+                    raise DeadlineExceeded(f"{key}が期限内に終わりませんでした") from e
+                raise
+            tracker.record(time.monotonic() - started_at)
+            return result
+
+        primary = submit_in_context(self.executor, self._attempt, func, timeout)
+        attempts = {primary}
+        done, _ = wait(attempts, timeout=delay)
+        if not done and expires_at - time.monotonic() > 0:
+            logger.debug(f"ヘッジを発行: {key}（{delay * 1000:.0f}ms経過）")
+            self._count(counters, "hedged")
+            attempts.add(submit_in_context(self.executor, self._attempt, func, expires_at - time.monotonic()))
+
+        error: Optional[BaseException] = None
+        while attempts:
+            done, attempts = wait(attempts, timeout=max(0.0, expires_at - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    latency, result = future.result()
+                    tracker.record(latency)
+                    if future is not primary:
+                        self._count(counters, "hedge_wins")
+                    return result
+                error = future.exception()
+
+        if turn_expired(reserve):
+            self._count(counters, "deadline_exceeded")
+            raise DeadlineExceeded(f"{key}が期限内に終わりませんでした")
+        if error is not None:
+            raise error
+        raise TimeoutError(f"{key}が{timeout:.1f}秒以内に終わりませんでした")
+
+    def _attempt(self, func: Callable[[float], T], timeout: float) -> Tuple[float, T]:
+        started_at = time.monotonic()
+        result = func(timeout)
+        return time.monotonic() - started_at, result
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """キーごとの呼び出し数・ヘッジ数と所要時間"""
+        with self.lock:
+            keys = list(self.trackers)
+        return {key: {**self.counters[key], **self.trackers[key].summary()} for key in keys}
@@ -0,0 +1,179 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# 並び順の指定（先頭に"-"を付けると降順）
+SORT_KEYS = ("name", "size", "mtime", "none")
+
+class FileListError(ValueError):
+    """ファイル一覧の取得条件が不正な場合のエラー"""
+    def __init__(self, message: str, code: str):
+        super().__init__(message)
+        self.code = code
+
+class DirectoryListing:
+    """1ディレクトリ分のキャッシュ（ディレクトリのmtimeが変わったら破棄）"""
+    def __init__(self, mtime_ns: int, entries: List[Tuple[str, bool]]):
+        self.mtime_ns = mtime_ns
+        self.entries = entries
+        self.stats: Optional[Dict[str, Tuple[int, float]]] = None
+        self.stats_loaded_at = 0.0
+        self.orders: Dict[str, List[Tuple[str, bool]]] = {}
+
+class DirectoryLister:
+    """os.scandirによるファイル一覧（ページング・メタデータ・mtimeで無効化するキャッシュ付き）"""
+
+    def __init__(self, root: str, default_limit: int = 100, max_limit: int = 1000, cache_size: int = 32, stats_ttl: float = 5.0):
+        self.root = os.path.realpath(root)
+        self.default_limit = default_limit
+        self.max_limit = max_limit
+        self.cache_size = cache_size
+        self.stats_ttl = stats_ttl
+        self.cache: "OrderedDict[str, DirectoryListing]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def resolve(self, path: str = "") -> str:
+        """ルート配下の実パスに変換（ルート外は拒否）"""
+        target = os.path.realpath(os.path.join(self.root, path.lstrip("/")))
+        if os.path.commonpath([self.root, target]) != self.root:
+            raise FileListError(f"ルートディレクトリ外は参照できません: {path}", "INVALID_PATH")
+        if not os.path.isdir(target):
+            raise FileListError(f"ディレクトリが見つかりません: {path}", "DIRECTORY_NOT_FOUND")
+        return target
+
+    def list(
+        self,
+        path: str = "",
+        sort: str = "name",
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
+        metadata: bool = False
+    ) -> Dict[str, Any]:
+        """1ページ分のファイル一覧を取得"""
+        target = self.resolve(path)
+        sort_key, descending = self._parse_sort(sort)
+        limit = self._parse_limit(limit)
+        offset = self._parse_cursor(cursor)
+
+        listing = self._get_listing(target)
+        if metadata or sort_key in ("size", "mtime"):
+            self._load_stats(target, listing)
+        ordered = self._ordered(listing, sort_key, descending)
+
+        page = ordered[offset:offset + limit]
+        next_offset = offset + len(page)
+        return {
+            "path": os.path.relpath(target, self.root),
+            "sort": sort,
+            "total": len(ordered),
+            "entries": [self._entry(name, is_dir, listing.stats if metadata else None) for name, is_dir in page],
+            "next_cursor": str(next_offset) if next_offset < len(ordered) else None
+        }
+
+    def stream(self, path: str = "", sort: str = "none", metadata: bool = False) -> Iterator[Dict[str, Any]]:
+        """巨大なディレクトリ向けに1件ずつ返す（sort=noneならメモリに全件を保持しない）"""
+        target = self.resolve(path)
+        sort_key, descending = self._parse_sort(sort)
+        if sort_key == "none":
+            with os.scandir(target) as it:
+                for entry in it:
+                    item = {"name": entry.name, "is_dir": entry.is_dir(follow_symlinks=False)}
+                    if metadata:
+                        stat = entry.stat(follow_symlinks=False)
+                        item["size"] = stat.st_size
+                        item["mtime"] = stat.st_mtime
+                    yield item
+            return
+
+        listing = self._get_listing(target)
+        if metadata or sort_key in ("size", "mtime"):
+            self._load_stats(target, listing)
+        for name, is_dir in self._ordered(listing, sort_key, descending):
+            yield self._entry(name, is_dir, listing.stats if metadata else None)
+
+    def _get_listing(self, target: str) -> DirectoryListing:
+        mtime_ns = os.stat(target).st_mtime_ns
+        with self.lock:
+            listing = self.cache.get(target)
+            if listing is not None and listing.mtime_ns == mtime_ns:
+                self.cache.move_to_end(target)
+                return listing
+
+        with os.scandir(target) as it:
+            entries = [(entry.name, entry.is_dir(follow_symlinks=False)) for entry in it]
+        listing = DirectoryListing(mtime_ns, entries)
+        with self.lock:
+            self.cache[target] = listing
+            self.cache.move_to_end(target)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return listing
+
+    def _load_stats(self, target: str, listing: DirectoryListing):
+        # サイズや更新日時は必要になった時点で取得する
+        # （ファイル内容の変更ではディレクトリのmtimeが変わらないため、stats_ttl秒ごとに取り直す）
+        if listing.stats is not None and time.monotonic() - listing.stats_loaded_at < self.stats_ttl:
+            return
+        stats = {}
+        with os.scandir(target) as it:
+            for entry in it:
+                try:
+                    stat = entry.stat(follow_symlinks=False)
+                    stats[entry.name] = (stat.st_size, stat.st_mtime)
+                except OSError:
+                    stats[entry.name] = (0, 0.0)
+        listing.stats = stats
+        listing.stats_loaded_at = time.monotonic()
+        for order_key in [key for key in listing.orders if key.lstrip("-") in ("size", "mtime")]:
+            del listing.orders[order_key]
+
+    def _ordered(self, listing: DirectoryListing, sort_key: str, descending: bool) -> List[Tuple[str, bool]]:
+        order_key = f"{'-' if descending else ''}{sort_key}"
+        ordered = listing.orders.get(order_key)
+        if ordered is not None:
+            return ordered
+        if sort_key == "none":
+            ordered = listing.entries
+        elif sort_key == "name":
+            ordered = sorted(listing.entries, key=lambda e: e[0].casefold(), reverse=descending)
+        else:
+            index = 0 if sort_key == "size" else 1
+            stats = listing.stats or {}
+            ordered = sorted(listing.entries, key=lambda e: stats.get(e[0], (0, 0.0))[index], reverse=descending)
+        listing.orders[order_key] = ordered
+        return ordered
+
+    def _entry(self, name: str, is_dir: bool, stats: Optional[Dict[str, Tuple[int, float]]]) -> Dict[str, Any]:
+        item = {"name": name, "is_dir": is_dir}
+        if stats is not None:
+            size, mtime = stats.get(name, (0, 0.0))
+            item["size"] = size
+            item["mtime"] = mtime
+        return item
+
+    def _parse_sort(self, sort: str) -> Tuple[str, bool]:
+        descending = sort.startswith("-")
+        sort_key = sort.lstrip("-")
+        if sort_key not in SORT_KEYS:
+            raise FileListError(f"不明な並び順: {sort}（{', '.join(SORT_KEYS)}）", "INVALID_SORT")
+        return sort_key, descending
+
+    def _parse_limit(self, limit: Optional[int]) -> int:
+        if limit is None:
+            return self.default_limit
+        if limit <= 0:
+            raise FileListError(f"ページサイズは1以上を指定してください: {limit}", "INVALID_LIMIT")
+        return min(limit, self.max_limit)
+
+    def _parse_cursor(self, cursor: Optional[str]) -> int:
+        if not cursor:
+            return 0
+        try:
+            offset = int(cursor)
+        except ValueError:
+            raise FileListError(f"不正なカーソル: {cursor}", "INVALID_CURSOR")
+        if offset < 0:
+            raise FileListError(f"不正なカーソル: {cursor}", "INVALID_CURSOR")
+        return offset
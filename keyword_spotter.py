@@ -0,0 +1,304 @@
+import argparse
+import functools
+import sys
+import threading
+import time
+import wave
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from audio_format import PolyphaseResampler
+
+# 特徴量の設定（25msの窓を10msずつずらしたMFCC）
+FRAME_SECONDS = 0.025
+HOP_SECONDS = 0.01
+N_MELS = 26
+N_MFCC = 13
+
+def pcm_to_float(frames: bytes, sample_width: int = 2) -> np.ndarray:
+    """PCMデータを-1.0〜1.0のfloat配列に変換"""
+    if sample_width == 2:
+        return np.frombuffer(frames, dtype="<i2").astype(np.float32) / 32768.0
+    if sample_width == 4:
+        return np.frombuffer(frames, dtype="<i4").astype(np.float32) / 2147483648.0
+    if sample_width == 1:
+        return (np.frombuffer(frames, dtype=np.uint8).astype(np.float32) - 128.0) / 128.0
+    raise ValueError(f"未対応のサンプル幅です: {sample_width}")
+
+@functools.lru_cache(maxsize=8)
+def mel_filterbank(sample_rate: int, n_fft: int, n_mels: int = N_MELS) -> np.ndarray:
+    """メルフィルタバンク（n_mels × n_fft/2+1）"""
+    def hz_to_mel(hz):
+        return 2595.0 * np.log10(1.0 + hz / 700.0)
+
+    def mel_to_hz(mel):
+        return 700.0 * (10.0 ** (mel / 2595.0) - 1.0)
+
+    mel_points = np.linspace(hz_to_mel(0.0), hz_to_mel(sample_rate / 2), n_mels + 2)
+    bins = np.floor((n_fft + 1) * mel_to_hz(mel_points) / sample_rate).astype(int)
+    filters = np.zeros((n_mels, n_fft // 2 + 1), dtype=np.float32)
+    for m in range(1, n_mels + 1):
+        left, center, right = bins[m - 1], bins[m], bins[m + 1]
+        if center > left:
+            filters[m - 1, left:center] = (np.arange(left, center) - left) / (center - left)
+        if right > center:
+            filters[m - 1, center:right] = (right - np.arange(center, right)) / (right - center)
+    return filters
+
+@functools.lru_cache(maxsize=2)
+def dct_matrix(n_mels: int = N_MELS, n_mfcc: int = N_MFCC) -> np.ndarray:
+    """メル対数パワーからMFCCへの変換行列（DCT-II）"""
+    n = np.arange(n_mels)
+    return np.cos(np.pi / n_mels * (n + 0.5)[None, :] * np.arange(n_mfcc)[:, None]).astype(np.float32)
+
+def mfcc(samples: np.ndarray, sample_rate: int) -> np.ndarray:
+    """MFCC（フレーム数 × N_MFCC-1、音量に左右されないよう0次の係数は除く）"""
+    frame_length = int(sample_rate * FRAME_SECONDS)
+    hop_length = int(sample_rate * HOP_SECONDS)
+    if len(samples) < frame_length:
+        samples = np.pad(samples, (0, frame_length - len(samples)))
+    # 高域強調
+    samples = np.append(samples[0], samples[1:] - 0.97 * samples[:-1]).astype(np.float32)
+    n_frames = 1 + (len(samples) - frame_length) // hop_length
+    frames = np.lib.stride_tricks.as_strided(
+        samples,
+        shape=(n_frames, frame_length),
+        strides=(samples.strides[0] * hop_length, samples.strides[0])
+    ) * np.hanning(frame_length).astype(np.float32)
+    n_fft = 1 << (frame_length - 1).bit_length()
+    power = np.abs(np.fft.rfft(frames, n_fft)) ** 2 / n_fft
+    log_mel = np.log(power @ mel_filterbank(sample_rate, n_fft).T + 1e-10)
+    return (log_mel @ dct_matrix().T)[:, 1:]
+
+def normalize_frames(features: np.ndarray) -> np.ndarray:
+    """コサイン距離を内積で求めるためにフレームごとに単位長にする"""
+    return features / (np.linalg.norm(features, axis=1, keepdims=True) + 1e-8)
+
+def subsequence_dtw(template: np.ndarray, features: np.ndarray) -> float:
+    """区間中のどこかに含まれるテンプレートとの最小DTW距離（フレーム平均のコサイン距離）
+
+    傾きを1/2〜2に制限した遷移だけを使い、テンプレートの1フレームごとに
+    区間全体をまとめてnumpyで更新する。
+    """
+    cost = 1.0 - template @ features.T
+    inf = np.full(cost.shape[1], np.inf)
+    accumulated = cost[0].copy()
+    two_back = inf
+    for i in range(1, len(cost)):
+        best = inf.copy()
+        # (i-1, j-1) と (i-1, j-2) から
+        best[1:] = accumulated[:-1]
+        best[2:] = np.minimum(best[2:], accumulated[:-2])
+        # (i-2, j-1) から（テンプレート側を2フレーム進める）
+        best[1:] = np.minimum(best[1:], two_back[:-1] + cost[i - 1, 1:])
+        two_back, accumulated = accumulated, cost[i] + best
+    return float(accumulated.min() / len(template))
+
+class GateStats:
+    """キーワードゲートの判定結果の集計"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.segments = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.audited = 0
+        self.false_accepts = 0
+        self.false_rejects = 0
+        self.checked_accepts = 0
+        self.gate_seconds = 0.0
+
+    def record(self, accepted: bool, seconds: float):
+        with self.lock:
+            self.segments += 1
+            self.gate_seconds += seconds
+            if accepted:
+                self.accepted += 1
+            else:
+                self.rejected += 1
+
+    def record_outcome(self, accepted: bool, contains_keyword: bool, audited: bool = False):
+        """文字起こし結果にキーワードが含まれていたかで誤受理・誤棄却を記録"""
+        with self.lock:
+            if audited:
+                self.audited += 1
+                if contains_keyword:
+                    self.false_rejects += 1
+            elif accepted:
+                self.checked_accepts += 1
+                if not contains_keyword:
+                    self.false_accepts += 1
+
+    def summary(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "segments": self.segments,
+                "accepted": self.accepted,
+                "rejected": self.rejected,
+                "stt_calls_avoided": self.rejected - self.audited,
+                "false_accepts": self.false_accepts,
+                "false_accept_rate": round(self.false_accepts / self.checked_accepts, 3) if self.checked_accepts else None,
+                "false_rejects": self.false_rejects,
+                "false_reject_rate": round(self.false_rejects / self.audited, 3) if self.audited else None,
+                "audited_rejections": self.audited,
+                "gate_ms_avg": round(self.gate_seconds / self.segments * 1000, 2) if self.segments else None
+            }
+
+class KeywordSpotter:
+    """登録した発話のテンプレートとのDTW距離によるキーワード検出
+
+    区間の先頭search_seconds秒にいずれかのテンプレートが距離threshold以下で含まれれば受理する。
+    MFCCのメルフィルタはサンプルレートで周波数軸が変わるので、区間は登録時のsample_rateに変換してから比べる。
+    """
+
+    def __init__(self, templates: List[np.ndarray], threshold: float, sample_rate: int, search_seconds: float = 3.0):
+        if not templates:
+            raise ValueError("キーワードのテンプレートがありません")
+        self.templates = [normalize_frames(template) for template in templates]
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.search_seconds = search_seconds
+        self.stats = GateStats()
+
+    @classmethod
+    def enroll(cls, recordings: List[np.ndarray], sample_rate: int, margin: float = 1.25, **kwargs) -> "KeywordSpotter":
+        """キーワードの録音からテンプレートを作成（しきい値は録音同士の距離の最大値にmarginを掛けた値）"""
+        templates = [mfcc(trim_silence(samples, sample_rate), sample_rate) for samples in recordings]
+        distances = [
+            subsequence_dtw(normalize_frames(a), normalize_frames(b))
+            for i, a in enumerate(templates)
+            for j, b in enumerate(templates)
+            if i != j
+        ]
+        threshold = max(distances) * margin if distances else 0.3
+        return cls(templates, threshold, sample_rate, **kwargs)
+
+    @classmethod
+    def load(cls, path: str, threshold: Optional[float] = None, **kwargs) -> "KeywordSpotter":
+        """saveで保存したテンプレートを読み込む（thresholdを指定すると保存値より優先）"""
+        with np.load(path) as data:
+            if "sample_rate" not in data.files:
+                raise ValueError(f"テンプレートに登録時のサンプルレートがありません。enrollで登録し直してください: {path}")
+            templates = [data[name] for name in sorted(data.files) if name.startswith("template_")]
+            saved_threshold = float(data["threshold"])
+            sample_rate = int(data["sample_rate"])
+        return cls(templates, saved_threshold if threshold is None else threshold, sample_rate, **kwargs)
+
+    def save(self, path: str):
+        arrays = {f"template_{i:02d}": template for i, template in enumerate(self.templates)}
+        np.savez(path, threshold=np.float64(self.threshold), sample_rate=np.int64(self.sample_rate), **arrays)
+
+    def score(self, samples: np.ndarray, sample_rate: int) -> float:
+        """区間に対する最も近いテンプレートとの距離（区間は登録時のサンプルレートに変換する）"""
+        samples = resample(samples[:int(sample_rate * self.search_seconds)], sample_rate, self.sample_rate)
+        features = normalize_frames(mfcc(samples, self.sample_rate))
+        return min(subsequence_dtw(template, features) for template in self.templates)
+
+    def accepts(self, frames: bytes, sample_rate: int, sample_width: int = 2) -> bool:
+        """PCMの区間がキーワードを含むか判定して集計"""
+        started = time.perf_counter()
+        accepted = self.score(pcm_to_float(frames, sample_width), sample_rate) <= self.threshold
+        self.stats.record(accepted, time.perf_counter() - started)
+        return accepted
+
+def resample(samples: np.ndarray, source_rate: int, target_rate: int) -> np.ndarray:
+    """モノラルの区間のサンプルレートを変換"""
+    if source_rate == target_rate:
+        return samples
+    resampler = PolyphaseResampler(source_rate, target_rate, 1)
+    column = samples.astype(np.float32, copy=False)[:, None]
+    return np.concatenate([resampler.process(column), resampler.flush()])[:, 0]
+
+def trim_silence(samples: np.ndarray, sample_rate: int, ratio: float = 0.1) -> np.ndarray:
+    """登録用の録音から前後の無音を除く（最大エネルギーに対する比で判定）"""
+    hop = max(1, int(sample_rate * HOP_SECONDS))
+    n_frames = len(samples) // hop
+    if n_frames == 0:
+        return samples
+    energy = np.sqrt(np.mean(samples[:n_frames * hop].reshape(n_frames, hop) ** 2, axis=1))
+    voiced = np.nonzero(energy > energy.max() * ratio)[0]
+    if len(voiced) == 0:
+        return samples
+    return samples[voiced[0] * hop:(voiced[-1] + 1) * hop]
+
+def evaluate(spotter: KeywordSpotter, positives: List[np.ndarray], negatives: List[np.ndarray], sample_rate: int) -> Dict[str, Any]:
+    """正例・負例の区間で誤棄却・誤受理を数える"""
+    started = time.perf_counter()
+    positive_scores = [spotter.score(samples, sample_rate) for samples in positives]
+    negative_scores = [spotter.score(samples, sample_rate) for samples in negatives]
+    elapsed = time.perf_counter() - started
+    false_rejects = sum(1 for score in positive_scores if score > spotter.threshold)
+    false_accepts = sum(1 for score in negative_scores if score <= spotter.threshold)
+    return {
+        "threshold": round(spotter.threshold, 4),
+        "positives": len(positives),
+        "negatives": len(negatives),
+        "false_rejects": false_rejects,
+        "false_accepts": false_accepts,
+        "stt_calls_avoided": len(negatives) - false_accepts + false_rejects,
+        "gate_ms_avg": round(elapsed / max(1, len(positives) + len(negatives)) * 1000, 2),
+        "positive_scores": positive_scores,
+        "negative_scores": negative_scores
+    }
+
+def read_wav(path: str) -> Tuple[np.ndarray, int]:
+    """モノラルのWAVファイルを読み込む"""
+    with wave.open(path, "rb") as wf:
+        if wf.getnchannels() != 1:
+            raise ValueError(f"モノラルのWAVファイルを指定してください: {path}")
+        return pcm_to_float(wf.readframes(wf.getnframes()), wf.getsampwidth()), wf.getframerate()
+
+def record_keyword(count: int) -> Tuple[List[np.ndarray], int]:
+    """マイクからキーワードをcount回録音"""
+    import speech_recognition as sr
+
+    recognizer = sr.Recognizer()
+    recordings = []
+    with sr.Microphone() as source:
+        recognizer.adjust_for_ambient_noise(source)
+        for i in range(count):
+            input(f"[{i + 1}/{count}] Enterを押してからキーワードを話してください")
+            audio = recognizer.listen(source, phrase_time_limit=3)
+            recordings.append(pcm_to_float(audio.get_raw_data(), audio.sample_width))
+        sample_rate = source.SAMPLE_RATE
+    return recordings, sample_rate
+
+def main():
+    parser = argparse.ArgumentParser(description="キーワードゲートのテンプレート登録と評価")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enroll = subparsers.add_parser("enroll", help="キーワードを録音してテンプレートを保存")
+    enroll.add_argument("-o", "--output", default="kws_templates.npz")
+    enroll.add_argument("--count", type=int, default=4)
+    enroll.add_argument("--wav", nargs="*", help="マイクの代わりに使う録音済みのWAVファイル")
+    enroll.add_argument("--margin", type=float, default=1.25)
+
+    evaluate_parser = subparsers.add_parser("evaluate", help="WAVファイルで誤受理・誤棄却を数える")
+    evaluate_parser.add_argument("--templates", default="kws_templates.npz")
+    evaluate_parser.add_argument("--threshold", type=float)
+    evaluate_parser.add_argument("--positive", nargs="+", required=True, help="キーワードを含む区間のWAVファイル")
+    evaluate_parser.add_argument("--negative", nargs="+", required=True, help="キーワードを含まない区間のWAVファイル")
+
+    args = parser.parse_args()
+    if args.command == "enroll":
+        if args.wav:
+            loaded = [read_wav(path) for path in args.wav]
+            # サンプルレートの異なるWAVは最初のファイルに合わせる
+            sample_rate = loaded[0][1]
+            recordings = [resample(samples, rate, sample_rate) for samples, rate in loaded]
+        else:
+            recordings, sample_rate = record_keyword(args.count)
+        spotter = KeywordSpotter.enroll(recordings, sample_rate, margin=args.margin)
+        spotter.save(args.output)
+        print(f"{len(recordings)}件のテンプレートを保存しました（しきい値: {spotter.threshold:.4f}）: {args.output}")
+    else:
+        spotter = KeywordSpotter.load(args.templates, args.threshold)
+        # WAVごとのサンプルレートから登録時のサンプルレートに変換して評価する
+        positives = [resample(*read_wav(path), spotter.sample_rate) for path in args.positive]
+        negatives = [resample(*read_wav(path), spotter.sample_rate) for path in args.negative]
+        result = evaluate(spotter, positives, negatives, spotter.sample_rate)
+        del result["positive_scores"], result["negative_scores"]
+        print(result)
+
+if __name__ == "__main__":
+    sys.exit(main())
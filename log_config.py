@@ -0,0 +1,145 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, Optional
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+class StructuredMessage:
+    """構造化ログイベント（JSONへの変換は書き込みスレッドで遅延実行）"""
+    def __init__(self, event: str, fields: Dict[str, Any]):
+        self.event = event
+        self.fields = fields
+
+    def __str__(self) -> str:
+        return json.dumps({"event": self.event, **self.fields}, ensure_ascii=False, default=str)
+
+def log_event(logger: logging.Logger, level: int, event: str, **fields: Any):
+    """構造化ログイベントを出力"""
+    if logger.isEnabledFor(level):
+        logger.log(level, StructuredMessage(event, fields), extra={"event": event}, stacklevel=2)
+
+class SamplingFilter(logging.Filter):
+    """ホットパスのDEBUGレコードを呼び出し箇所ごとにレート制限してサンプリング"""
+    def __init__(self, rate: float, sample_every: int, max_level: int = logging.DEBUG):
+        super().__init__()
+        self.rate = rate
+        self.sample_every = max(1, sample_every)
+        self.max_level = max_level
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.dropped = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.max_level or self.rate <= 0:
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated_at, overflow = self.buckets.get(key, (self.rate, now, 0))
+            tokens = min(self.rate, tokens + (now - updated_at) * self.rate)
+            if tokens >= 1:
+                self.buckets[key] = (tokens - 1, now, overflow)
+                return True
+            # レート超過分はsample_every件に1件だけ残す
+            overflow += 1
+            self.buckets[key] = (tokens, now, overflow)
+            if overflow % self.sample_every == 0:
+                record.sampled = self.sample_every
+                return True
+            self.dropped += 1
+            return False
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """キューが満杯の場合は待たずに破棄するQueueHandler"""
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 同一プロセス内のキューなので、メッセージの整形は書き込みスレッドに任せる
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def create_file_handler(log_file: str) -> logging.Handler:
+    """ローテーション付きのファイルハンドラーを作成
+
+    LOG_ROTATE_WHENを指定すると時間ベース、未指定ならLOG_MAX_BYTESによるサイズベースでローテーションする。
+    """
+    backup_count = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+    rotate_when = os.getenv('LOG_ROTATE_WHEN', '')
+    if rotate_when:
+        return logging.handlers.TimedRotatingFileHandler(
+            log_file, when=rotate_when, backupCount=backup_count, encoding='utf-8'
+        )
+    return logging.handlers.RotatingFileHandler(
+        log_file, maxBytes=int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024))), backupCount=backup_count, encoding='utf-8'
+    )
+
+def worker_log_file(log_file: str, workers: int) -> str:
+    """複数プロセスで起動する場合のログファイル名（プロセスIDを付けて分ける）
+
+    ローテーションは1つのファイルを複数のプロセスから扱えないため、プロセスごとに別のファイルに書き込む。
+    """
+    if workers <= 1:
+        return log_file
+    base, ext = os.path.splitext(log_file)
+    return f"{base}.{os.getpid()}{ext}"
+
+# 起動中の書き込みスレッド
+log_listener: Optional[logging.handlers.QueueListener] = None
+
+def setup_logging(log_file: str, level: int = logging.INFO, console: bool = True) -> logging.Logger:
+    """キュー経由のバックグラウンド書き込みでルートロガーを設定"""
+    global log_listener
+
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [create_file_handler(log_file)]
+    if console:
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+    root.setLevel(level)
+
+    # DEBUGレコードは呼び出し箇所ごとに毎秒LOG_SAMPLE_RATE件まで、超過分はLOG_SAMPLE_EVERY件に1件だけ残す
+    sampling = SamplingFilter(
+        float(os.getenv('LOG_SAMPLE_RATE', '50')),
+        int(os.getenv('LOG_SAMPLE_EVERY', '100'))
+    )
+    if os.getenv('LOG_QUEUE', '1') == '1':
+        front = NonBlockingQueueHandler(queue.Queue(int(os.getenv('LOG_QUEUE_SIZE', '10000'))))
+        log_listener = logging.handlers.QueueListener(front.queue, *handlers, respect_handler_level=True)
+        log_listener.start()
+        front.addFilter(sampling)
+        root.addHandler(front)
+    else:
+        for handler in handlers:
+            handler.addFilter(sampling)
+            root.addHandler(handler)
+    return root
+
+def shutdown_logging():
+    """キューに残ったログを書き出して書き込みスレッドを停止"""
+    global log_listener
+    if log_listener is not None:
+        log_listener.stop()
+        log_listener = None
+
+atexit.register(shutdown_logging)
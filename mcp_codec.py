@@ -0,0 +1,86 @@
+import json
+from typing import Any, List, Optional
+
+# 高速なシリアライザ（インストールされていなければ標準のjsonを使用）
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+MSGPACK_MEDIA_TYPES = (MSGPACK_MEDIA_TYPE, "application/x-msgpack")
+
+def dumps_json(payload: Any) -> bytes:
+    """JSONバイト列にシリアライズ"""
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def dumps_json_text(payload: Any) -> str:
+    """LLMのプロンプトなどに埋め込むJSON文字列にシリアライズ"""
+    if orjson is not None:
+        return orjson.dumps(payload).decode("utf-8")
+    return json.dumps(payload, ensure_ascii=False)
+
+def loads_json(data: bytes) -> Any:
+    """JSONバイト列をデシリアライズ"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def available_media_types() -> List[str]:
+    """このプロセスで扱えるメディアタイプ"""
+    if msgpack is not None:
+        return [JSON_MEDIA_TYPE, MSGPACK_MEDIA_TYPE]
+    return [JSON_MEDIA_TYPE]
+
+def encode(payload: Any, media_type: str = JSON_MEDIA_TYPE) -> bytes:
+    """メディアタイプに応じてシリアライズ"""
+    if media_type in MSGPACK_MEDIA_TYPES and msgpack is not None:
+        return msgpack.packb(payload, use_bin_type=True)
+    return dumps_json(payload)
+
+def decode(body: bytes, content_type: Optional[str] = None) -> Any:
+    """Content-Typeに応じてデシリアライズ"""
+    media_type = (content_type or JSON_MEDIA_TYPE).split(";")[0].strip().lower()
+    if media_type in MSGPACK_MEDIA_TYPES:
+        if msgpack is None:
+            raise ValueError("MessagePack応答を受信しましたが、msgpackがインストールされていません")
+        return msgpack.unpackb(body, raw=False)
+    return loads_json(body)
+
+def negotiate_media_type(accept: Optional[str]) -> str:
+    """Acceptヘッダーから応答のメディアタイプを決定（既定はJSON）"""
+    if not accept or msgpack is None:
+        return JSON_MEDIA_TYPE
+
+    best_media_type = JSON_MEDIA_TYPE
+    best_quality = -1.0
+    for part in accept.split(","):
+        fields = part.strip().split(";")
+        media_type = fields[0].strip().lower()
+        quality = 1.0
+        for param in fields[1:]:
+            name, _, value = param.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_type in MSGPACK_MEDIA_TYPES:
+            candidate = MSGPACK_MEDIA_TYPE
+        elif media_type in (JSON_MEDIA_TYPE, "application/*", "*/*"):
+            candidate = JSON_MEDIA_TYPE
+        else:
+            continue
+        # 同じ品質値ならJSONを優先する
+        if quality > best_quality or (quality == best_quality and candidate == JSON_MEDIA_TYPE):
+            best_media_type = candidate
+            best_quality = quality
+    return best_media_type if best_quality > 0 else JSON_MEDIA_TYPE
@@ -1,48 +1,79 @@
 import requests
 import json
 import os
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Iterable, Iterator, Optional
+from mcp_codec import JSON_MEDIA_TYPE, MSGPACK_MEDIA_TYPE, available_media_types, decode
+from city_index import CityIndex, CityRecord
+from deadline import DeadlineExceeded, Hedger, stage_timeout
 
 class MCPController:
     def __init__(self):
-        # ローカルサーバーのURLを使用
-        self.base_url = "http://localhost:8000"
+        # ローカルサーバーのURL（サーバーと同じMCP_SERVER_HOST/MCP_SERVER_PORTから組み立てる）
+        host = os.getenv('MCP_SERVER_HOST', 'localhost')
+        if host in ('', '0.0.0.0', '::'):
+            # 全インターフェースで待ち受けている場合は自分自身に接続する
+            host = 'localhost'
+        self.base_url = f"http://{host}:{int(os.getenv('MCP_SERVER_PORT', '8000'))}"
         self.api_key = "your-local-api-key"  # MCPサーバーで設定したものと同じキーを使用
+
+        # ファイル一覧で1回に取得する件数
+        self.files_page_size = int(os.getenv('MCP_FILES_PAGE_SIZE', '100'))
+
+        # 応答形式（msgpackが使える場合はMessagePackを優先し、JSONも受け付ける）
+        if os.getenv('MCP_WIRE_FORMAT', 'msgpack') == 'msgpack' and MSGPACK_MEDIA_TYPE in available_media_types():
+            self.accept = f"{MSGPACK_MEDIA_TYPE}, {JSON_MEDIA_TYPE};q=0.9"
+        else:
+            self.accept = JSON_MEDIA_TYPE
         
-        # 主要都市の日本語-英語マッピング
-        self.city_mapping = {
-            "東京": "Tokyo",
-            "大阪": "Osaka",
-            "京都": "Kyoto",
-            "名古屋": "Nagoya",
-            "横浜": "Yokohama",
-            "神戸": "Kobe",
-            "福岡": "Fukuoka",
-            "札幌": "Sapporo",
-            "仙台": "Sendai",
-            "広島": "Hiroshima",
-            "那覇": "Naha",
-            "沖縄": "Naha"  # 沖縄の場合は那覇を返す
-        }
-        
-    def _make_request(self, method: str, endpoint: str, data: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        # 1リクエストあたりのタイムアウト（ターンの期限があれば残り時間の方が短ければそちらを使う）
+        self.request_timeout = float(os.getenv('MCP_REQUEST_TIMEOUT', '5'))
+        # GETは冪等なので、HEDGE_STAGESにmcpが含まれていれば遅いリクエストをヘッジする
+        hedge_stages = os.getenv('HEDGE_STAGES', 'mcp').split(',')
+        self.hedger = Hedger(None if 'mcp' in hedge_stages else ())
+
+        # 市区町村の索引（漢字・かな・ローマ字からOWMの都市IDを引く）
+        self.city_index = CityIndex.load_default()
+
+    def _make_request(
+        self,
+        method: str,
+        endpoint: str,
+        data: Optional[Dict[str, Any]] = None,
+        params: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
         """APIリクエストを実行"""
         headers = {
             "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
+            "Content-Type": "application/json",
+            "Accept": self.accept
         }
         
         url = f"{self.base_url}{endpoint}"
         
         try:
             if method == "GET":
-                response = requests.get(url, headers=headers)
+                # 所要時間はエンドポイントの種類（weather, system, ...）ごとに記録する
+                response = self.hedger.call(
+                    endpoint.strip("/").split("/")[0],
+                    lambda timeout: requests.get(url, headers=headers, params=params, timeout=timeout),
+                    cap=self.request_timeout
+                )
             elif method == "POST":
-                response = requests.post(url, headers=headers, json=data)
+                # POSTは冪等とは限らないためヘッジしない
+                response = requests.post(url, headers=headers, json=data, timeout=stage_timeout(self.request_timeout))
             
             response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
+            return decode(response.content, response.headers.get("Content-Type"))
+        except DeadlineExceeded as e:
+            print(f"MCPリクエストが期限内に終わりませんでした: {endpoint}")
+            return {
+                "status": "error",
+                "error": {
+                    "message": str(e),
+                    "code": "DEADLINE_EXCEEDED"
+                }
+            }
+        except (requests.exceptions.RequestException, TimeoutError, ValueError) as e:
             print(f"MCPリクエストエラー: {str(e)}")
             return {
                 "status": "error",
@@ -52,16 +83,102 @@ class MCPController:
                 }
             }
 
-    def get_weather(self, city: str = "東京") -> Dict[str, Any]:
-        """天気情報を取得"""
-        # 都市名を英語に変換
-        en_city = self.city_mapping.get(city, "Tokyo")  # デフォルトは東京
-        return self._make_request("GET", f"/weather/{en_city}")
+    def get_weather(self, city: str = "東京", priority: str = "interactive") -> Dict[str, Any]:
+        """天気情報を取得（先読みなどはpriority="background"を指定）"""
+        params = {"priority": priority}
+        record = self.resolve_city(city)
+        if record is None:
+            candidates = self.city_index.lookup_all(city)
+            if len(candidates) > 1:
+                # 同名の市区町村が複数ある場合はどれか1つを選ばず、都道府県名付きで聞き直してもらう
+                choices = [f"{candidate.prefecture}{candidate.name}" for candidate in candidates]
+                return {
+                    "status": "error",
+                    "error": {
+                        "message": f"同名の市区町村が複数あります: {city}（候補: {'、'.join(choices)}）",
+                        "code": "CITY_AMBIGUOUS"
+                    }
+                }
+            # 索引にない都市はサーバー（OWM）の都市名検索に任せる。索引が主要都市だけの場合もここで全国の都市を引ける
+            result = self._make_request("GET", f"/weather/{city}", params=params)
+            if result.get("status") == "error" and result["error"].get("code") == "WEATHER_FETCH_ERROR":
+                # 同名の市区町村を区別できるよう都道府県名を付ける
+                suggestions = [f"{candidate.prefecture}{candidate.name}" for candidate in self.city_index.suggest(city)]
+                if suggestions:
+                    result["error"]["message"] += f"（候補: {'、'.join(suggestions)}）"
+            return result
+        if record.owm_id:
+            params["city_id"] = record.owm_id
+            return self._make_request("GET", f"/weather/{record.name}", params=params)
+        return self._make_request("GET", f"/weather/{record.romaji}", params=params)
+
+    def resolve_city(self, city: str) -> Optional[CityRecord]:
+        """都市名（漢字・かな・ローマ字、末尾の市区町村や長音の表記ゆれを含む）を索引の完全一致で解決"""
+        return self.city_index.resolve(city)
+
+    def get_quota(self) -> Dict[str, Any]:
+        """上流APIの残り枠を取得"""
+        return self._make_request("GET", "/quota")
 
     def get_system_info(self, info_type: str) -> Dict[str, Any]:
         """システム情報を取得"""
+        if info_type == "files":
+            return self.list_files()
         return self._make_request("GET", f"/system/{info_type}")
 
+    def list_files(
+        self,
+        path: str = "",
+        sort: str = "name",
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
+        metadata: bool = False
+    ) -> Dict[str, Any]:
+        """ファイル一覧を1ページ分取得"""
+        params = {
+            "path": path,
+            "sort": sort,
+            "limit": limit or self.files_page_size,
+            "metadata": str(metadata).lower()
+        }
+        if cursor:
+            params["cursor"] = cursor
+        return self._make_request("GET", "/system/files", params=params)
+
+    def subscribe_metrics(self, metrics: Iterable[str] = ("cpu", "memory"), interval: float = 1.0) -> Iterator[Dict[str, Any]]:
+        """CPU・メモリの値を購読し、差分を反映した最新の値を順に返す"""
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Accept": "text/event-stream"
+        }
+        params = {"metrics": ",".join(metrics), "interval": interval}
+        state: Dict[str, Dict[str, Any]] = {}
+
+        # 購読は長時間続くため、接続にだけタイムアウトを設定する
+        with requests.get(
+            f"{self.base_url}/system/subscribe",
+            headers=headers,
+            params=params,
+            stream=True,
+            timeout=(self.request_timeout, None)
+        ) as response:
+            response.raise_for_status()
+            event_type = None
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event:"):
+                    event_type = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    event = decode(line[len("data:"):].strip().encode("utf-8"))
+                    if event_type == "snapshot":
+                        state = {metric: dict(values) for metric, values in event["metrics"].items()}
+                    else:
+                        for metric, values in event["metrics"].items():
+                            state.setdefault(metric, {}).update(values)
+                    yield {
+                        "timestamp": event["timestamp"],
+                        "metrics": {metric: dict(values) for metric, values in state.items()}
+                    }
+
     def get_time(self) -> Dict[str, Any]:
         """現在時刻を取得"""
         return self._make_request("GET", "/time")
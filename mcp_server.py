@@ -1,17 +1,26 @@
-from fastapi import FastAPI, HTTPException, Depends, Security
+from fastapi import FastAPI, HTTPException, Depends, Security, Header, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
 import uvicorn
+import asyncio
 import subprocess
 import os
-from typing import Dict, Any, List, Optional
+import tempfile
+from typing import Dict, Any, AsyncIterator, Iterator, List, Optional
 from datetime import datetime
 from pyowm import OWM
 from pyowm.utils.config import get_default_config
-import json
 from dotenv import load_dotenv
+from log_config import setup_logging, log_event, worker_log_file
+from mcp_codec import available_media_types, dumps_json, encode, negotiate_media_type
+from file_lister import DirectoryLister, FileListError
+from shared_cache import CacheWaitTimeout, SharedCache
+from upstream_scheduler import PRIORITIES, PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, QuotaExhausted, SharedTokenBucket, UpstreamScheduler
+from metrics_stream import METRIC_TYPES, MetricsSampler, parse_cpu_info, parse_memory_info
+from city_index import CityIndex
+from command_registry import COMMANDS
 import sys
-import pykakasi
 import logging
 
 # 環境変数の読み込み
@@ -40,6 +49,14 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Security(security))
         raise HTTPException(status_code=401, detail="Invalid API key")
     return True
 
+# システム情報の取得に使うコマンド
+SYSTEM_COMMANDS = {
+    "cpu": ["top", "-l", "1", "-n", "0"],
+    "memory": ["vm_stat"]
+}
+# システム情報のコマンドのタイムアウト（秒）
+SYSTEM_COMMAND_TIMEOUT = 5.0
+
 class MCPServer:
     def __init__(self):
         # OpenWeatherMap APIの設定
@@ -47,36 +64,110 @@ class MCPServer:
         config_dict['language'] = 'ja'
         self.owm = OWM(os.getenv('OPENWEATHER_API_KEY'), config_dict)
         self.mgr = self.owm.weather_manager()
+        self.owm_timeout = float(config_dict['connection'].get('timeout_secs') or 5)
         
-        # 日本語-ローマ字変換器の初期化
-        self.kks = pykakasi.Kakasi()
-
-        # ロガーの設定
-        logging.basicConfig(
-            level=logging.DEBUG,
-            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-            handlers=[
-                logging.StreamHandler(),
-                logging.FileHandler('mcp_server.log')
-            ]
+        # 市区町村の索引（漢字・かな・ローマ字からOWMの都市IDを引く）
+        self.city_index = CityIndex.load_default()
+
+        # ファイル一覧（MCP_FILES_ROOT配下をos.scandirで列挙）
+        self.file_lister = DirectoryLister(
+            os.getenv('MCP_FILES_ROOT', os.getcwd()),
+            default_limit=int(os.getenv('MCP_FILES_PAGE_SIZE', '100')),
+            max_limit=int(os.getenv('MCP_FILES_MAX_PAGE_SIZE', '1000'))
+        )
+
+        # ワーカープロセス間で共有するキャッシュ（天気情報とシステム情報）
+        self.cache = SharedCache(os.getenv('MCP_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'mcp_server_cache.sqlite3')))
+        self.weather_cache_ttl = float(os.getenv('MCP_WEATHER_CACHE_TTL', '600'))
+        self.metrics_cache_ttl = float(os.getenv('MCP_METRICS_CACHE_TTL', '1'))
+
+        # OpenWeatherMapの呼び出し枠（無料枠は60回/分）をワーカー間で共有して管理
+        calls_per_minute = float(os.getenv('OWM_CALLS_PER_MINUTE', '60'))
+        self.weather_scheduler = UpstreamScheduler(
+            SharedTokenBucket(
+                self.cache.path,
+                "openweathermap",
+                rate_per_second=calls_per_minute / 60,
+                capacity=float(os.getenv('OWM_BURST', '10'))
+            ),
+            max_queue=int(os.getenv('OWM_QUEUE_SIZE', '32')),
+            wait_timeouts={
+                PRIORITY_INTERACTIVE: float(os.getenv('OWM_INTERACTIVE_WAIT', '3')),
+                PRIORITY_BACKGROUND: float(os.getenv('OWM_BACKGROUND_WAIT', '30'))
+            }
         )
+        self.weather_served_stale = 0
+
+        # ロガーの設定（キュー経由でバックグラウンドのスレッドが書き込む）
+        # 複数ワーカーの場合はワーカーごとのファイルに書き込む（例: mcp_server.12345.log）
+        log_file = worker_log_file('mcp_server.log', int(os.getenv('MCP_SERVER_WORKERS', '1')))
+        setup_logging(log_file, level=getattr(logging, os.getenv('MCP_LOG_LEVEL', 'DEBUG').upper(), logging.DEBUG))
         self.logger = logging.getLogger('mcp_server')
 
-    def get_weather(self, city: str = "Tokyo") -> Dict[str, Any]:
-        """指定された都市の天気情報を取得"""
+    def get_weather(self, city: str = "Tokyo", priority: int = PRIORITY_INTERACTIVE, city_id: Optional[int] = None) -> Dict[str, Any]:
+        """指定された都市の天気情報を取得（成功した結果はワーカー間で共有してキャッシュ）"""
+        if city_id is None:
+            # 索引にある都市は都市IDで問い合わせる（表記の違いでキャッシュが分かれないようにする）
+            record = self.city_index.resolve(city)
+            if record is not None and record.owm_id:
+                city, city_id = record.name, record.owm_id
+        key = f"weather:id:{city_id}" if city_id else f"weather:{city.lower()}"
         try:
-            print(f"天気情報の取得を開始: 都市名 = {city}")
+            result = self.cache.get_or_compute(
+                key,
+                self.weather_cache_ttl,
+                lambda: self.weather_scheduler.call(lambda: self.fetch_weather(city, city_id), priority),
+                cacheable=lambda result: result.get("status") == "success",
+                # 他のワーカーが同じ都市を取得中なら、枠待ちと取得にかかる時間まで結果を待つ
+                wait_timeout=self.weather_scheduler.wait_timeouts.get(priority, 0.0) + self.owm_timeout
+            )
+        except CacheWaitTimeout as e:
+            log_event(self.logger, logging.WARNING, "weather.cache.wait_timeout", city=city, error=str(e))
+            result = {
+                "status": "error",
+                "error": {
+                    "message": f"天気情報の取得が混み合っています: {str(e)}",
+                    "code": "UPSTREAM_BUSY"
+                }
+            }
+        except QuotaExhausted as e:
+            log_event(self.logger, logging.WARNING, "weather.quota.exhausted", city=city, error=str(e))
+            result = {
+                "status": "error",
+                "error": {
+                    "message": f"天気情報の取得回数の上限に達しました: {str(e)}",
+                    "code": "RATE_LIMITED"
+                }
+            }
+
+        if result.get("error", {}).get("code") in ("RATE_LIMITED", "UPSTREAM_BUSY"):
+            # 枠を使い切った場合や他のワーカーの取得を待ちきれない場合は最後に取得できた結果を返す
+            stale = self.cache.get_stale(key)
+            if stale is not None:
+                self.weather_served_stale += 1
+                log_event(self.logger, logging.INFO, "weather.serve_stale", city=city)
+                return {**stale, "data": {**stale["data"], "stale": True}}
+        return result
+
+    def fetch_weather(self, city: str, city_id: Optional[int] = None) -> Dict[str, Any]:
+        """OpenWeatherMapから天気情報を取得（都市IDがあればIDで問い合わせる）"""
+        try:
+            log_event(self.logger, logging.DEBUG, "weather.fetch.start", city=city, city_id=city_id)
             
             try:
                 # 天気情報を直接取得
-                weather = self.mgr.weather_at_place(f"{city},JP").weather
-                print(f"天気情報取得成功: {weather}")
+                if city_id:
+                    weather = self.mgr.weather_at_id(city_id).weather
+                else:
+                    weather = self.mgr.weather_at_place(f"{city},JP").weather
                 
                 # 天気情報を整形
                 result = {
                     "status": "success",
                     "data": {
                         "city": city,
+                        "city_id": city_id,
+                        "fetched_at": datetime.now().isoformat(),
                         "weather": {
                             "description": weather.detailed_status,
                             "temperature": {
@@ -90,16 +181,25 @@ class MCPServer:
                         }
                     }
                 }
-                print(f"天気情報の取得成功: {json.dumps(result, ensure_ascii=False)}")
+                log_event(self.logger, logging.DEBUG, "weather.fetch.success", city=city, result=result)
                 return result
                 
             except Exception as api_error:
-                print(f"API呼び出しエラー: {str(api_error)}")
+                log_event(self.logger, logging.WARNING, "weather.api.error", city=city, error=str(api_error))
+                if "429" in str(api_error):
+                    self.weather_scheduler.report_rate_limited()
+                    return {
+                        "status": "error",
+                        "error": {
+                            "message": f"天気情報の取得回数の上限に達しました: {str(api_error)}",
+                            "code": "RATE_LIMITED"
+                        }
+                    }
                 raise ValueError(f"天気情報の取得に失敗しました: {str(api_error)}")
             
         except Exception as e:
             error_msg = f"天気情報の取得に失敗: {str(e)}"
-            print(error_msg)
+            log_event(self.logger, logging.ERROR, "weather.fetch.error", city=city, error=error_msg)
             return {
                 "status": "error",
                 "error": {
@@ -112,7 +212,7 @@ class MCPServer:
         """システム情報を取得"""
         try:
             if info_type == "cpu":
-                cpu_info = subprocess.check_output(["top", "-l", "1", "-n", "0"]).decode()
+                cpu_info = self.read_system_output("cpu")
                 return {
                     "status": "success",
                     "data": {
@@ -121,7 +221,7 @@ class MCPServer:
                     }
                 }
             elif info_type == "memory":
-                memory_info = subprocess.check_output(["vm_stat"]).decode()
+                memory_info = self.read_system_output("memory")
                 return {
                     "status": "success",
                     "data": {
@@ -130,14 +230,7 @@ class MCPServer:
                     }
                 }
             elif info_type == "files":
-                file_list = subprocess.check_output(["ls"]).decode()
-                return {
-                    "status": "success",
-                    "data": {
-                        "type": "files",
-                        "info": file_list
-                    }
-                }
+                return self.list_files()
             else:
                 return {
                     "status": "error",
@@ -155,6 +248,67 @@ class MCPServer:
                 }
             }
 
+    def list_files(
+        self,
+        path: str = "",
+        sort: str = "name",
+        limit: Optional[int] = None,
+        cursor: Optional[str] = None,
+        metadata: bool = False
+    ) -> Dict[str, Any]:
+        """ファイル一覧を1ページ分取得"""
+        try:
+            return {
+                "status": "success",
+                "data": {
+                    "type": "files",
+                    **self.file_lister.list(path, sort, limit, cursor, metadata)
+                }
+            }
+        except FileListError as e:
+            return {
+                "status": "error",
+                "error": {
+                    "message": str(e),
+                    "code": e.code
+                }
+            }
+        except OSError as e:
+            return {
+                "status": "error",
+                "error": {
+                    "message": str(e),
+                    "code": "SYSTEM_INFO_ERROR"
+                }
+            }
+
+    def sample_metrics(self, metrics: List[str]) -> Dict[str, Dict[str, float]]:
+        """購読配信用にCPU・メモリの値を取得"""
+        snapshot = {}
+        if "cpu" in metrics:
+            snapshot["cpu"] = parse_cpu_info(self.read_system_output("cpu"))
+        if "memory" in metrics:
+            snapshot["memory"] = parse_memory_info(self.read_system_output("memory"))
+        return snapshot
+
+    def read_system_output(self, info_type: str) -> str:
+        """top/vm_statの出力を取得（短時間はワーカー間で共有してキャッシュ）"""
+        command = SYSTEM_COMMANDS[info_type]
+        key = f"system:{info_type}"
+        try:
+            return self.cache.get_or_compute(
+                key,
+                self.metrics_cache_ttl,
+                lambda: subprocess.check_output(command, timeout=SYSTEM_COMMAND_TIMEOUT).decode(),
+                wait_timeout=SYSTEM_COMMAND_TIMEOUT
+            )
+        except CacheWaitTimeout:
+            # 他のワーカーのコマンドが終わらなければ最後に取得できた出力を使う
+            stale = self.cache.get_stale(key)
+            if stale is None:
+                raise
+            return stale
+
     def get_current_time(self) -> Dict[str, Any]:
         """現在時刻の情報を取得"""
         try:
@@ -184,20 +338,39 @@ class MCPServer:
 
 mcp_server = MCPServer()
 
-@app.get("/health")
-async def health_check() -> Dict[str, Any]:
-    """ヘルスチェックエンドポイント"""
+# 差分がない場合にkeepaliveを送る間隔（秒）
+METRICS_KEEPALIVE_SECONDS = 15.0
+
+# 全購読者で共有するメトリクスのサンプラー
+metrics_sampler = MetricsSampler(
+    mcp_server.sample_metrics,
+    min_interval=float(os.getenv('MCP_METRICS_MIN_INTERVAL', '0.5')),
+    queue_size=int(os.getenv('MCP_METRICS_QUEUE_SIZE', '8'))
+)
+
+# /commands の応答（起動時に一度だけ構築し、メディアタイプごとにシリアライズ済みの本文を保持）
+COMMANDS_PAYLOAD = COMMANDS.commands_payload()
+
+COMMANDS_BODIES = {media_type: encode(COMMANDS_PAYLOAD, media_type) for media_type in available_media_types()}
+
+def negotiated_response(payload: Dict[str, Any], accept: Optional[str]) -> Response:
+    """Acceptヘッダーに応じてJSONまたはMessagePackで応答"""
+    media_type = negotiate_media_type(accept)
+    return Response(content=encode(payload, media_type), media_type=media_type)
+
+def check_health() -> Dict[str, Any]:
+    """基本的なシステムチェックを実行"""
     try:
         # 基本的なシステムチェック
         system_status = "healthy"
         
         # メモリ使用状況の確認
-        memory_info = subprocess.check_output(["vm_stat"]).decode()
+        memory_info = mcp_server.read_system_output("memory")
         if "Pages free" not in memory_info:
             system_status = "degraded"
             
         # CPU負荷の確認
-        cpu_info = subprocess.check_output(["top", "-l", "1", "-n", "0"]).decode()
+        cpu_info = mcp_server.read_system_output("cpu")
         if "CPU usage" not in cpu_info:
             system_status = "degraded"
             
@@ -223,64 +396,152 @@ async def health_check() -> Dict[str, Any]:
             }
         }
 
+@app.get("/health")
+def health_check(accept: Optional[str] = Header(None)) -> Response:
+    """ヘルスチェックエンドポイント（他のワーカーの計算待ちでイベントループを止めないよう同期関数としてスレッドで実行）"""
+    return negotiated_response(check_health(), accept)
+
 @app.get("/commands")
 async def get_commands(
+    accept: Optional[str] = Header(None),
     authorized: bool = Depends(verify_token)
-) -> Dict[str, Any]:
+) -> Response:
     """利用可能なコマンド情報を取得"""
-    return {
+    media_type = negotiate_media_type(accept)
+    return Response(content=COMMANDS_BODIES[media_type], media_type=media_type)
+
+@app.get("/weather/{city}")
+def get_weather(
+    city: str,
+    priority: str = "interactive",
+    city_id: Optional[int] = None,
+    accept: Optional[str] = Header(None),
+    authorized: bool = Depends(verify_token)
+) -> Response:
+    """天気情報を取得（上流の枠待ちでイベントループを止めないよう同期関数としてスレッドで実行）"""
+    if priority not in PRIORITIES:
+        return negotiated_response({
+            "status": "error",
+            "error": {
+                "message": f"不明な優先度: {priority}（{', '.join(PRIORITIES)}）",
+                "code": "INVALID_PRIORITY"
+            }
+        }, accept)
+    return negotiated_response(mcp_server.get_weather(city, PRIORITIES[priority], city_id), accept)
+
+@app.get("/quota")
+def get_quota(
+    accept: Optional[str] = Header(None),
+    authorized: bool = Depends(verify_token)
+) -> Response:
+    """上流APIの残り枠と待ち行列の状態を取得（スケジューラのロックと共有DBのトランザクションを待つため同期関数としてスレッドで実行）"""
+    return negotiated_response({
         "status": "success",
         "data": {
-            "commands": {
-                "weather": {
-                    "description": "天気情報を取得",
-                    "examples": ["東京の天気を教えて", "大阪の天気は？", "天気を教えて"],
-                    "parameters": {
-                        "city": "都市名（デフォルト: 東京）"
-                    }
-                },
-                "system": {
-                    "description": "システム情報を取得",
-                    "examples": ["CPUの使用率を確認して", "メモリの使用状況を教えて","ファイルを見せて"],
-                    "parameters": {
-                        "type": "情報タイプ（cpu, memory, files）"
-                    }
-                },
-                "time": {
-                    "description": "現在時刻を取得",
-                    "examples": ["時刻を教えて", "今何時？"],
-                    "parameters": {}
-                }
+            "openweathermap": {
+                **mcp_server.weather_scheduler.stats(),
+                "served_stale": mcp_server.weather_served_stale
             }
         }
-    }
+    }, accept)
 
-@app.get("/weather/{city}")
-async def get_weather(
-    city: str,
+@app.get("/system/files")
+def list_files(
+    path: str = "",
+    sort: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    metadata: bool = False,
+    stream: bool = False,
+    accept: Optional[str] = Header(None),
     authorized: bool = Depends(verify_token)
-) -> Dict[str, Any]:
-    """天気情報を取得"""
-    return mcp_server.get_weather(city)
+) -> Response:
+    """ファイル一覧を取得（stream=trueで1行1件のNDJSONを逐次返す。既定の並び順はページングがname、ストリームはnone）
+
+    ディレクトリの走査でイベントループを止めないよう同期関数としてスレッドで実行する
+    （ストリームの残りも同期ジェネレーターなのでスレッドで読み進められる）。
+    """
+    if not stream:
+        return negotiated_response(mcp_server.list_files(path, sort or "name", limit, cursor, metadata), accept)
+
+    try:
+        entries = mcp_server.file_lister.stream(path, sort or "none", metadata)
+        first = next(entries, None)
+    except FileListError as e:
+        return negotiated_response({"status": "error", "error": {"message": str(e), "code": e.code}}, accept)
+
+    def ndjson() -> Iterator[bytes]:
+        if first is not None:
+            yield dumps_json(first) + b"\n"
+        for entry in entries:
+            yield dumps_json(entry) + b"\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+@app.get("/system/subscribe")
+async def subscribe_metrics(
+    request: Request,
+    metrics: str = "cpu,memory",
+    interval: float = 1.0,
+    authorized: bool = Depends(verify_token)
+) -> Response:
+    """CPU・メモリの値をServer-Sent Eventsで配信（初回は全体、以降は差分のみ）"""
+    requested = [metric.strip() for metric in metrics.split(",") if metric.strip()]
+    invalid = [metric for metric in requested if metric not in METRIC_TYPES]
+    if not requested or invalid:
+        return negotiated_response({
+            "status": "error",
+            "error": {
+                "message": f"不明なメトリクス: {', '.join(invalid) or metrics}",
+                "code": "INVALID_METRIC"
+            }
+        }, None)
+
+    subscriber = metrics_sampler.subscribe(requested, interval)
+
+    async def events() -> AsyncIterator[bytes]:
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscriber.queue.get(), timeout=METRICS_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    # 差分がない間も接続の生存を確認する
+                    event = b": keepalive\n\n"
+                if event is None or await request.is_disconnected():
+                    break
+                yield event
+        finally:
+            metrics_sampler.unsubscribe(subscriber)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 @app.get("/system/{info_type}")
-async def get_system_info(
+def get_system_info(
     info_type: str,
+    accept: Optional[str] = Header(None),
     authorized: bool = Depends(verify_token)
-) -> Dict[str, Any]:
-    """システム情報を取得"""
-    return mcp_server.get_system_info(info_type)
+) -> Response:
+    """システム情報を取得（他のワーカーの計算待ちでイベントループを止めないよう同期関数としてスレッドで実行）"""
+    return negotiated_response(mcp_server.get_system_info(info_type), accept)
 
 @app.get("/time")
 async def get_time(
+    accept: Optional[str] = Header(None),
     authorized: bool = Depends(verify_token)
-) -> Dict[str, Any]:
+) -> Response:
     """現在時刻を取得"""
-    return mcp_server.get_current_time()
+    return negotiated_response(mcp_server.get_current_time(), accept)
 
 def start_server():
-    """サーバーを起動"""
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    """サーバーを起動（MCP_SERVER_WORKERSが2以上ならマルチプロセスで起動）"""
+    host = os.getenv('MCP_SERVER_HOST', '0.0.0.0')
+    port = int(os.getenv('MCP_SERVER_PORT', '8000'))
+    workers = int(os.getenv('MCP_SERVER_WORKERS', '1'))
+    if workers > 1:
+        # 各ワーカーがモジュールを読み込み直すため、アプリはインポート文字列で渡す
+        uvicorn.run("mcp_server:app", host=host, port=port, workers=workers)
+    else:
+        uvicorn.run(app, host=host, port=port)
 
 if __name__ == "__main__":
     start_server() 
\ No newline at end of file
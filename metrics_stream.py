@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import re
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from mcp_codec import dumps_json
+
+logger = logging.getLogger('mcp_server.metrics')
+
+# 購読できるメトリクス
+METRIC_TYPES = ("cpu", "memory")
+
+CPU_USAGE_PATTERN = re.compile(r"CPU usage:\s*([\d.]+)% user,\s*([\d.]+)% sys,\s*([\d.]+)% idle")
+VM_STAT_PATTERN = re.compile(r"^\"?([^:\"]+)\"?:\s+([\d.]+)\.?$", re.MULTILINE)
+
+def parse_cpu_info(cpu_info: str) -> Dict[str, float]:
+    """topの出力からCPU使用率を取り出す"""
+    match = CPU_USAGE_PATTERN.search(cpu_info)
+    if not match:
+        return {}
+    user, sys_, idle = (float(value) for value in match.groups())
+    return {"user": user, "sys": sys_, "idle": idle}
+
+def parse_memory_info(memory_info: str) -> Dict[str, float]:
+    """vm_statの出力から各項目の値を取り出す"""
+    return {name.strip(): float(value) for name, value in VM_STAT_PATTERN.findall(memory_info)}
+
+def format_sse(event: str, data: Dict[str, Any]) -> bytes:
+    """Server-Sent Eventsの1イベント分を整形"""
+    return b"event: " + event.encode() + b"\ndata: " + dumps_json(data) + b"\n\n"
+
+class MetricsSubscriber:
+    """1購読者分の状態（送信済みの値と送信待ちキュー）"""
+    def __init__(self, metrics: List[str], interval: float, queue_size: int):
+        self.metrics = metrics
+        self.interval = interval
+        self.queue: "asyncio.Queue[Optional[bytes]]" = asyncio.Queue(queue_size)
+        self.next_due = 0.0
+        self.last_sent: Dict[str, Dict[str, float]] = {}
+        self.dropped = False
+
+    def make_event(self, snapshot: Dict[str, Dict[str, float]], timestamp: float) -> Optional[bytes]:
+        """前回送信分との差分だけをイベントにする（初回は全体）"""
+        if not self.last_sent:
+            data = {metric: snapshot.get(metric, {}) for metric in self.metrics}
+            self.last_sent = {metric: dict(values) for metric, values in data.items()}
+            return format_sse("snapshot", {"timestamp": timestamp, "metrics": data})
+
+        delta = {}
+        for metric in self.metrics:
+            previous = self.last_sent.setdefault(metric, {})
+            changed = {key: value for key, value in snapshot.get(metric, {}).items() if previous.get(key) != value}
+            if changed:
+                delta[metric] = changed
+                previous.update(changed)
+        if not delta:
+            return None
+        return format_sse("delta", {"timestamp": timestamp, "metrics": delta})
+
+class MetricsSampler:
+    """全購読者で共有するメトリクスのサンプラー
+
+    購読者がいる間だけ動作し、最も短い購読間隔で1回だけサンプリングして
+    間隔が来た購読者に配信する。キューが溢れた購読者は切断する。
+    新しい購読者が来たら待機を打ち切り、すぐに初回の値を送る。
+    """
+
+    def __init__(
+        self,
+        sample: Callable[[List[str]], Dict[str, Dict[str, float]]],
+        min_interval: float = 0.5,
+        queue_size: int = 8
+    ):
+        self.sample = sample
+        self.min_interval = min_interval
+        self.queue_size = queue_size
+        self.subscribers: List[MetricsSubscriber] = []
+        self.task: Optional[asyncio.Task] = None
+        self.wakeup: Optional[asyncio.Event] = None
+        self.samples_taken = 0
+        self.dropped_subscribers = 0
+
+    def subscribe(self, metrics: List[str], interval: float) -> MetricsSubscriber:
+        """購読を開始（最初の購読者でサンプラーを起動）"""
+        subscriber = MetricsSubscriber(metrics, max(interval, self.min_interval), self.queue_size)
+        self.subscribers.append(subscriber)
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        if self.task is None or self.task.done():
+            self.task = asyncio.get_running_loop().create_task(self._run())
+        else:
+            # 既存の購読者の間隔で待機中のサンプラーを起こす
+            self.wakeup.set()
+        return subscriber
+
+    def unsubscribe(self, subscriber: MetricsSubscriber):
+        """購読を終了（購読者がいなくなればサンプラーは停止する）"""
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "subscribers": len(self.subscribers),
+            "samples_taken": self.samples_taken,
+            "dropped_subscribers": self.dropped_subscribers
+        }
+
+    async def _run(self):
+        while self.subscribers:
+            # 以降に来た購読者は次の待機を打ち切る
+            self.wakeup.clear()
+            now = time.monotonic()
+            due = [subscriber for subscriber in self.subscribers if subscriber.next_due <= now]
+            if due:
+                metrics = sorted({metric for subscriber in due for metric in subscriber.metrics})
+                try:
+                    # サブプロセスの起動はイベントループの外で行う
+                    snapshot = await asyncio.to_thread(self.sample, metrics)
+                    self.samples_taken += 1
+                except Exception as e:
+                    logger.error(f"メトリクスのサンプリングに失敗: {str(e)}")
+                    snapshot = None
+                timestamp = time.time()
+                for subscriber in due:
+                    subscriber.next_due = now + subscriber.interval
+                    if snapshot is not None:
+                        self._deliver(subscriber, snapshot, timestamp)
+
+            if not self.subscribers:
+                break
+            next_due = min(subscriber.next_due for subscriber in self.subscribers)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=max(0.0, next_due - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
+
+    def _deliver(self, subscriber: MetricsSubscriber, snapshot: Dict[str, Dict[str, float]], timestamp: float):
+        event = subscriber.make_event(snapshot, timestamp)
+        if event is None:
+            return
+        try:
+            subscriber.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # 読み出しが追いつかない購読者は切断する
+            logger.warning("メトリクス購読者の受信が遅いため切断します")
+            subscriber.dropped = True
+            self.dropped_subscribers += 1
+            self.unsubscribe(subscriber)
+            try:
+                subscriber.queue.get_nowait()
+                subscriber.queue.put_nowait(None)
+            except (asyncio.QueueEmpty, asyncio.QueueFull):
+                pass
@@ -0,0 +1,140 @@
+import logging
+import secrets
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from mcp_codec import dumps_json, loads_json
+
+logger = logging.getLogger('mcp_server.cache')
+
+class CacheWaitTimeout(Exception):
+    """他のプロセスが計算中の値を待ち時間内に受け取れなかった場合のエラー"""
+
+class SharedCache:
+    """複数のワーカープロセスで共有するSQLiteのキャッシュ
+
+    値はJSONで保存し、期限切れの値は読み出し時に無視する。
+    get_or_computeは同じキーの計算を全プロセスで1回にまとめる。
+    計算中のロックはlock_timeoutごとに延長するので、計算が長引いても失効しない
+    （保持したプロセスが落ちた場合だけ、lock_timeout後に他のプロセスが引き継ぐ）。
+    """
+
+    def __init__(self, path: str, lock_timeout: float = 10.0, poll_interval: float = 0.05, wait_timeout: float = 10.0):
+        self.path = path
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.wait_timeout = wait_timeout
+        self.local = threading.local()
+        self.writes = 0
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_locks (key TEXT PRIMARY KEY, owner INTEGER NOT NULL, expires_at REAL NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        # 接続はスレッドごとに保持する
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.lock_timeout, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[Any]:
+        """有効期限内の値を取得（なければNone）"""
+        row = self._connect().execute(
+            "SELECT value FROM cache WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return loads_json(row[0]) if row else None
+
+    def get_stale(self, key: str) -> Optional[Any]:
+        """有効期限切れでも最後に保存された値を取得"""
+        row = self._connect().execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+        return loads_json(row[0]) if row else None
+
+    def set(self, key: str, value: Any, ttl: float):
+        """値を保存"""
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, dumps_json(value), time.time() + ttl)
+        )
+        self.writes += 1
+        if self.writes % 100 == 0:
+            # 古い値は最後の値として残したいので、十分に古いものだけ削除
+            conn.execute("DELETE FROM cache WHERE expires_at < ?", (time.time() - 86400,))
+
+    def get_or_compute(
+        self,
+        key: str,
+        ttl: float,
+        compute: Callable[[], Any],
+        cacheable: Callable[[Any], bool] = lambda value: True,
+        wait_timeout: Optional[float] = None
+    ) -> Any:
+        """キャッシュになければ計算して保存（同じキーの計算は全プロセスで1回にまとめる）
+
+        他のプロセスの計算をwait_timeout秒待っても値が保存されなければCacheWaitTimeoutを送出する
+        （ロックなしで計算すると上流への呼び出しが増えるため、自分では計算しない）。
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        deadline = time.monotonic() + (self.wait_timeout if wait_timeout is None else wait_timeout)
+        owner = secrets.randbits(62)
+        while not self._acquire(key, owner):
+            # 他のプロセスが計算中なので、結果が保存されるのを待つ
+            time.sleep(self.poll_interval)
+            value = self.get(key)
+            if value is not None:
+                return value
+            if time.monotonic() > deadline:
+                logger.warning(f"キャッシュの計算待ちがタイムアウトしました: {key}")
+                raise CacheWaitTimeout(f"他のワーカーの計算が終わりませんでした: {key}")
+
+        renewing = self._keep_lock(key, owner)
+        try:
+            value = self.get(key)
+            if value is not None:
+                return value
+            value = compute()
+            if cacheable(value):
+                self.set(key, value, ttl)
+            return value
+        finally:
+            renewing.set()
+            self._release(key, owner)
+
+    def _acquire(self, key: str, owner: int) -> bool:
+        conn = self._connect()
+        now = time.time()
+        conn.execute("DELETE FROM cache_locks WHERE key = ? AND expires_at < ?", (key, now))
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO cache_locks (key, owner, expires_at) VALUES (?, ?, ?)",
+            (key, owner, now + self.lock_timeout)
+        )
+        return cursor.rowcount == 1
+
+    def _keep_lock(self, key: str, owner: int) -> threading.Event:
+        """計算が終わるまでロックの期限を延長し続ける（戻り値をsetすると止まる）"""
+        done = threading.Event()
+
+        def renew():
+            while not done.wait(self.lock_timeout / 3):
+                self._connect().execute(
+                    "UPDATE cache_locks SET expires_at = ? WHERE key = ? AND owner = ?",
+                    (time.time() + self.lock_timeout, key, owner)
+                )
+
+        threading.Thread(target=renew, name=f"cache-lock:{key}", daemon=True).start()
+        return done
+
+    def _release(self, key: str, owner: int):
+        self._connect().execute("DELETE FROM cache_locks WHERE key = ? AND owner = ?", (key, owner))
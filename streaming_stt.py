@@ -0,0 +1,150 @@
+import contextvars
+import io
+import time
+import wave
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from difflib import SequenceMatcher
+from typing import Callable, Optional
+
+logger = logging.getLogger('voice_chat_ai.streaming_stt')
+
+# 窓の末尾に付きやすい句読点（つなぎ合わせの際は無視する）
+TRAILING_PUNCTUATION = "。、．，.,!?！？ 　"
+
+def pcm_to_wav(frames: bytes, sample_rate: int, sample_width: int, channels: int = 1) -> bytes:
+    """生のPCMデータをWAV形式のバイト列に変換"""
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wf:
+        wf.setnchannels(channels)
+        wf.setsampwidth(sample_width)
+        wf.setframerate(sample_rate)
+        wf.writeframes(frames)
+    return buffer.getvalue()
+
+def stitch_transcripts(previous: str, hypothesis: str, min_overlap: int = 2) -> str:
+    """これまでの文字起こしと、重なりのある新しい窓の仮説をつなぎ合わせる"""
+    if not previous:
+        return hypothesis
+    if not hypothesis:
+        return previous
+
+    # 新しい窓の先頭は、前回までの末尾のどこかと重なっているはず
+    base = previous.rstrip(TRAILING_PUNCTUATION)
+    tail_start = max(0, len(base) - 2 * len(hypothesis))
+    tail = base[tail_start:]
+    match = SequenceMatcher(None, tail, hypothesis, autojunk=False).find_longest_match(
+        0, len(tail), 0, len(hypothesis)
+    )
+    if match.size < min_overlap:
+        # 重なりが見つからない場合はそのまま連結
+        return previous + hypothesis
+
+    # 重なり以降は、より多くの文脈を持つ新しい窓の仮説を採用
+    return base[:tail_start + match.a] + hypothesis[match.b:]
+
+def common_prefix(a: str, b: str) -> str:
+    """2つの文字列の共通接頭辞"""
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return a[:length]
+
+class StreamingTranscriber:
+    """発話中に重なりのある窓を逐次文字起こしし、部分結果をつなぎ合わせる
+
+    transcribeはWAVバイト列と直前までの文字起こし（プロンプト）を受け取り、
+    テキストを返す関数。チャンクごとに直近window_seconds分の音声を送信する。
+    """
+
+    def __init__(
+        self,
+        transcribe: Callable[[bytes, Optional[str]], str],
+        sample_rate: int,
+        sample_width: int,
+        chunk_seconds: float = 1.0,
+        window_seconds: float = 3.0,
+        on_partial: Optional[Callable[[str], None]] = None,
+        on_stable: Optional[Callable[[str], None]] = None,
+        min_stable_chars: int = 2,
+        max_workers: int = 2
+    ):
+        self.transcribe = transcribe
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+        bytes_per_second = sample_rate * sample_width
+        self.chunk_bytes = max(sample_width, int(bytes_per_second * chunk_seconds) // sample_width * sample_width)
+        self.window_bytes = max(self.chunk_bytes, int(bytes_per_second * window_seconds) // sample_width * sample_width)
+        self.on_partial = on_partial
+        self.on_stable = on_stable
+        self.min_stable_chars = min_stable_chars
+
+        self.audio = bytearray()
+        self.sent_until = 0
+        self.pending = deque()
+        self.transcript = ""
+        self.stable = ""
+        self.windows_sent = 0
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="stt-window")
+
+    def feed(self, frames: bytes):
+        """音声データを追加し、チャンクがたまったら窓を送信"""
+        self.audio.extend(frames)
+        while len(self.audio) - self.sent_until >= self.chunk_bytes:
+            self._submit(self.sent_until + self.chunk_bytes)
+        self._drain(block=False)
+
+    def finish(self, timeout: Optional[float] = None) -> str:
+        """発話終了時に残りの音声を送信し、最終的な文字起こしを返す（timeout秒を過ぎた窓は使わない）"""
+        try:
+            if len(self.audio) > self.sent_until or self.windows_sent == 0:
+                self._submit(len(self.audio))
+            self._drain(block=True, expires_at=None if timeout is None else time.monotonic() + timeout)
+            return self.transcript.strip()
+        finally:
+            self.executor.shutdown(wait=False)
+
+    def _submit(self, end: int):
+        start = max(0, end - self.window_bytes)
+        wav = pcm_to_wav(bytes(self.audio[start:end]), self.sample_rate, self.sample_width)
+        prompt = self.transcript or None
+        # 呼び出し側のコンテキスト（ターンの期限など）を引き継ぐ
+        self.pending.append((start, self.executor.submit(contextvars.copy_context().run, self.transcribe, wav, prompt)))
+        self.sent_until = end
+        self.windows_sent += 1
+
+    def _drain(self, block: bool, expires_at: Optional[float] = None):
+        # 窓の結果は送信順に反映する
+        while self.pending and (block or self.pending[0][1].done()):
+            start, future = self.pending.popleft()
+            try:
+                timeout = None if expires_at is None else max(0.0, expires_at - time.monotonic())
+                hypothesis = (future.result(timeout=timeout) or "").strip()
+            except FuturesTimeoutError:
+                logger.warning("窓の文字起こしが期限内に終わりませんでした")
+                continue
+            except Exception as e:
+                logger.warning(f"窓の文字起こしに失敗: {str(e)}")
+                continue
+            self._update(start, hypothesis)
+
+    def _update(self, start: int, hypothesis: str):
+        previous = self.transcript
+        if start == 0:
+            # 先頭からの窓はそれまでの仮説をすべて置き換える
+            self.transcript = hypothesis
+        else:
+            self.transcript = stitch_transcripts(previous, hypothesis)
+        logger.debug(f"部分文字起こし: {self.transcript}")
+        if self.on_partial:
+            self.on_partial(self.transcript)
+
+        # 連続する2つの仮説で変化しなかった接頭辞を安定した部分結果とみなす
+        stable = common_prefix(previous, self.transcript).rstrip(TRAILING_PUNCTUATION)
+        if len(stable) >= self.min_stable_chars and len(stable) > len(self.stable):
+            self.stable = stable
+            if self.on_stable:
+                self.on_stable(stable)
@@ -0,0 +1,150 @@
+import heapq
+import itertools
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger('mcp_server.upstream')
+
+# 優先度（小さいほど優先）
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+PRIORITIES = {"interactive": PRIORITY_INTERACTIVE, "background": PRIORITY_BACKGROUND}
+
+class QuotaExhausted(Exception):
+    """上流APIの呼び出し枠を待ち時間内に確保できなかった場合のエラー"""
+
+class SharedTokenBucket:
+    """ワーカープロセス間で共有するトークンバケット（SQLiteに状態を保存）"""
+
+    def __init__(self, path: str, name: str, rate_per_second: float, capacity: float):
+        self.name = name
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.conn = sqlite3.connect(path, timeout=10.0, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS token_buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self.conn.execute(
+                "INSERT OR IGNORE INTO token_buckets (name, tokens, updated_at) VALUES (?, ?, ?)",
+                (name, capacity, time.time())
+            )
+
+    def _update(self, consume: float, drain: bool = False) -> Tuple[bool, float]:
+        # 他のプロセスと競合しないよう、読み出しから更新までを1トランザクションで行う
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                tokens, updated_at = self.conn.execute(
+                    "SELECT tokens, updated_at FROM token_buckets WHERE name = ?", (self.name,)
+                ).fetchone()
+                now = time.time()
+                tokens = min(self.capacity, tokens + max(0.0, now - updated_at) * self.rate)
+                acquired = consume > 0 and tokens >= consume
+                if acquired:
+                    tokens -= consume
+                if drain:
+                    tokens = 0.0
+                self.conn.execute(
+                    "UPDATE token_buckets SET tokens = ?, updated_at = ? WHERE name = ?", (tokens, now, self.name)
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return acquired, tokens
+
+    def try_acquire(self) -> Tuple[bool, float]:
+        """トークンを1つ取得（取得できなければ次のトークンまでの秒数を返す）"""
+        acquired, tokens = self._update(1.0)
+        if acquired:
+            return True, 0.0
+        return False, (1.0 - tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def remaining(self) -> float:
+        """現在の残りトークン数"""
+        return self._update(0.0)[1]
+
+    def drain(self):
+        """上流からレート制限の応答を受けた場合に残りを0にする"""
+        self._update(0.0, drain=True)
+
+class UpstreamScheduler:
+    """トークンバケットと優先度付きの待ち行列で上流APIの呼び出しを制御
+
+    枠がない場合は期限付きで待機し、対話的なリクエストを先に通す。
+    待ち行列が満杯、または期限までに枠を確保できなければQuotaExhaustedを送出する。
+    """
+
+    def __init__(self, bucket: SharedTokenBucket, max_queue: int = 32, wait_timeouts: Optional[Dict[int, float]] = None):
+        self.bucket = bucket
+        self.max_queue = max_queue
+        self.wait_timeouts = wait_timeouts or {PRIORITY_INTERACTIVE: 3.0, PRIORITY_BACKGROUND: 30.0}
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.counters = {"calls": 0, "waited": 0, "rejected": 0, "timed_out": 0, "rate_limited": 0}
+
+    def call(self, func: Callable[[], Any], priority: int = PRIORITY_INTERACTIVE) -> Any:
+        """枠を確保してから上流APIを呼び出す"""
+        self.acquire(priority)
+        with self.condition:
+            self.counters["calls"] += 1
+        return func()
+
+    def acquire(self, priority: int = PRIORITY_INTERACTIVE):
+        """呼び出し枠を確保（期限内に確保できなければQuotaExhausted）"""
+        with self.condition:
+            # 待っている人がいなければ即座に取得を試みる
+            if not self.waiting:
+                acquired, _ = self.bucket.try_acquire()
+                if acquired:
+                    return
+            if len(self.waiting) >= self.max_queue:
+                self.counters["rejected"] += 1
+                raise QuotaExhausted("上流APIの待ち行列が満杯です")
+
+            deadline = time.monotonic() + self.wait_timeouts.get(priority, 0.0)
+            ticket = (priority, next(self.sequence))
+            heapq.heappush(self.waiting, ticket)
+            self.counters["waited"] += 1
+            try:
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if self.waiting[0] == ticket:
+                        acquired, wait = self.bucket.try_acquire()
+                        if acquired:
+                            return
+                    else:
+                        wait = remaining
+                    if remaining <= 0:
+                        self.counters["timed_out"] += 1
+                        raise QuotaExhausted("上流APIの呼び出し枠を期限内に確保できませんでした")
+                    self.condition.wait(min(wait, remaining))
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+
+    def report_rate_limited(self):
+        """上流から429を受けた場合に枠を使い切った扱いにする"""
+        logger.warning("上流APIからレート制限の応答を受けました")
+        self.bucket.drain()
+        with self.condition:
+            self.counters["rate_limited"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """残り枠と待ち行列の状態"""
+        with self.condition:
+            return {
+                "tokens_remaining": round(self.bucket.remaining(), 3),
+                "capacity": self.bucket.capacity,
+                "rate_per_minute": self.bucket.rate * 60,
+                "queue_length": len(self.waiting),
+                "queue_limit": self.max_queue,
+                **self.counters
+            }
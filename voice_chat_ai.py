@@ -1,31 +1,36 @@
-import speech_recognition as sr
 import openai
 import os
 from dotenv import load_dotenv
+from log_config import setup_logging, log_event
+from mcp_codec import dumps_json_text
 import pygame
 import time
 import json
 import logging
 import sys
-import sounddevice as sd
 import numpy as np
 from io import BytesIO
 import wave
 from mcp_controller import MCPController
-from typing import List, Dict, Any, Generator
+from command_registry import COMMANDS
+from typing import List, Dict, Any, Callable, Generator, Optional, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+import threading
+import math
+from collections import deque
+from streaming_stt import StreamingTranscriber
+from audio_devices import AudioDevices
+from audio_format import PlaybackConverter, PlaybackFormat
+from keyword_spotter import KeywordSpotter
+from city_index import normalize_key
+from deadline import Deadline, DeadlineExceeded, Hedger, LatencyTracker, current_deadline, set_deadline, stage_timeout, submit_in_context, turn_expired
+import random
 
 # 環境変数の読み込み
 load_dotenv(verbose=True)
 
-# ロガーの設定
-logging.basicConfig(
-    level=logging.WARNING,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('voice_chat.log')
-    ]
-)
+# ロガーの設定（キュー経由でバックグラウンドのスレッドが書き込む）
+setup_logging('voice_chat.log', level=getattr(logging, os.getenv('VOICE_CHAT_LOG_LEVEL', 'WARNING').upper(), logging.WARNING))
 logger = logging.getLogger('voice_chat_ai')
 
 # OpenAI APIキーを環境変数から取得
@@ -34,137 +39,179 @@ openai.api_key = os.getenv('OPENAI_API_KEY')
 # MCPコントローラーのインスタンスを作成
 mcp = MCPController()
 
+# 逐次文字起こしの設定
+STREAMING_STT = os.getenv('STREAMING_STT', '0') == '1'
+STT_CHUNK_SECONDS = float(os.getenv('STT_CHUNK_SECONDS', '1.0'))
+STT_WINDOW_SECONDS = float(os.getenv('STT_WINDOW_SECONDS', '3.0'))
+
+# キーワードゲートの設定（KWS_TEMPLATE_PATHを指定すると、キーワードを含む発話だけを文字起こしする）
+KWS_TEMPLATE_PATH = os.getenv('KWS_TEMPLATE_PATH', '')
+KWS_THRESHOLD = float(os.getenv('KWS_THRESHOLD')) if os.getenv('KWS_THRESHOLD') else None
+KWS_SEARCH_SECONDS = float(os.getenv('KWS_SEARCH_SECONDS', '3.0'))
+# 誤受理・誤棄却の集計に使うキーワードの表記と、棄却した発話を確認のため文字起こしする割合
+KWS_KEYWORD_TEXT = os.getenv('KWS_KEYWORD_TEXT', '')
+KWS_AUDIT_RATE = float(os.getenv('KWS_AUDIT_RATE', '0'))
+
+# ターンの期限（発話終了から応答開始までの秒数）。各段階は残り時間をタイムアウトとして使う
+TURN_DEADLINE_SECONDS = float(os.getenv('TURN_DEADLINE_SECONDS', '10'))
+# 音声合成のために残しておく秒数と、OpenAIの1回の呼び出しの上限（期限がない場合）
+TTS_RESERVE_SECONDS = float(os.getenv('TTS_RESERVE_SECONDS', '2'))
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', '15'))
+# p95を超えたら複製を発行する段階（stt, llm, tts, mcp）
+HEDGE_STAGES = os.getenv('HEDGE_STAGES', 'mcp').split(',')
+# 期限を過ぎた場合の短い応答
+TURN_FALLBACK_TEXT = os.getenv('TURN_FALLBACK_TEXT', 'すみません、応答に時間がかかっています。もう一度お願いします。')
+
+# 音声デバイス（名前の一部で指定。未指定なら既定のデバイス）。開いたままにしてターンごとに開き直さない
+AUDIO_INPUT_DEVICE = os.getenv('AUDIO_INPUT_DEVICE', '')
+AUDIO_OUTPUT_DEVICE = os.getenv('AUDIO_OUTPUT_DEVICE', '')
+# 起動後最初の聞き取りで雑音レベルを測る秒数と、指定のデバイスが見つからない場合に接続を確認し直す間隔（秒）
+NOISE_CALIBRATION_SECONDS = float(os.getenv('NOISE_CALIBRATION_SECONDS', '1.0'))
+AUDIO_DEVICE_RECHECK_SECONDS = float(os.getenv('AUDIO_DEVICE_RECHECK_SECONDS', '30'))
+# PCM再生のブロック長（秒）。デバイスのバッファとデバイスの形式への変換はこの単位で行う
+PLAYBACK_BLOCK_SECONDS = float(os.getenv('PLAYBACK_BLOCK_SECONDS', '0.05'))
+
+# LLMに渡すファイル一覧の最大件数と文字列の最大長
+LLM_MAX_FILE_ENTRIES = int(os.getenv('LLM_MAX_FILE_ENTRIES', '50'))
+LLM_MAX_TEXT_CHARS = int(os.getenv('LLM_MAX_TEXT_CHARS', '4000'))
+
 # グローバル変数の追加（ファイルの先頭付近に追加）
 is_speaking = False
 
+# ターンをまたいで開いたままにする入出力デバイス
+audio_devices = AudioDevices(
+    AUDIO_INPUT_DEVICE,
+    AUDIO_OUTPUT_DEVICE,
+    calibration_seconds=NOISE_CALIBRATION_SECONDS,
+    recheck_seconds=AUDIO_DEVICE_RECHECK_SECONDS,
+    block_seconds=PLAYBACK_BLOCK_SECONDS
+)
+
+# OpenAIの呼び出しの所要時間の記録とヘッジ
+openai_hedger = Hedger([stage for stage in HEDGE_STAGES if stage in ("stt", "llm", "tts")])
+
+# 発話終了から応答開始までの所要時間と、期限切れで定型の応答にした回数
+turn_latency = LatencyTracker(window=1000)
+turn_fallbacks = 0
+fallback_audio: Optional[bytes] = None
+
+def call_openai(stage: str, func: Callable[[Any], Any], reserve: float = TTS_RESERVE_SECONDS) -> Any:
+    """OpenAIの呼び出しをターンの残り時間内で実行（リトライはせず、対象の段階はヘッジ）"""
+    return openai_hedger.call(
+        stage,
+        lambda timeout: func(openai.OpenAI(timeout=timeout, max_retries=0)),
+        cap=OPENAI_TIMEOUT,
+        reserve=reserve
+    )
+
+def start_turn():
+    """発話の終了時点からターンの期限を開始"""
+    set_deadline(Deadline(TURN_DEADLINE_SECONDS))
+
+def record_turn_latency():
+    """応答の再生開始時点でターンの所要時間を記録"""
+    deadline = current_deadline()
+    if deadline is not None:
+        turn_latency.record(deadline.elapsed())
+
 def stream_audio_data(audio_data: bytes, sample_rate: int = 24000):
-    """音声データをリアルタイムでストリーミング再生"""
+    """音声データをリアルタイムでストリーミング再生
+
+    WAVはヘッダの形式で、ヘッダのないPCM（OpenAI TTSのresponse_format="pcm"）は16bitモノラルのsample_rateとして扱う。
+    出力デバイスの形式（サンプルレート・チャンネル数・dtype）にブロックごとに変換しながら再生する。
+    """
     global is_speaking
     is_speaking = True
     
     try:
-        # BytesIOを使用してバイトデータをwavファイルとして読み込む
-        with wave.open(BytesIO(audio_data), 'rb') as wf:
-            # WAVファイルのパラメータを取得
-            channels = wf.getnchannels()
-            sampwidth = wf.getsampwidth()
-            rate = wf.getframerate()
-            
-            # 全データを一度に読み込み
-            audio_data = wf.readframes(wf.getnframes())
-            
-            # データ型を設定
-            if sampwidth == 2:
-                dtype = np.int16
-            elif sampwidth == 4:
-                dtype = np.int32
-            else:
-                raise ValueError(f"サポートされていないサンプル幅です: {sampwidth}")
-            
-            # バイトデータをnumpy配列に変換
-            samples = np.frombuffer(audio_data, dtype=dtype)
-            
-            # 正規化（-1.0から1.0の範囲に）
-            if dtype == np.int16:
-                samples = samples.astype(np.float32) / 32768.0
-            elif dtype == np.int32:
-                samples = samples.astype(np.float32) / 2147483648.0
-            
-            # チャンネル数に応じて整形
-            if channels == 2:
-                samples = samples.reshape(-1, 2)
-            else:
-                samples = samples.reshape(-1, 1)
-            
-            # ブロックサイズの設定
-            block_size = int(rate * 0.05)  # 50msブロック
-            
-            # コールバック関数
-            current_frame = [0]  # ミュータブルな参照用
-            
-            def callback(outdata, frames, time, status):
-                if status:
-                    logger.warning(f'ストリーミングステータス: {status}')
-                
-                start = current_frame[0]
-                end = start + frames
-                
-                if start >= len(samples):
-                    raise sd.CallbackStop()
-                
-                if end > len(samples):
-                    outdata[:len(samples)-start] = samples[start:]
-                    outdata[len(samples)-start:] = 0
-                    raise sd.CallbackStop()
-                else:
-                    outdata[:] = samples[start:end]
-                
-                current_frame[0] = end
-            
-            # ストリームを開始
-            with sd.OutputStream(
-                channels=channels,
-                dtype=np.float32,
-                samplerate=rate,
-                blocksize=block_size,
-                callback=callback
-            ) as stream:
-                while stream.active and current_frame[0] < len(samples) and is_speaking:
-                    sd.sleep(100)
-                    
+        if audio_data[:4] == b"RIFF":
+            # BytesIOを使用してバイトデータをwavファイルとして読み込む
+            with wave.open(BytesIO(audio_data), 'rb') as wf:
+                channels = wf.getnchannels()
+                sampwidth = wf.getsampwidth()
+                rate = wf.getframerate()
+                frames = wf.readframes(wf.getnframes())
+        else:
+            channels, sampwidth, rate = 1, 2, sample_rate
+            frames = audio_data
+
+        block_bytes = int(rate * PLAYBACK_BLOCK_SECONDS) * sampwidth * channels
+
+        def convert(target: PlaybackFormat):
+            converter = PlaybackConverter(rate, sampwidth, channels, target)
+            for offset in range(0, len(frames), block_bytes):
+                yield converter.convert(frames[offset:offset + block_bytes])
+            yield converter.flush()
+
+        # 開いたままの出力ストリームで再生（is_speakingがFalseになったら中断）
+        audio_devices.output.play_blocks(convert, lambda: is_speaking)
     except Exception as e:
         logger.error(f"音声ストリーミングエラー: {str(e)}", exc_info=True)
     finally:
         is_speaking = False
 
-def speak_text(text: str):
-    """テキストを音声に変換して再生する"""
-    try:
-        # 一時ファイルのパス
-        output_file = "response.mp3"
-        
-        # OpenAI TTS APIを使用して音声を生成
-        client = openai.OpenAI()
-        response = client.audio.speech.create(
+def synthesize_speech(text: str, reserve: float = 0.0) -> bytes:
+    """OpenAI TTS APIでテキストをPCM（24kHz・16bit・モノラル、ヘッダなし）に変換"""
+    response = call_openai(
+        "tts",
+        lambda client: client.audio.speech.create(
             model="tts-1",
             voice="nova",
             input=text,
-            speed=1
-        )
-        
-        # 音声ファイルを保存
-        response.stream_to_file(output_file)
-        
-        # 音声を再生
-        pygame.mixer.init()
-        pygame.mixer.music.load(output_file)
-        pygame.mixer.music.play()
+            speed=1,
+            response_format="pcm"
+        ),
+        reserve=reserve
+    )
+    return response.content
+
+def speak_text(text: str):
+    """テキストを音声に変換して再生する"""
+    try:
+        # OpenAI TTS APIを使用して音声を生成（ターンの残り時間内）
+        audio_data = synthesize_speech(text)
         
-        # 再生が終わるまで待機
-        while pygame.mixer.music.get_busy():
-            time.sleep(0.1)
-            
-        # クリーンアップ
-        pygame.mixer.quit()
-        os.remove(output_file)
+        # デバイスの形式に変換しながら、開いたままの出力ストリームで再生
+        record_turn_latency()
+        stream_audio_data(audio_data)
         
+    except DeadlineExceeded:
+        logger.warning("音声合成が期限内に終わらなかったため定型の応答に切り替えます")
+        speak_fallback()
     except Exception as e:
         logger.error(f"音声出力エラー: {str(e)}", exc_info=True)
 
-def get_command_keywords() -> List[str]:
-    """MCPサーバーからコマンドキーワードを取得"""
+def prepare_fallback_audio():
+    """期限切れの場合の応答音声を起動時に合成しておく"""
+    global fallback_audio
+    try:
+        fallback_audio = synthesize_speech(TURN_FALLBACK_TEXT)
+    except Exception as e:
+        logger.warning(f"定型の応答音声を用意できませんでした: {str(e)}")
+
+def speak_fallback():
+    """ターンの期限を過ぎた場合に短い定型の応答を返す（音声は合成済みのものを再生）"""
+    global turn_fallbacks
+    turn_fallbacks += 1
+    print(f"AI: {TURN_FALLBACK_TEXT}")
+    record_turn_latency()
+    if fallback_audio:
+        stream_audio_data(fallback_audio)
+
+def get_command_keyword_map() -> Dict[str, str]:
+    """MCPサーバーからコマンドキーワードとコマンド名の対応を取得"""
     try:
         status = mcp.get_status()
-        logger.debug(f"MCPステータス: {status}")
+        log_event(logger, logging.DEBUG, "mcp.status", status=status)
         
         if status.get("status") == "success" and "commands" in status.get("data", {}):
             commands_data = status["data"]["commands"]
-            keywords = []
+            keywords = {}
             
             # コマンド情報から基本キーワードを抽出
             for command_name, command_info in commands_data.items():
                 logger.debug(f"処理中のコマンド: {command_name}")
-                keywords.append(command_name)
+                keywords[command_name] = command_name
                 
                 # 例文からもキーワードを抽出
                 if "examples" in command_info:
@@ -175,42 +222,65 @@ def get_command_keywords() -> List[str]:
                         words = base_example.split()
                         for word in words:
                             if word not in ['を', 'の', 'は', 'が']:
-                                keywords.append(word)
+                                keywords[word] = command_name
             
             logger.debug(f"抽出された基本キーワード: {keywords}")
             
             # ひらがな変換も追加
-            additional_keywords = []
-            for keyword in keywords:
+            additional_keywords = {}
+            for keyword, command_name in keywords.items():
                 if 'ヘルプ' in keyword:
-                    additional_keywords.append('へるぷ')
+                    additional_keywords['へるぷ'] = command_name
                 elif 'メモリ' in keyword:
-                    additional_keywords.append('めもり')
+                    additional_keywords['めもり'] = command_name
                 elif keyword.upper() == 'CPU':
-                    additional_keywords.append('cpu')
+                    additional_keywords['cpu'] = command_name
                 elif '天気' in keyword:
-                    additional_keywords.append('てんき')
+                    additional_keywords['てんき'] = command_name
             
-            final_keywords = list(set(keywords + additional_keywords))
+            final_keywords = {**keywords, **additional_keywords}
             logger.debug(f"最終的なキーワードリスト: {final_keywords}")
             return final_keywords
             
     except Exception as e:
         logger.error(f"キーワード取得エラー: {str(e)}", exc_info=True)
-        return []
+    return {}
+
+def get_command_keywords() -> List[str]:
+    """MCPサーバーからコマンドキーワードを取得"""
+    return list(get_command_keyword_map())
+
+def cap_for_llm(result: Dict[str, Any]) -> Dict[str, Any]:
+    """LLMに渡すMCPレスポンスを上限内に切り詰める"""
+    data = result.get("data")
+    if not isinstance(data, dict):
+        return result
+
+    capped = dict(data)
+    entries = data.get("entries")
+    if isinstance(entries, list) and len(entries) > LLM_MAX_FILE_ENTRIES:
+        capped["entries"] = entries[:LLM_MAX_FILE_ENTRIES]
+        capped["omitted_entries"] = data.get("total", len(entries)) - LLM_MAX_FILE_ENTRIES
+    elif isinstance(entries, list) and data.get("total", len(entries)) > len(entries):
+        capped["omitted_entries"] = data["total"] - len(entries)
+
+    info = data.get("info")
+    if isinstance(info, str) and len(info) > LLM_MAX_TEXT_CHARS:
+        capped["info"] = info[:LLM_MAX_TEXT_CHARS] + "…（以下省略）"
+
+    return {**result, "data": capped}
 
 def format_response_for_human(result: Dict[str, Any]) -> str:
     """MCPサーバーからのレスポンスを人間が理解しやすい形式に変換"""
     try:
         # レスポンスをJSON文字列に変換
-        result_json = json.dumps(result, ensure_ascii=False)
+        result_json = dumps_json_text(cap_for_llm(result))
         
         # デバッグログとして元のメッセージを出力
-        logger.info(f"元のレスポンス: {result_json}")
+        log_event(logger, logging.INFO, "format.input", response=result)
         
         # LLMを使用してレスポンスを人間が読みやすい形式に変換
-        client = openai.OpenAI()
-        response = client.chat.completions.create(
+        response = call_openai("llm", lambda client: client.chat.completions.create(
             model="gpt-3.5-turbo",
             messages=[
                 {"role": "system", "content": """あなたはシステム情報を人間が理解しやすい日本語に変換するアシスタントです。
@@ -223,7 +293,8 @@ def format_response_for_human(result: Dict[str, Any]) -> str:
                 6. 入力されたJSONデータに含まれる情報のみを使用
                 7. 重複した情報は1回だけ表示
                 8. ファイル一覧を表示する場合：
-                   - lsコマンドの出力をそのまま表示
+                   - entriesの名前を一覧で表示（is_dirがtrueなら末尾に/を付ける）
+                   - omitted_entriesがあれば「ほか○件」と最後に添える
                    - 前置きは「現在のディレクトリの内容：」のみとする
                 9. 時刻情報を表示する場合：
                    - 日付、時刻、曜日を自然な日本語で表示
@@ -235,10 +306,12 @@ def format_response_for_human(result: Dict[str, Any]) -> str:
                 {"role": "user", "content": f"以下のシステム情報を簡潔な日本語で説明してください：\n{result_json}"}
             ],
             temperature=0.3  # より決定論的な応答を生成
-        )
+        ))
         formatted_response = response.choices[0].message.content
-        logger.debug(f"変換後のレスポンス: {formatted_response}")
+        log_event(logger, logging.DEBUG, "format.output", text=formatted_response)
         return formatted_response
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         logger.error(f"レスポンス変換エラー: {str(e)}", exc_info=True)
         # エラーの場合は、元のデータを整形して返す
@@ -247,44 +320,11 @@ def format_response_for_human(result: Dict[str, Any]) -> str:
         except:
             return str(result)
 
-def natural_to_mcp_request(text: str) -> Dict[str, Any]:
-    """自然文をMCPリクエストに変換"""
-    try:
-        # サーバーから利用可能なコマンド情報を取得
-        status = mcp.get_status()
-        if status.get("status") != "success" or "commands" not in status.get("data", {}):
-            logger.error("コマンド情報の取得に失敗しました")
-            return {
-                "command": "error",
-                "parameters": {
-                    "message": "コマンド情報を取得できませんでした"
-                }
-            }
-            
-        commands_data = status["data"]["commands"]
-        
-        # コマンド情報をプロンプトに変換
-        commands_info = []
-        for cmd_name, cmd_info in commands_data.items():
-            cmd_desc = {
-                "name": cmd_name,
-                "description": cmd_info["description"],
-                "examples": cmd_info["examples"],
-                "parameters": cmd_info["parameters"]
-            }
-            commands_info.append(cmd_desc)
-            
-        commands_json = json.dumps(commands_info, ensure_ascii=False, indent=2)
-        
-        # OpenAI APIを使用してリクエストを解析
-        client = openai.OpenAI()
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": f"""あなたは自然な日本語をMCPリクエストに変換するパーサーです。
+# 自然文の解析に使うシステムプロンプト（起動時に1回だけ構築し、毎回同じバイト列を送る）
+PARSER_SYSTEM_PROMPT = f"""あなたは自然な日本語をMCPリクエストに変換するパーサーです。
 以下のコマンドが利用可能です：
 
-{commands_json}
+{COMMANDS.catalog_json()}
 
 ユーザーの入力を解析し、以下の形式でJSONレスポンスのみを返してください：
 
@@ -325,15 +365,24 @@ def natural_to_mcp_request(text: str) -> Dict[str, Any]:
     "parameters": {{
         "message": "コマンドを認識できませんでした"
     }}
-}}"""},
+}}"""
+
+def natural_to_mcp_request(text: str) -> Dict[str, Any]:
+    """自然文をMCPリクエストに変換"""
+    try:
+        # OpenAI APIを使用してリクエストを解析
+        response = call_openai("llm", lambda client: client.chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=[
+                {"role": "system", "content": PARSER_SYSTEM_PROMPT},
                 {"role": "user", "content": text}
             ],
             temperature=0.1  # より決定論的な応答を生成
-        )
+        ))
         
         # レスポンスをパース
         result = response.choices[0].message.content.strip()
-        logger.debug(f"OpenAI解析結果: {result}")
+        log_event(logger, logging.DEBUG, "parse.llm_output", text=result)
         
         try:
             # 余分なテキストを削除してJSONのみを抽出
@@ -372,6 +421,8 @@ def natural_to_mcp_request(text: str) -> Dict[str, Any]:
                 }
             }
             
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         logger.error(f"MCP変換エラー: {str(e)}", exc_info=True)
         return {
@@ -383,13 +434,17 @@ def natural_to_mcp_request(text: str) -> Dict[str, Any]:
 
 def process_command(text: str) -> str:
     """音声コマンドを処理する"""
+    speculation = None
     try:
+        # 解析を待つ間に、予測したツール呼び出しを先行実行
+        speculation = ToolSpeculation(text)
+
         # 自然文をMCPリクエストに変換
         request = natural_to_mcp_request(text)
         if not request:
             return "申し訳ありません。コマンドの解析に失敗しました。"
             
-        logger.debug(f"変換されたリクエスト: {request}")
+        log_event(logger, logging.DEBUG, "parse.request", request=request)
         
         # エラー処理
         if request["command"] == "error":
@@ -406,17 +461,12 @@ def process_command(text: str) -> str:
         
         # コマンドを実行
         try:
-            if request["command"] == "weather":
-                city = request["parameters"].get("city", "東京")
-                result = mcp.get_weather(city)
-            elif request["command"] == "system":
-                info_type = request["parameters"].get("type", "cpu")
-                result = mcp.get_system_info(info_type)
-            elif request["command"] == "time":
-                result = mcp.get_time()
-            else:
+            call = COMMANDS.command_call(request["command"], request["parameters"])
+            if call is None:
                 logger.error(f"不明なコマンド: {request['command']}")
                 return "申し訳ありません。そのコマンドは現在サポートされていません。"
+
+            result = run_tool_calls([call], speculation=speculation)[0]
                 
             # エラーチェック
             if result.get("status") == "error":
@@ -426,136 +476,635 @@ def process_command(text: str) -> str:
             # レスポンスを人間が理解しやすい形式に変換
             return format_response_for_human(result)
             
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             logger.error(f"コマンド実行エラー: {str(e)}", exc_info=True)
             return f"申し訳ありません。コマンドの実行中にエラーが発生しました: {str(e)}"
         
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         logger.error(f"コマンド処理エラー: {str(e)}", exc_info=True)
         return "申し訳ありません。予期せぬエラーが発生しました。"
+    finally:
+        # コマンドを実行しなかった場合も先行実行分を破棄して集計
+        if speculation:
+            speculation.finish(time.monotonic())
+
+def load_keyword_gate() -> Optional[KeywordSpotter]:
+    """KWS_TEMPLATE_PATHのテンプレートからキーワードゲートを作成（未指定なら無効）"""
+    if not KWS_TEMPLATE_PATH:
+        return None
+    try:
+        return KeywordSpotter.load(KWS_TEMPLATE_PATH, KWS_THRESHOLD, search_seconds=KWS_SEARCH_SECONDS)
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"キーワードゲートを無効にします: {str(e)}")
+        return None
+
+keyword_gate = load_keyword_gate()
+
+def check_keyword_gate(frames: bytes, sample_rate: int, sample_width: int) -> Tuple[bool, bool]:
+    """発話を文字起こしに回すか判定（戻り値は(文字起こしするか, 棄却した発話の確認か)）"""
+    if keyword_gate is None or keyword_gate.accepts(frames, sample_rate, sample_width):
+        return True, False
+    # 誤棄却を見積もるため、棄却した発話の一部だけ文字起こしする
+    if KWS_KEYWORD_TEXT and random.random() < KWS_AUDIT_RATE:
+        return True, True
+    return False, False
+
+def review_gated_transcript(text: Optional[str], audited: bool) -> Optional[str]:
+    """文字起こし結果でゲートの判定を検証（棄却すべき発話はNoneにする）"""
+    if keyword_gate is None or not KWS_KEYWORD_TEXT or not text:
+        return text
+    contains_keyword = normalize_key(KWS_KEYWORD_TEXT) in normalize_key(text)
+    keyword_gate.stats.record_outcome(not audited, contains_keyword, audited)
+    if audited and not contains_keyword:
+        return None
+    return text
+
+def transcribe_wav(wav_data: bytes, prompt: Optional[str] = None) -> str:
+    """WAVデータをWhisperで文字起こしする"""
+    options = {"prompt": prompt} if prompt else {}
+    response = call_openai("stt", lambda client: client.audio.transcriptions.create(
+        model="whisper-1",
+        file=("speech.wav", wav_data),
+        **options
+    ))
+    return response.text
+
+def listen_to_speech_streaming(on_stable: Optional[Callable[[str], None]] = None) -> Optional[str]:
+    """発話中に重なりのある窓を逐次文字起こしし、部分結果を表示する"""
+    recognizer = audio_devices.input.recognizer
+
+    def show_partial(text: str):
+        print(f"\r(認識中) {text}", end="", flush=True)
+
+    try:
+        source = audio_devices.input.acquire()
+        print("聞き取っています...")
+        transcriber = StreamingTranscriber(
+            transcribe_wav,
+            source.SAMPLE_RATE,
+            source.SAMPLE_WIDTH,
+            chunk_seconds=STT_CHUNK_SECONDS,
+            window_seconds=STT_WINDOW_SECONDS,
+            on_partial=show_partial,
+            on_stable=on_stable
+        )
+        seconds_per_buffer = source.CHUNK / source.SAMPLE_RATE
+        pause_buffers = int(math.ceil(recognizer.pause_threshold / seconds_per_buffer))
+        gate_buffers = int(math.ceil(KWS_SEARCH_SECONDS / seconds_per_buffer))
+        # 発話開始直前の音声も含める
+        preroll = deque(maxlen=int(math.ceil(recognizer.non_speaking_duration / seconds_per_buffer)) or 1)
+        started = False
+        skipping = False
+        pending: Optional[List[bytes]] = None
+        audited = False
+        silent_buffers = 0
+
+        while True:
+            buffer = source.stream.read(source.CHUNK)
+            if not buffer:
+                break
+            samples = np.frombuffer(buffer, dtype=np.int16).astype(np.float64)
+            energy = float(np.sqrt(np.mean(np.square(samples)))) if len(samples) else 0.0
+
+            if not started:
+                preroll.append(buffer)
+                if energy <= recognizer.energy_threshold:
+                    # 発話していない区間で雑音レベルを追跡する
+                    audio_devices.input.track_noise(energy, seconds_per_buffer)
+                if energy > recognizer.energy_threshold:
+                    started = True
+                    silent_buffers = 0
+                    if keyword_gate is None:
+                        for frames in preroll:
+                            transcriber.feed(frames)
+                    else:
+                        # キーワードの判定が済むまでは文字起こしに送らずに溜める
+                        pending = list(preroll)
+                    preroll.clear()
+                continue
+
+            silent_buffers = silent_buffers + 1 if energy <= recognizer.energy_threshold else 0
+            speech_ended = silent_buffers >= pause_buffers
+
+            if skipping:
+                # キーワードを含まない発話は終わるまで読み捨てて次の発話を待つ
+                if speech_ended:
+                    started = skipping = False
+                continue
 
-def listen_to_speech():
+            if pending is not None:
+                pending.append(buffer)
+                if len(pending) < gate_buffers and not speech_ended:
+                    continue
+                send, audited = check_keyword_gate(b"".join(pending), source.SAMPLE_RATE, source.SAMPLE_WIDTH)
+                if not send:
+                    pending = None
+                    if speech_ended:
+                        started = False
+                    else:
+                        skipping = True
+                    continue
+                for frames in pending:
+                    transcriber.feed(frames)
+                pending = None
+            else:
+                transcriber.feed(buffer)
+
+            if speech_ended:
+                break
+
+        # 発話終了後は最後の窓1つ分の文字起こしだけを待つ（ターンの期限はここから）
+        start_turn()
+        text = transcriber.finish(timeout=stage_timeout(OPENAI_TIMEOUT, TTS_RESERVE_SECONDS))
+        print()
+        if not text and turn_expired(TTS_RESERVE_SECONDS):
+            raise DeadlineExceeded("文字起こしが期限内に終わりませんでした")
+        return review_gated_transcript(text, audited) or None
+    except DeadlineExceeded:
+        raise
+    except OSError as e:
+        # デバイスが外れた場合など。次の聞き取りで開き直す
+        audio_devices.input.recover(e)
+        print(f"マイクのエラーが発生しました: {str(e)}")
+        return None
+    except Exception as e:
+        print(f"エラーが発生しました: {str(e)}")
+        return None
+
+def listen_to_speech(on_stable: Optional[Callable[[str], None]] = None):
     """マイクから音声を取得し、テキストに変換する"""
-    recognizer = sr.Recognizer()
-    
-    with sr.Microphone() as source:
+    if STREAMING_STT:
+        return listen_to_speech_streaming(on_stable)
+
+    # マイクと認識器は開いたまま使い回す（しきい値はRecognizer.listenが雑音に合わせて更新する）
+    audio_input = audio_devices.input
+    try:
+        source = audio_input.acquire()
         print("聞き取っています...")
-        audio = recognizer.listen(source)
+        while True:
+            audio = audio_input.recognizer.listen(source)
+            # キーワードを含まない発話は文字起こしせずに聞き直す
+            send, audited = check_keyword_gate(audio.get_raw_data(), audio.sample_rate, audio.sample_width)
+            if send:
+                break
+    except OSError as e:
+        # デバイスが外れた場合など。次の聞き取りで開き直す
+        audio_input.recover(e)
+        print(f"マイクのエラーが発生しました: {str(e)}")
+        return None
+    
+    # ターンの期限は発話の終了時点から
+    start_turn()
         
     try:
         # Whisperを使用して音声認識（新しいAPI形式）
-        audio_file = "temp_audio.wav"
-        with open(audio_file, "wb") as f:
-            f.write(audio.get_wav_data())
-        
-        client = openai.OpenAI()
-        with open(audio_file, "rb") as audio_file:
-            response = client.audio.transcriptions.create(
-                model="whisper-1",
-                file=audio_file
-            )
-        
-        os.remove("temp_audio.wav")
-        return response.text
+        response = call_openai("stt", lambda client: client.audio.transcriptions.create(
+            model="whisper-1",
+            file=("speech.wav", audio.get_wav_data())
+        ))
+        return review_gated_transcript(response.text, audited)
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         print(f"エラーが発生しました: {str(e)}")
         return None
 
-def get_ai_response(text: str) -> str:
-    """ChatGPTを使用して応答を生成する"""
-    try:
-        # Function callingのための関数定義
-        functions = [
-            {
-                "name": "get_weather",
-                "description": "指定された都市の天気情報を取得します",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "city": {
-                            "type": "string",
-                            "description": "天気を知りたい都市名（例：東京、大阪）"
-                        }
-                    },
-                    "required": ["city"]
-                }
-            },
-            {
-                "name": "get_system_info",
-                "description": "システム情報を取得します",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "info_type": {
-                            "type": "string",
-                            "description": "取得したい情報のタイプ（cpu, memory, files）",
-                            "enum": ["cpu", "memory", "files"]
-                        }
-                    },
-                    "required": ["info_type"]
+# Tool callingのためのツール定義（コマンドの登録内容から起動時に1回だけ生成）
+TOOLS = COMMANDS.tool_schemas()
+
+SYSTEM_PROMPT = "あなたは音声対話AIアシスタントです。ユーザーの要求に応じて適切な情報を提供してください。"
+
+# LLMが本文のない応答を返した場合に読み上げる文
+EMPTY_RESPONSE_TEXT = "申し訳ありません。うまく答えられませんでした。もう一度お願いします。"
+
+# ツール1件あたりのタイムアウト（秒）
+TOOL_TIMEOUT = float(os.getenv('MCP_TOOL_TIMEOUT', '10'))
+
+# ツール並列実行用のスレッドプール
+tool_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="mcp-tool")
+
+# ツール名から実行関数を引く表
+tool_dispatch = COMMANDS.dispatch_table(mcp)
+
+def execute_tool(function_name: str, function_args: Dict[str, Any], priority: str = "interactive") -> Dict[str, Any]:
+    """ツール呼び出しを1件実行（上流の枠を使うツールにはpriorityを渡す）"""
+    handler = tool_dispatch.get(function_name)
+    if handler is None:
+        return {
+            "status": "error",
+            "error": {
+                "message": f"不明なツール: {function_name}",
+                "code": "UNKNOWN_TOOL"
+            }
+        }
+    return handler(function_args, priority=priority)
+
+# 低い優先度の先行実行がこれらのエラーになった場合は、LLMが同じ呼び出しを選んだ時点で通常の優先度でやり直す
+BACKGROUND_RETRY_CODES = ("RATE_LIMITED", "UPSTREAM_BUSY")
+
+# 投機的プリフェッチを有効にするか
+SPECULATIVE_PREFETCH = os.getenv('SPECULATIVE_PREFETCH', '1') == '1'
+# 安定した部分文字起こしでLLMの意図解析（1回目の呼び出し）を先に始めるか、と1ターンあたりの最大回数
+SPECULATIVE_INTENT = os.getenv('SPECULATIVE_INTENT', '1') == '1'
+SPECULATIVE_INTENT_MAX_CALLS = int(os.getenv('SPECULATIVE_INTENT_MAX_CALLS', '2'))
+
+# 先行する意図解析用のスレッドプール（同時に1ターン分だけ実行する）
+intent_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="llm-intent")
+
+# サーバーのコマンド名とツール名の対応
+COMMAND_TOOL_NAMES = {command.name: command.tool_name for command in COMMANDS}
+
+# サーバーのキーワード語彙を補うローカルのヒント（キーワード, ツール名, 引数）
+SPECULATION_HINTS = [
+    ("天気", "get_weather", {}),
+    ("てんき", "get_weather", {}),
+    ("気温", "get_weather", {}),
+    ("weather", "get_weather", {}),
+    ("時刻", "get_time", {}),
+    ("何時", "get_time", {}),
+    ("なんじ", "get_time", {}),
+    ("time", "get_time", {}),
+    ("cpu", "get_system_info", {"info_type": "cpu"}),
+    ("メモリ", "get_system_info", {"info_type": "memory"}),
+    ("めもり", "get_system_info", {"info_type": "memory"}),
+    ("memory", "get_system_info", {"info_type": "memory"}),
+    ("ファイル", "get_system_info", {"info_type": "files"}),
+    ("ふぁいる", "get_system_info", {"info_type": "files"})
+]
+
+# 予測に使う語彙（初回利用時に構築）
+speculation_vocabulary = None
+
+def get_speculation_vocabulary() -> List[Tuple[str, str, Dict[str, Any]]]:
+    """get_command_keywordsの語彙とローカルヒントから予測用の語彙を構築"""
+    global speculation_vocabulary
+    if speculation_vocabulary is None:
+        vocabulary = [(keyword.lower(), tool_name, args) for keyword, tool_name, args in SPECULATION_HINTS]
+        for keyword, command_name in get_command_keyword_map().items():
+            tool_name = COMMAND_TOOL_NAMES.get(command_name)
+            # 引数が決まらないsystemコマンドはローカルヒントに任せる
+            if tool_name and tool_name != "get_system_info":
+                vocabulary.append((keyword.lower(), tool_name, {}))
+        speculation_vocabulary = vocabulary
+    return speculation_vocabulary
+
+def predict_tool_calls(text: str) -> List[Tuple[str, Dict[str, Any]]]:
+    """発話から必要になりそうなツール呼び出しをローカルで予測"""
+    lowered = text.lower()
+    predictions = {}
+    for keyword, tool_name, args in get_speculation_vocabulary():
+        if not keyword or keyword not in lowered:
+            continue
+        if tool_name == "get_weather":
+            # 市区町村の索引で文中の都市をすべて拾う（見つからなければ東京）
+            cities = [record.name for record in mcp.city_index.find_in_text(text)] or ["東京"]
+            for city in cities:
+                predictions[tool_call_key(tool_name, {"city": city})] = (tool_name, {"city": city})
+        else:
+            predictions[tool_call_key(tool_name, args)] = (tool_name, args)
+    return list(predictions.values())
+
+def tool_call_key(function_name: str, function_args: Dict[str, Any]) -> Tuple[str, Any]:
+    """実際に発行されるMCPリクエスト単位でツール呼び出しを識別するキー"""
+    if function_name == "get_weather":
+        city = function_args.get("city", "東京")
+        record = mcp.resolve_city(city)
+        return (function_name, record.owm_id or record.name if record else city)
+    elif function_name == "get_system_info":
+        return (function_name, function_args.get("info_type"))
+    return (function_name, None)
+
+class SpeculationStats:
+    """投機的プリフェッチの的中率と短縮時間の集計"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.predicted = 0
+        self.hits = 0
+        self.misses = 0
+        self.wasted = 0
+        self.saved_seconds = 0.0
+        self.intents = 0
+        self.intent_hits = 0
+
+    def record(self, predicted: int, hits: int, misses: int, wasted: int, saved_seconds: float, intents: int = 0, intent_hits: int = 0):
+        with self.lock:
+            self.predicted += predicted
+            self.hits += hits
+            self.misses += misses
+            self.wasted += wasted
+            self.saved_seconds += saved_seconds
+            self.intents += intents
+            self.intent_hits += intent_hits
+
+    def summary(self) -> Dict[str, Any]:
+        with self.lock:
+            requested = self.hits + self.misses
+            return {
+                "predicted": self.predicted,
+                "hits": self.hits,
+                "misses": self.misses,
+                "wasted": self.wasted,
+                "hit_rate": self.hits / requested if requested else 0.0,
+                "precision": self.hits / self.predicted if self.predicted else 0.0,
+                "saved_seconds": round(self.saved_seconds, 3),
+                "intents": self.intents,
+                "intent_hits": self.intent_hits
+            }
+
+speculation_stats = SpeculationStats()
+
+class ToolSpeculation:
+    """LLMの応答待ちと並行して予測したツール呼び出しを先行実行する
+
+    部分文字起こしの段階では、LLMの意図解析（1回目の呼び出し）も先に始める（同時に1件まで）。
+    解析結果のツール呼び出しも先行実行し、確定テキストが解析したテキストと同じなら応答をそのまま使う。
+    """
+    def __init__(self, text: str):
+        # 完了済みのFutureにadd_done_callbackすると同じスレッドで呼ばれるので再入可能なロックにする
+        self.lock = threading.RLock()
+        self.started_at = {}
+        self.futures = {}
+        self.durations = {}
+        self.claimed = set()
+        self.misses = 0
+        self.finished = False
+        self.intents: Dict[str, Future] = {}
+        self.intent_text = ""
+        self.intent_running = False
+        self.intent_hit = False
+        self.extend(text)
+
+    def extend(self, text: str):
+        """より新しい発話テキストから予測を追加（実行済みの呼び出しは再利用）"""
+        if not SPECULATIVE_PREFETCH or self.finished:
+            return
+        try:
+            predictions = predict_tool_calls(text)
+        except Exception as e:
+            logger.warning(f"ツール予測エラー: {str(e)}")
+            predictions = []
+        self._submit(predictions)
+
+    def _submit(self, predictions: List[Tuple[str, Dict[str, Any]]]):
+        with self.lock:
+            for function_name, function_args in predictions:
+                if self.finished:
+                    return
+                key = tool_call_key(function_name, function_args)
+                if key in self.futures:
+                    continue
+                self.started_at[key] = time.monotonic()
+                self.futures[key] = submit_in_context(tool_executor, self._run, key, function_name, function_args)
+                logger.debug(f"投機的プリフェッチ開始: {key}")
+
+    def parse_intent(self, text: str):
+        """安定した部分文字起こしでLLMの意図解析を始める（解析中なら終わった後に最新のテキストで解析し直す）"""
+        if not SPECULATIVE_INTENT or self.finished:
+            return
+        with self.lock:
+            self.intent_text = text
+            if not self.intent_running:
+                self._start_intent()
+
+    def _start_intent(self):
+        # self.lockを取った状態で呼ぶ
+        text = self.intent_text
+        key = normalize_key(text)
+        if self.finished or key in self.intents or len(self.intents) >= SPECULATIVE_INTENT_MAX_CALLS:
+            return
+        self.intent_running = True
+        future = submit_in_context(intent_executor, request_intent, text)
+        self.intents[key] = future
+        logger.debug(f"意図解析を先行して開始: {text}")
+        future.add_done_callback(self._intent_done)
+
+    def _intent_done(self, future: Future):
+        # LLMが選んだツール呼び出しも先行実行する
+        try:
+            tool_calls = future.result().choices[0].message.tool_calls or []
+            self._submit([parse_tool_call(tool_call) for tool_call in tool_calls])
+        except Exception as e:
+            logger.debug(f"先行した意図解析のエラー: {str(e)}")
+        with self.lock:
+            self.intent_running = False
+            self._start_intent()
+
+    def take_intent(self, text: str) -> Optional[Any]:
+        """確定テキストと同じテキストで先に始めた意図解析の応答を取り出す（なければNone）"""
+        future = self.intents.get(normalize_key(text))
+        if future is None:
+            return None
+        try:
+            response = future.result(timeout=stage_timeout(OPENAI_TIMEOUT, TTS_RESERVE_SECONDS))
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            # 失敗・時間切れの場合は確定テキストで呼び出し直す
+            logger.debug(f"先行した意図解析を使えませんでした: {str(e)}")
+            return None
+        self.intent_hit = True
+        return response
+
+    def _run(self, key: Tuple[str, Any], function_name: str, function_args: Dict[str, Any]) -> Dict[str, Any]:
+        started_at = time.monotonic()
+        try:
+            # 外れた予測が利用者の呼び出しと上流の枠を取り合わないよう、先行実行は低い優先度で行う
+            return execute_tool(function_name, function_args, priority="background")
+        finally:
+            self.durations[key] = time.monotonic() - started_at
+
+    def claim(self, function_name: str, function_args: Dict[str, Any]) -> Optional[Future]:
+        """LLMの判断と一致した先行実行結果を取り出す（不一致ならNone）"""
+        key = tool_call_key(function_name, function_args)
+        future = self.futures.get(key)
+        if future is None or key in self.claimed:
+            self.misses += 1
+            return None
+        self.claimed.add(key)
+        return future
+
+    def finish(self, decided_at: float):
+        """未使用の結果を破棄し、的中率と短縮時間を記録（聞き取れなかったターンでも呼ぶ）"""
+        with self.lock:
+            if self.finished:
+                return
+            self.finished = True
+        for future in self.intents.values():
+            future.cancel()
+        saved_seconds = 0.0
+        wasted = 0
+        for key, future in self.futures.items():
+            if key in self.claimed:
+                # 先行実行しなければLLMの判断後にduration分かかっていた
+                duration = self.durations.get(key)
+                if duration is not None:
+                    saved_seconds += max(0.0, min(duration, decided_at - self.started_at[key]))
+            else:
+                future.cancel()
+                wasted += 1
+        speculation_stats.record(len(self.futures), len(self.claimed), self.misses, wasted, saved_seconds, len(self.intents), int(self.intent_hit))
+        logger.info(
+            f"投機的プリフェッチ: 的中={len(self.claimed)} 外れ={self.misses} 破棄={wasted} 短縮={saved_seconds:.3f}秒 "
+            f"意図解析={len(self.intents)}件（{'使用' if self.intent_hit else '未使用'}）"
+        )
+
+def run_tool_calls(
+    calls: List[Tuple[str, Dict[str, Any]]],
+    timeout: float = TOOL_TIMEOUT,
+    speculation: Optional[ToolSpeculation] = None
+) -> List[Dict[str, Any]]:
+    """複数のツール呼び出しをMCPControllerに対して並列実行"""
+    decided_at = time.monotonic()
+    futures = []
+    speculative = []
+    for function_name, function_args in calls:
+        future = speculation.claim(function_name, function_args) if speculation else None
+        speculative.append(future is not None)
+        if future is None:
+            future = submit_in_context(tool_executor, execute_tool, function_name, function_args)
+        futures.append(future)
+
+    # すべて同時に投入しているため、各ツールの期限は投入時刻から計算する（ターンの残り時間が短ければそちら）
+    deadline = decided_at + stage_timeout(timeout, TTS_RESERVE_SECONDS)
+    results = []
+    for (function_name, function_args), future, claimed in zip(calls, futures, speculative):
+        try:
+            result = future.result(timeout=max(0.0, deadline - time.monotonic()))
+            if claimed and result.get("status") == "error" and result.get("error", {}).get("code") in BACKGROUND_RETRY_CODES:
+                # 低い優先度では枠を確保できなかった先行実行は、利用者の呼び出しとしてやり直す
+                logger.info(f"先行実行が枠待ちで失敗したため通常の優先度で再実行: {function_name}")
+                result = submit_in_context(tool_executor, execute_tool, function_name, function_args).result(
+                    timeout=max(0.0, deadline - time.monotonic())
+                )
+        except FuturesTimeoutError:
+            future.cancel()
+            logger.warning(f"ツール実行タイムアウト: {function_name}")
+            result = {
+                "status": "error",
+                "error": {
+                    "message": f"{function_name}がタイムアウトしました",
+                    "code": "TOOL_TIMEOUT"
                 }
-            },
-            {
-                "name": "get_time",
-                "description": "現在の時刻情報を取得します",
-                "parameters": {
-                    "type": "object",
-                    "properties": {}
+            }
+        except Exception as e:
+            logger.error(f"ツール実行エラー: {str(e)}", exc_info=True)
+            result = {
+                "status": "error",
+                "error": {
+                    "message": str(e),
+                    "code": "TOOL_EXECUTION_ERROR"
                 }
             }
+        results.append(result)
+
+    if speculation:
+        speculation.finish(decided_at)
+    return results
+
+def execute_tool_calls(
+    tool_calls: List[Any],
+    timeout: float = TOOL_TIMEOUT,
+    speculation: Optional[ToolSpeculation] = None
+) -> List[Dict[str, Any]]:
+    """LLMが要求したツール呼び出しを並列実行"""
+    return run_tool_calls([parse_tool_call(tool_call) for tool_call in tool_calls], timeout, speculation)
+
+def parse_tool_call(tool_call: Any) -> Tuple[str, Dict[str, Any]]:
+    """LLMのツール呼び出しを（ツール名, 引数）に変換"""
+    try:
+        function_args = json.loads(tool_call.function.arguments or "{}")
+    except json.JSONDecodeError:
+        function_args = {}
+    return tool_call.function.name, function_args
+
+def request_intent(text: str) -> Any:
+    """1回目のLLM呼び出し（直接応答するか、どのツールを呼ぶかを決める）"""
+    return call_openai("llm", lambda client: client.chat.completions.create(
+        model="gpt-3.5-turbo",
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": text}
+        ],
+        tools=TOOLS,
+        tool_choice="auto"
+    ))
+
+def get_ai_response(text: str, speculation: Optional[ToolSpeculation] = None) -> str:
+    """ChatGPTを使用して応答を生成する"""
+    try:
+        messages = [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": text}
         ]
 
-        # OpenAI APIを呼び出し
-        client = openai.OpenAI()
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "あなたは音声対話AIアシスタントです。ユーザーの要求に応じて適切な情報を提供してください。"},
-                {"role": "user", "content": text}
-            ],
-            functions=functions,
-            function_call="auto"
-        )
+        # LLMの応答を待つ間に、予測したツール呼び出しを先行実行
+        # （部分文字起こしの段階で開始済みなら、確定テキストで予測を追加する）
+        if speculation is None:
+            speculation = ToolSpeculation(text)
+        else:
+            speculation.extend(text)
+
+        # OpenAI APIを呼び出し（ターンの残り時間内）。部分文字起こしで同じテキストを解析済みならその応答を使う
+        response = speculation.take_intent(text)
+        if response is None:
+            response = request_intent(text)
 
         # レスポンスを処理
         message = response.choices[0].message
 
-        # 関数呼び出しが必要な場合
-        if message.function_call:
-            # 関数名と引数を取得
-            function_name = message.function_call.name
-            function_args = json.loads(message.function_call.arguments)
-
-            # 関数を実行
-            if function_name == "get_weather":
-                result = mcp.get_weather(function_args.get("city", "東京"))
-            elif function_name == "get_system_info":
-                result = mcp.get_system_info(function_args.get("info_type"))
-            elif function_name == "get_time":
-                result = mcp.get_time()
-            else:
-                return "申し訳ありません。その操作は実行できません。"
-
-            # 関数の結果を使って2回目の応答を生成
-            second_response = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": "あなたは音声対話AIアシスタントです。ユーザーの要求に応じて適切な情報を提供してください。"},
-                    {"role": "user", "content": text},
-                    {"role": "function", "name": function_name, "content": json.dumps(result, ensure_ascii=False)},
-                ],
-                functions=functions
-            )
-
-            # 最終的な応答を返す
-            return second_response.choices[0].message.content
-        
-        # 関数呼び出しが不要な場合は直接応答を返す
-        return message.content
+        # ツール呼び出しが不要な場合は直接応答を返す
+        if not message.tool_calls:
+            return message.content or EMPTY_RESPONSE_TEXT
 
+        # 1回の応答で要求されたツールをまとめて並列実行（先行実行と一致したものは再利用）
+        results = execute_tool_calls(message.tool_calls, speculation=speculation)
+
+        messages.append({
+            "role": "assistant",
+            "content": message.content,
+            "tool_calls": [
+                {
+                    "id": tool_call.id,
+                    "type": "function",
+                    "function": {
+                        "name": tool_call.function.name,
+                        "arguments": tool_call.function.arguments
+                    }
+                }
+                for tool_call in message.tool_calls
+            ]
+        })
+        for tool_call, result in zip(message.tool_calls, results):
+            messages.append({
+                "role": "tool",
+                "tool_call_id": tool_call.id,
+                "content": dumps_json_text(cap_for_llm(result))
+            })
+
+        # すべてのツール結果を使って1回だけ追加の応答を生成（ここではツールを呼ばせず、必ず本文で答えさせる）
+        second_response = call_openai("llm", lambda client: client.chat.completions.create(
+            model="gpt-3.5-turbo",
+            messages=messages,
+            tools=TOOLS,
+            tool_choice="none"
+        ))
+
+        # 最終的な応答を返す（本文がなければ定型の応答で何も話さないターンを避ける）
+        return second_response.choices[0].message.content or EMPTY_RESPONSE_TEXT
+
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         logger.error(f"エラーが発生しました: {str(e)}", exc_info=True)
         return "申し訳ありません。エラーが発生しました。"
+    finally:
+        # ツールを使わなかった場合も先行実行分を破棄して集計
+        if speculation:
+            speculation.finish(time.monotonic())
 
 def display_available_commands():
     """利用可能なコマンドを表示"""
@@ -589,23 +1138,53 @@ def main():
         
         # 起動時にMCPサーバーから利用可能なコマンドを取得して表示
         display_available_commands()
+
+        # 投機的プリフェッチ用の語彙を事前に構築
+        if SPECULATIVE_PREFETCH:
+            get_speculation_vocabulary()
+
+        # 期限切れの場合の応答音声を合成しておく
+        prepare_fallback_audio()
         
         print("会話を始めてください。")
         print("終了するには Ctrl+C を押してください。")
         
         while True:
             try:
-                # 音声入力を受け取る
-                user_input = listen_to_speech()
-                if user_input:
-                    print(f"あなた: {user_input}")
-                    
-                    # AI応答を生成
-                    ai_response = get_ai_response(user_input)
-                    if ai_response:
-                        print(f"AI: {ai_response}")
-                        speak_text(ai_response)
-                
+                # ターンの期限は発話の終了時点で開始する
+                set_deadline(None)
+
+                # 安定した部分文字起こしが得られた時点で意図の予測を開始
+                speculation = None
+
+                def on_stable(partial: str):
+                    nonlocal speculation
+                    if speculation is None:
+                        speculation = ToolSpeculation(partial)
+                    else:
+                        speculation.extend(partial)
+                    # LLMの意図解析も確定テキストを待たずに始める
+                    speculation.parse_intent(partial)
+
+                try:
+                    # 音声入力を受け取る
+                    user_input = listen_to_speech(on_stable)
+                    if user_input:
+                        print(f"あなた: {user_input}")
+
+                        # AI応答を生成
+                        ai_response = get_ai_response(user_input, speculation)
+                        if ai_response:
+                            print(f"AI: {ai_response}")
+                            speak_text(ai_response)
+                finally:
+                    # 聞き取れなかった場合や期限切れの場合も、部分文字起こしで始めた先行実行を破棄して集計する
+                    if speculation is not None:
+                        speculation.finish(time.monotonic())
+
+            except DeadlineExceeded as e:
+                logger.warning(f"定型の応答に切り替えます: {str(e)}")
+                speak_fallback()
             except KeyboardInterrupt:
                 print("\nプログラムを終了します。")
                 break
@@ -616,8 +1195,18 @@ def main():
     except Exception as e:
         logger.error(f"予期せぬエラーが発生しました: {str(e)}", exc_info=True)
     finally:
+        # 投機的プリフェッチの効果を報告
+        print(f"投機的プリフェッチ統計: {json.dumps(speculation_stats.summary(), ensure_ascii=False)}")
+        print(f"ターン所要時間: {json.dumps({**turn_latency.summary(), 'fallbacks': turn_fallbacks}, ensure_ascii=False)}")
+        print(f"期限・ヘッジ統計: {json.dumps({**openai_hedger.stats(), **{f'mcp.{key}': value for key, value in mcp.hedger.stats().items()}}, ensure_ascii=False)}")
+        if keyword_gate is not None:
+            print(f"キーワードゲート統計: {json.dumps(keyword_gate.stats.summary(), ensure_ascii=False)}")
+
+        print(f"音声デバイス統計: {json.dumps(audio_devices.stats(), ensure_ascii=False)}")
+
         # クリーンアップ処理
         try:
+            audio_devices.close()
             pygame.quit()
         except:
             pass